@@ -247,11 +247,13 @@ std = {
     'checkdigit_on_usestock': True,
 }
 
-# Print to a locally-attached TM-T20.
+# Print to a locally-attached TM-T20.  The spooler means the till
+# doesn't wait for the printer to finish.
 localprinter = {
-    'printer': quicktill.pdrivers.linux_lpprinter(
-        "/dev/epson-tm-t20",
-        driver=quicktill.pdrivers.Epson_TM_T20_driver(80)),
+    'printer': quicktill.pdrivers.spooler(
+        quicktill.pdrivers.linux_lpprinter(
+            "/dev/epson-tm-t20",
+            driver=quicktill.pdrivers.Epson_TM_T20_driver(80))),
 }
 # 'Print' into a popup window
 windowprinter = {
@@ -2,6 +2,7 @@
 
 import quicktill.extras
 import quicktill.foodcheck
+import quicktill.kitchen
 from quicktill.keyboard import *
 import quicktill.pdrivers
 import quicktill.register
@@ -458,10 +459,16 @@ config4.update(localprinter)
 config4.update(labelprinter)
 config4.update(kitchen)
 
+config5 = {'description': "Kitchen order display",
+           'firstpage': lambda: quicktill.kitchen.page(["kitchen"]),
+}
+config5.update(std)
+
 configurations = {
     'default': config0,
     'mainbar': config1,
     'stockterminal': config2,
     'testmenu': config3,
     'festival': config4,
+    'kitchen': config5,
 }
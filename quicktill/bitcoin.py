@@ -1,6 +1,6 @@
 import requests
 from decimal import Decimal
-from . import payment, ui, tillconfig, printer, td, keyboard
+from . import payment, ui, tillconfig, printer, td, keyboard, printtemplate
 from .models import zero, penny, Payment, Transaction
 try:
     import qrcode
@@ -113,17 +113,15 @@ class btcpopup(ui.dismisspopup):
             with ui.exception_guard("printing the QR code"):
                 data = self.qrcode_data(self.response)
                 with printer.driver as d:
-                    d.printline("\t" + tillconfig.pubname, emph=1)
-                    d.printline("\t{} payment".format(self._pm.description))
-                    d.printline("\t" + self.response['description'])
-                    d.printline("\t" + tillconfig.fc(self.response['amount']))
-                    d.printline("\t{} {} to pay".format(
-                            self.response['to_pay'], self._pm._currency))
-                    d.printqrcode(data.encode('utf-8'))
-                    d.printline()
-                    d.printline("\t" + self.response['pay_to_address'])
-                    d.printline()
-                    d.printline()
+                    printtemplate.render(
+                        d, 'qrcode_payment',
+                        method=self._pm.description,
+                        description=self.response['description'],
+                        amount=tillconfig.fc(self.response['amount']),
+                        to_pay=self.response['to_pay'],
+                        currency=self._pm._currency,
+                        data=data.encode('utf-8'),
+                        address=self.response['pay_to_address'])
     def refresh(self):
         payment = td.s.query(Payment).get(self._paymentid)
         if not payment:
@@ -4,6 +4,7 @@ from decimal import Decimal
 from .models import Delivery, Supplier, StockUnit, StockItem, StockType
 from .models import penny
 from .plugins import InstancePluginMount
+from sqlalchemy.orm import contains_eager
 import datetime
 
 import logging
@@ -13,18 +14,53 @@ log = logging.getLogger(__name__)
 def deliverymenu():
     """Display a list of deliveries and call the edit function.
     """
-    dl = td.s.query(Delivery)\
-             .order_by(Delivery.checked)\
-             .order_by(Delivery.date.desc())\
-             .order_by(Delivery.id.desc())\
-             .all()
     f = ui.tableformatter(' r L l L l ')
-    lines = [(f(x.id, x.supplier.name, x.date, x.docnumber or "",
-                "" if x.checked else "not confirmed"),
-              delivery, (x.id,)) for x in dl]
-    lines.insert(0, ("Record new delivery", delivery, None))
-    ui.menu(lines, title="Delivery List",
-            blurb="Select a delivery and press Cash/Enter.")
+    ui.querymenu(
+        lambda: td.s.query(Delivery)\
+                    .join(Supplier)\
+                    .options(contains_eager(Delivery.supplier))\
+                    .order_by(Delivery.checked)\
+                    .order_by(Delivery.date.desc())\
+                    .order_by(Delivery.id.desc()),
+        lambda x: f(x.id, x.supplier.name, x.date, x.docnumber or "",
+                    "" if x.checked else "not confirmed"),
+        lambda x: delivery(x.id),
+        title="Delivery List",
+        blurb="Type a supplier name to search, or select a delivery "
+        "and press Cash/Enter.",
+        filter_fields=[Supplier.name],
+        extra_items=[("Record new delivery", delivery, None)] + (
+            [("Print labels for a range of delivery dates", labelrange, None)]
+            if printer.labelprinters else []))
+
+class labelrange(ui.dismisspopup):
+    """Print stock labels for all deliveries between two dates
+    """
+    def __init__(self):
+        ui.dismisspopup.__init__(self, 7, 50, title="Print labels",
+                                 colour=ui.colour_input)
+        self.addstr(2, 2, "Print labels for deliveries dated")
+        self.addstr(4, 2, "from")
+        self.addstr(4, 18, "to")
+        today = datetime.date.today()
+        self.startfield = ui.datefield(4, 7, f=today)
+        self.endfield = ui.datefield(
+            4, 21, f=today, keymap={keyboard.K_CASH: (self.finish, None)})
+        ui.map_fieldlist([self.startfield, self.endfield])
+        self.startfield.focus()
+
+    def finish(self):
+        start = self.startfield.read()
+        end = self.endfield.read()
+        if not start or not end:
+            ui.infopopup(["You must enter both dates!"], title="Error")
+            return
+        self.dismiss()
+        menu = [("Print labels on {}".format(str(x)),
+                 printer.label_print_delivery_range, (x, start, end))
+                for x in printer.labelprinters]
+        ui.automenu(menu, title="Delivery print options",
+                    colour=ui.colour_confirm)
 
 class deliveryline(ui.line):
     def __init__(self, stockitem):
@@ -1,5 +1,7 @@
 import selectors
 import time
+import os
+import collections
 import logging
 
 log = logging.getLogger(__name__)
@@ -32,6 +34,14 @@ class SelectorsMainLoop:
         self.exit_code = None
         # Future events: key is wrapper object, value is time
         self._timeouts = {}
+        # Calls requested by other threads, and a pipe used to wake
+        # up the select() call when one is added
+        self._calls = collections.deque()
+        self._wakeup_r, self._wakeup_w = os.pipe()
+        os.set_blocking(self._wakeup_r, False)
+        os.set_blocking(self._wakeup_w, False)
+        self._sel.register(self._wakeup_r, selectors.EVENT_READ,
+                           self._run_calls)
 
     def shutdown(self, code):
         self.exit_code = code
@@ -91,13 +101,40 @@ class SelectorsMainLoop:
         self._timeouts[wrapper] = call_at
         return wrapper
 
-    def iterate(self):
+    def call_from_thread(self, func, desc=None):
+        """Arrange for func to be called from the main loop
+
+        This is the only method that may be called from a thread
+        other than the one running the main loop.
+        """
+        self._calls.append(func)
+        try:
+            os.write(self._wakeup_w, b'\0')
+        except BlockingIOError:
+            # The pipe is full, so the main loop will wake up anyway
+            pass
+
+    def _run_calls(self, mask):
+        try:
+            while os.read(self._wakeup_r, 4096):
+                pass
+        except BlockingIOError:
+            pass
+        while self._calls:
+            func = self._calls.popleft()
+            with timeout_time_guard:
+                func()
+
+    def iterate(self, max_wait=None):
         # Work out what the earliest timeout is
         timeout = None
         if self._timeouts:
             t = time.time()
             earliest = min(self._timeouts.values())
             timeout = earliest - t
+        # If we've been asked not to wait too long, don't
+        if max_wait is not None and (timeout is None or timeout > max_wait):
+            timeout = max_wait
         for key, mask in self._sel.select(timeout):
             key.data(mask)
         # Process any events whose time has come
@@ -77,5 +77,14 @@ class GLibMainLoop:
     def add_timeout(self, timeout, func, desc=None):
         return self._glib_timeout(self, timeout, func, desc)
 
+    def call_from_thread(self, func, desc=None):
+        def _call():
+            try:
+                func()
+            except Exception as e:
+                self._exc_info = sys.exc_info()
+            return False
+        GLib.idle_add(_call)
+
 if GLib is None:
     GLibMainLoop = None
@@ -0,0 +1,316 @@
+"""Bulk export of sales and stock movements
+
+Exports the rows of a table for a range of dates, for loading into
+other systems for analysis.  Rows are read through a server-side
+cursor a batch at a time and written out as they are read, so the
+amount of memory used doesn't depend on the number of rows.
+
+The tables that can be exported are "translines", "payments",
+"stockout" and "stock".  Transaction lines and payments include the
+session they belong to; stock items include the date of their
+delivery, which is the date used to choose them.
+
+Formats are "csv", and "parquet" and "arrow" (Arrow IPC stream
+format), which need the pyarrow library.
+
+Exports can be incremental: given the highest id exported last time
+(the "watermark"), only rows with higher ids are exported.  Each
+export also has an upper limit on ids, found when it starts, so that
+rows added while it is running are left for next time.  Ids are
+allocated when rows are inserted, not when they are committed, so a
+row added by a database transaction that was still in progress when
+an export started can be missed; run incremental exports when the
+till is quiet.  Stock items are exported when they are created, and
+not again when they are finished.
+"""
+
+import csv
+import io
+import sys
+import json
+import datetime
+from sqlalchemy import Integer, Numeric, DateTime, Date, Boolean
+from sqlalchemy.sql import select, func
+from . import cmdline, td
+from .models import Transline, Transaction, Payment, StockOut
+from .models import StockItem, Delivery
+try:
+    import pyarrow
+    import pyarrow.parquet
+    _arrow_available = True
+except ImportError:
+    _arrow_available = False
+
+import logging
+log = logging.getLogger(__name__)
+
+def _translines():
+    t = Transline.__table__
+    tr = Transaction.__table__
+    return [t, tr.c.sessionid], t.join(tr), t.c.translineid, t.c.time
+
+def _payments():
+    t = Payment.__table__
+    tr = Transaction.__table__
+    return [t, tr.c.sessionid], t.join(tr), t.c.paymentid, t.c.time
+
+def _stockout():
+    t = StockOut.__table__
+    return [t], t, t.c.stockoutid, t.c.time
+
+def _stock():
+    t = StockItem.__table__
+    d = Delivery.__table__
+    return [t, d.c.date.label("deliverydate")], t.join(d), t.c.stockid, \
+        d.c.date
+
+# name: function returning (columns, from clause, id column, date column)
+tables = {
+    'translines': _translines,
+    'payments': _payments,
+    'stockout': _stockout,
+    'stock': _stock,
+}
+
+def watermark(session, table):
+    """The highest id in a table, or 0 if it is empty
+    """
+    columns, fromclause, idcol, datecol = tables[table]()
+    return session.execute(select([func.max(idcol)])).scalar() or 0
+
+def query(table, start=None, end=None, since=None, upto=None):
+    """The select statement for an export
+
+    start and end are dates, and are inclusive.  since and upto are
+    ids: rows with ids greater than since and no greater than upto
+    are included.
+    """
+    columns, fromclause, idcol, datecol = tables[table]()
+    q = select(columns).select_from(fromclause).order_by(idcol)
+    if start:
+        q = q.where(datecol >= start)
+    if end:
+        q = q.where(datecol < end + datetime.timedelta(days=1))
+    if since:
+        q = q.where(idcol > since)
+    if upto is not None:
+        q = q.where(idcol <= upto)
+    return q
+
+def batches(session, q, batch_size=10000):
+    """Run a query through a server-side cursor
+
+    Yields lists of rows.
+    """
+    conn = session.connection().execution_options(stream_results=True)
+    result = conn.execute(q)
+    try:
+        while True:
+            rows = result.fetchmany(batch_size)
+            if not rows:
+                break
+            yield rows
+    finally:
+        result.close()
+
+class chunkbuffer:
+    """A file-like object that keeps what is written to it until it
+    is taken away
+    """
+    def __init__(self):
+        self._chunks = []
+        self.closed = False
+
+    def write(self, data):
+        self._chunks.append(bytes(data))
+        return len(data)
+
+    def flush(self):
+        pass
+
+    def take(self):
+        data = b"".join(self._chunks)
+        self._chunks = []
+        return data
+
+class csvwriter:
+    mimetype = "text/csv"
+
+    def __init__(self, f, columns):
+        self._f = f
+        self._buf = io.StringIO()
+        self._w = csv.writer(self._buf)
+        self._w.writerow([c.name for c in columns])
+
+    def write(self, rows):
+        self._w.writerows(rows)
+        self._f.write(self._buf.getvalue().encode("utf-8"))
+        self._buf.seek(0)
+        self._buf.truncate()
+
+    def close(self):
+        self._f.write(self._buf.getvalue().encode("utf-8"))
+
+def _arrow_schema(columns):
+    pa = pyarrow
+    fields = []
+    for c in columns:
+        if isinstance(c.type, Integer):
+            t = pa.int64()
+        elif isinstance(c.type, Numeric):
+            t = pa.decimal128(c.type.precision, c.type.scale)
+        elif isinstance(c.type, DateTime):
+            t = pa.timestamp("us")
+        elif isinstance(c.type, Date):
+            t = pa.date32()
+        elif isinstance(c.type, Boolean):
+            t = pa.bool_()
+        else:
+            t = pa.string()
+        fields.append(pa.field(c.name, t, nullable=c.nullable))
+    return pa.schema(fields)
+
+class _arrowwriter:
+    def __init__(self, f, columns):
+        self.schema = _arrow_schema(columns)
+        self._f = pyarrow.PythonFile(f, mode="w")
+
+    def _batch(self, rows):
+        return pyarrow.RecordBatch.from_arrays(
+            [pyarrow.array(values, type=field.type)
+             for values, field in zip(zip(*rows), self.schema)],
+            schema=self.schema)
+
+class parquetwriter(_arrowwriter):
+    mimetype = "application/vnd.apache.parquet"
+
+    def __init__(self, f, columns):
+        super().__init__(f, columns)
+        self._w = pyarrow.parquet.ParquetWriter(self._f, self.schema)
+
+    def write(self, rows):
+        # Each batch becomes a row group
+        self._w.write_table(
+            pyarrow.Table.from_batches([self._batch(rows)]))
+
+    def close(self):
+        self._w.close()
+
+class arrowwriter(_arrowwriter):
+    mimetype = "application/vnd.apache.arrow.stream"
+
+    def __init__(self, f, columns):
+        super().__init__(f, columns)
+        self._w = pyarrow.ipc.new_stream(self._f, self.schema)
+
+    def write(self, rows):
+        self._w.write_batch(self._batch(rows))
+
+    def close(self):
+        self._w.close()
+
+formats = {
+    'csv': csvwriter,
+    'parquet': parquetwriter,
+    'arrow': arrowwriter,
+}
+
+def format_available(format):
+    """Can exports be written in this format?
+    """
+    return format == "csv" or (format in formats and _arrow_available)
+
+def export(session, f, table, format="csv", batch_size=10000, **kwargs):
+    """Write an export to binary file f
+
+    Other keyword arguments are passed to query().  Returns the
+    number of rows written.
+    """
+    q = query(table, **kwargs)
+    w = formats[format](f, q.columns)
+    n = 0
+    for rows in batches(session, q, batch_size):
+        w.write(rows)
+        n += len(rows)
+    w.close()
+    return n
+
+def stream(session, table, format="csv", batch_size=10000, **kwargs):
+    """Generate an export a batch at a time
+
+    Yields bytes.  Other keyword arguments are passed to query().
+    """
+    q = query(table, **kwargs)
+    out = chunkbuffer()
+    w = formats[format](out, q.columns)
+    for rows in batches(session, q, batch_size):
+        w.write(rows)
+        yield out.take()
+    w.close()
+    yield out.take()
+
+class export_cmd(cmdline.command):
+    """Export sales and stock movements.
+
+    Writes the rows of a table for a range of dates in CSV, Parquet
+    or Arrow IPC stream format.  With --state, only rows added since
+    the last export using the same state file are written, and the
+    state file is updated afterwards.
+    """
+    command = "export"
+    help = "export sales and stock movements"
+
+    @staticmethod
+    def add_arguments(parser):
+        parser.add_argument("table", choices=sorted(tables.keys()),
+                            help="table to export")
+        parser.add_argument("-f", "--format", choices=sorted(formats.keys()),
+                            default="csv", help="output format")
+        parser.add_argument("-o", "--output", metavar="FILE",
+                            help="output file (default standard output)")
+        parser.add_argument("--start", type=_date,
+                            help="first date to export (YYYY-MM-DD)")
+        parser.add_argument("--end", type=_date,
+                            help="last date to export (YYYY-MM-DD)")
+        parser.add_argument("--state", metavar="FILE",
+                            help="file recording the watermark of the "
+                            "last export of each table")
+        parser.add_argument("--batch-size", type=int, default=10000,
+                            help="number of rows to read at a time")
+
+    @staticmethod
+    def run(args):
+        if not format_available(args.format):
+            print("The {} format needs the pyarrow library, which is not "
+                  "installed.".format(args.format), file=sys.stderr)
+            return 1
+        state = {}
+        if args.state:
+            try:
+                with open(args.state) as f:
+                    state = json.load(f)
+            except FileNotFoundError:
+                pass
+        since = state.get(args.table)
+        with td.orm_session():
+            upto = watermark(td.s, args.table)
+            if args.output:
+                f = open(args.output, "wb")
+            else:
+                f = sys.stdout.buffer
+            try:
+                n = export(td.s, f, args.table, format=args.format,
+                           batch_size=args.batch_size, start=args.start,
+                           end=args.end, since=since, upto=upto)
+            finally:
+                if args.output:
+                    f.close()
+        log.info("Exported %d rows from %s, ids after %d up to %d",
+                 n, args.table, since or 0, upto)
+        if args.state:
+            state[args.table] = upto
+            with open(args.state, "w") as f:
+                json.dump(state, f)
+
+def _date(s):
+    return datetime.datetime.strptime(s, "%Y-%m-%d").date()
@@ -48,7 +48,8 @@ class page(ui.basicpage):
         elif k == 'q' or k == 'Q':
             tillconfig.mainloop.shutdown(self._quitcode)
         elif k == 'o' or k == 'O' or k == keyboard.K_CASH:
-            foodorder.popup(self.receive_order, self.ordernumber)
+            foodorder.popup(self.receive_order, self.ordernumber,
+                            queue=False)
         else:
             ui.beep()
 
@@ -8,16 +8,66 @@ import datetime
 import hashlib
 import logging
 from . import ui, keyboard, td, printer, tillconfig, pdrivers, user
-from .models import zero, penny
+from . import printtemplate
+from .models import zero, penny, KitchenOrder
 from decimal import Decimal
 log=logging.getLogger(__name__)
 
 kitchenprinter=pdrivers.nullprinter(name="default_kitchenprinter")
 menuurl=None
 
+# Food orders can be split between several kitchen destinations, for
+# example a pizza oven and a grill, each with its own printer.  Items
+# go to the destination named in the menu if there is one, otherwise
+# to the destination for their department in kitchen_routes,
+# otherwise to default_destination.  Destinations not listed in
+# kitchenprinters use kitchenprinter.
+default_destination="kitchen"
+kitchenprinters={}
+kitchen_routes={}
+
+def kitchen_printer(destination):
+    """The printer for a kitchen destination
+    """
+    return kitchenprinters.get(destination,kitchenprinter)
+
+def spool_kitchen_printers():
+    """Print to the kitchen printers in the background
+
+    Wraps each kitchen printer that isn't already a spooler in one,
+    so that sending a food order doesn't wait for the kitchen
+    printers and orders for different destinations are printed in
+    parallel.  This is only done if the 'spool_kitchenprinters'
+    configuration key is set: errors that the printer doesn't report
+    in advance, such as a paper jam, are then only shown as a toast
+    when the spooler gives up, instead of the kitchen copy being
+    printed on the receipt printer straight away.
+    """
+    global kitchenprinter
+    def spooled(p):
+        return p if isinstance(p,pdrivers.spooler) else pdrivers.spooler(p)
+    kitchenprinter=spooled(kitchenprinter)
+    for destination in kitchenprinters:
+        kitchenprinters[destination]=spooled(kitchenprinters[destination])
+
+def kitchen_problems():
+    """Problems reported by kitchen printers
+
+    Returns a list of strings, which is empty if all the kitchen
+    printers are working.
+    """
+    problems=[]
+    for p in [kitchenprinter]+list(kitchenprinters.values()):
+        problem=p.offline()
+        if problem:
+            problems.append(problem if len(kitchenprinters)==0
+                            else "{}: {}".format(p,problem))
+    return problems
+
 class fooditem(ui.lrline):
-    def __init__(self,name,price,dept=None):
+    def __init__(self,name,price,dept=None,destination=None):
         self.dept=dept
+        self.destination=destination
         self.update(name,price,dept)
     def update(self,name,price,dept=None):
         self.name=name
@@ -26,12 +76,13 @@ class fooditem(ui.lrline):
         ui.lrline.__init__(self,name,tillconfig.fc(self.price)
                            if self.price!=zero else "")
     def copy(self):
-        return fooditem(self.name,self.price,self.dept)
+        return fooditem(self.name,self.price,self.dept,self.destination)
 
 def handle_option(itemfunc,option):
     """An option is either a tuple of (name,price), a tuple of
-    (name,price,dept), or a tuple of (name,action) where action is an
-    object with a display_menu method.
+    (name,price,dept), a tuple of (name,price,dept,destination), or a
+    tuple of (name,action) where action is an object with a
+    display_menu method.
 
     """
     if hasattr(option[1],'display_menu'):
@@ -175,43 +226,42 @@ def print_food_order(driver,number,ol,verbose=True,tablenumber=None,footer="",
 
     """
     with driver as d:
-        if verbose:
-            d.printline("\t%s"%tillconfig.pubname,emph=1)
-            for i in tillconfig.pubaddr:
-                d.printline("\t%s"%i,colour=1)
-            d.printline("\tTel. %s"%tillconfig.pubnumber)
-            d.printline()
-        if tablenumber is not None:
-            d.printline("\tTable number %s"%tablenumber,colour=1,emph=1)
-            d.printline()
-        if transid is not None:
-            d.printline("\tTransaction %s"%transid)
-            d.printline()
-        if user:
-            d.printline("\t%s"%user)
-            d.printline()
-        d.printline("\tFood order %d"%number,colour=1,emph=1)
-        d.printline()
-        d.printline("\t%s"%ui.formattime(datetime.datetime.now()))
-        d.printline()
-        tot=zero
-        for item in ol:
-            d.printline("%s\t\t%s"%(item.ltext,item.rtext))
-            tot+=item.price
-        if print_total:
-            d.printline("\t\tTotal %s"%tillconfig.fc(tot),emph=1)
-        d.printline()
-        d.printline("\tFood order %d"%number,colour=1,emph=1)
-        if tablenumber is not None:
-            d.printline()
-            d.printline("\tTable number %s"%tablenumber,colour=1,emph=1)
-        if verbose:
-            d.printline()
-            d.printline("\t%s"%footer)
-        else:
-            d.printline()
-            d.printline()
+        printtemplate.render(
+            d, 'foodorder', verbose=verbose, tablenumber=tablenumber,
+            has_table=tablenumber is not None, transid=transid,
+            has_transid=transid is not None, user=user, number=number,
+            time=ui.formattime(datetime.datetime.now()), items=ol,
+            print_total=print_total,
+            total=tillconfig.fc(sum((item.price for item in ol), zero)),
+            footer=footer)
+
+def route_order(items,dept):
+    """Split a food order between kitchen destinations
+
+    dept is the department for items that don't have one.  Returns a
+    list of (destination,items) tuples.
+    """
+    routed={}
+    for item in items:
+        destination=item.destination or kitchen_routes.get(
+            dept if item.dept is None else item.dept,default_destination)
+        routed.setdefault(destination,[]).append(item)
+    return list(routed.items())
+
+def queue_order(number,routed,tablenumber=None,transid=None):
+    """Add a food order to the kitchen queue
 
+    routed is a list of (destination,items) tuples as returned by
+    route_order().  Kitchen displays are notified when the database
+    session is committed.
+    """
+    dbuser=user.current_dbuser()
+    for destination,items in routed:
+        td.s.add(KitchenOrder(
+            number=number,destination=destination,transid=transid,
+            tablenumber=None if tablenumber is None else str(tablenumber),
+            user=dbuser,text="\n".join(item.name for item in items)))
+    td.s.flush()
 
 class tablenumber(ui.dismisspopup):
     """
@@ -261,7 +311,8 @@ class popup(user.permission_checked,ui.basicpopup):
     permission_required=('kitchen-order','Send an order to the kitchen')
     menu_hash=None
     menu_module=None
-    def __init__(self,func,ordernumberfunc=td.foodorder_ticket,transid=None):
+    def __init__(self,func,ordernumberfunc=td.foodorder_ticket,transid=None,
+                 queue=True):
         if menuurl is None:
             ui.infopopup(["No menu has been set!"],title="Error")
             return
@@ -313,9 +364,10 @@ class popup(user.permission_checked,ui.basicpopup):
         self.func=func
         self.transid=transid
         self.ordernumberfunc=ordernumberfunc
+        self.queue=queue
         self.h=20
         self.w=64
-        kpprob=kitchenprinter.offline()
+        kpprob="; ".join(kitchen_problems())
         rpprob=printer.driver.offline()
         if kpprob and rpprob:
             ui.infopopup(
@@ -444,29 +496,46 @@ class popup(user.permission_checked,ui.basicpopup):
         if r==None: return
         self.dismiss()
         if r==True:
-            user=ui.current_user()
+            u=ui.current_user()
+            username=u.shortname if u else None
             with ui.exception_guard("printing the customer copy"):
                 print_food_order(printer.driver,number,self.ml,
                                  verbose=True,tablenumber=tablenumber,
                                  footer=self.footer,transid=self.transid,
                                  print_total=self.print_total)
-            try:
-                print_food_order(
-                    kitchenprinter,number,self.ml,
-                    verbose=False,tablenumber=tablenumber,
-                    footer=self.footer,transid=self.transid,
-                    user=user.shortname if user else None)
-            except:
-                e=traceback.format_exception_only(
-                    sys.exc_info()[0],sys.exc_info()[1])
+            routed=route_order(self.ml,self.dept)
+            if self.queue:
+                queue_order(number,routed,tablenumber=tablenumber,
+                            transid=self.transid)
+            # If a kitchen printer is known not to be working, or
+            # printing to it fails, print its copy here instead.  If
+            # kitchen printers are spoolers the orders for different
+            # destinations are printed in parallel in the background.
+            errors=[]
+            for destination,items in routed:
+                kp=kitchen_printer(destination)
+                problem=kp.offline()
+                if not problem:
+                    try:
+                        print_food_order(
+                            kp,number,items,
+                            verbose=False,tablenumber=tablenumber,
+                            footer=self.footer,transid=self.transid,
+                            user=username)
+                        continue
+                    except:
+                        problem="".join(traceback.format_exception_only(
+                            sys.exc_info()[0],sys.exc_info()[1])).strip()
+                errors.append("{}: {}".format(kp,problem))
                 try:
                     print_food_order(
-                        printer.driver,number,self.ml,
+                        printer.driver,number,items,
                         verbose=False,tablenumber=tablenumber,
                         footer=self.footer,transid=self.transid,
-                        user=user.shortname if user else None)
+                        user=username)
                 except:
                     pass
+            if errors:
                 ui.infopopup(
                     ["There was a problem sending the order to the "
                      "printer in the kitchen, so the kitchen copy has been "
@@ -474,7 +543,7 @@ class popup(user.permission_checked,ui.basicpopup):
                      "so that they can make it.  Check that the printer "
                      "in the kitchen has paper, is turned on, and is plugged "
                      "in to the network.","","The error message from the "
-                     "printer is:"]+e,title="Kitchen printer error")
+                     "printer is:"]+errors,title="Kitchen printer error")
                 return
         else:
             if r:
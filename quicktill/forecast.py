@@ -0,0 +1,195 @@
+"""Forecasting stock usage
+
+Buying lists are worked out from how quickly each stock type has
+been used recently.  Rather than adding up the stockout table for the
+whole period every time, the stockusage table keeps the total used of
+each stock type for each reason on each day.
+
+The stockusage table is brought up to date at the end of every
+session by refresh(), which recalculates the days from the most
+recent day already in the table onwards.  Stock used on earlier days
+doesn't usually change; if it does, for example because a stock item
+has had its stock type corrected, run "runtill refresh-stock-usage
+--all" to recalculate the whole table.
+
+Forecasts are based on the average amount used per day over a
+number of whole days up to yesterday.  Where there are enough days
+to tell, this is adjusted for the day of the week: a stock type that
+sells twice as much on Fridays is expected to do so in future.
+"""
+
+import datetime
+from sqlalchemy import Date
+from sqlalchemy.orm import lazyload, undefer
+from sqlalchemy.sql import select, func
+from . import cmdline, td
+from .models import StockUsage, StockOut, StockItem, StockType
+
+import logging
+log = logging.getLogger(__name__)
+
+# Day of the week adjustments are only made when the period covers
+# at least this many of each day of the week
+min_weeks_for_weekdays = 4
+
+def refresh(session, start=None):
+    """Bring the stockusage table up to date
+
+    Days from start onwards are recalculated from the stockout table.
+    If start is None the days from the most recent day in the table
+    are recalculated, because that day may not have been complete; if
+    the table is empty, all days are calculated.  Returns the number
+    of rows written.
+    """
+    if start is None:
+        start = session.query(func.max(StockUsage.date)).scalar()
+    # This expression matches the stockout_date_key index
+    day = func.cast(StockOut.time, Date)
+    old = session.query(StockUsage)
+    if start:
+        old = old.filter(StockUsage.date >= start)
+    old.delete(synchronize_session=False)
+    q = select([day, StockItem.stocktype_id, StockOut.removecode_id,
+                func.sum(StockOut.qty)])\
+        .select_from(StockOut.__table__.join(StockItem.__table__))\
+        .group_by(day, StockItem.stocktype_id, StockOut.removecode_id)
+    if start:
+        q = q.where(day >= start)
+    r = session.execute(StockUsage.__table__.insert().from_select(
+        ['date', 'stocktype', 'removecode', 'qty'], q))
+    log.info("Stock usage: %d rows refreshed from %s", r.rowcount,
+             start or "the beginning")
+    return r.rowcount
+
+def _period(days, end=None):
+    """First and last dates of a period of whole days ending yesterday
+    """
+    if end is None:
+        end = datetime.date.today() - datetime.timedelta(days=1)
+    return end - datetime.timedelta(days=days - 1), end
+
+def usage_rates(session, days, end=None, removecode='sold', dept=None,
+                min_rate=None):
+    """Average amount of each stock type used per day
+
+    The period is the given number of days up to and including end,
+    which defaults to yesterday.  Returns a dict of stock type id to
+    amount per day.  Stock types used less than min_rate per day are
+    left out.
+    """
+    first, last = _period(days, end)
+    rate = func.sum(StockUsage.qty) / days
+    q = session.query(StockUsage.stocktype_id, rate)\
+               .filter(StockUsage.date >= first)\
+               .filter(StockUsage.date <= last)\
+               .filter(StockUsage.removecode_id == removecode)\
+               .group_by(StockUsage.stocktype_id)
+    if dept is not None:
+        q = q.join(StockType).filter(StockType.dept_id == dept)
+    if min_rate is not None:
+        q = q.having(rate > min_rate)
+    return dict(q.all())
+
+def weekday_factors(session, stocktypes, days, end=None, removecode='sold'):
+    """How much more or less of each stock type is used on each day
+
+    Returns a dict of stock type id to a list of seven numbers, one
+    for each day of the week starting with Monday, giving the amount
+    used on that day as a multiple of the amount used on an average
+    day.  If the period has fewer than min_weeks_for_weekdays of each
+    day, or none of a stock type was used, the numbers are all 1.0.
+    """
+    flat = [1.0] * 7
+    factors = {st: flat for st in stocktypes}
+    if days < min_weeks_for_weekdays * 7 or not stocktypes:
+        return factors
+    first, last = _period(days, end)
+    # Number of each day of the week in the period
+    counts = [0] * 7
+    for i in range(days):
+        counts[(first + datetime.timedelta(days=i)).weekday()] += 1
+    weekday = func.extract('isodow', StockUsage.date)
+    q = session.query(StockUsage.stocktype_id, weekday,
+                      func.sum(StockUsage.qty))\
+               .filter(StockUsage.date >= first)\
+               .filter(StockUsage.date <= last)\
+               .filter(StockUsage.removecode_id == removecode)\
+               .filter(StockUsage.stocktype_id.in_(list(stocktypes)))\
+               .group_by(StockUsage.stocktype_id, weekday)
+    used = {}
+    for st, dow, qty in q:
+        used.setdefault(st, [0.0] * 7)[int(dow) - 1] = float(qty)
+    for st, u in used.items():
+        average = sum(u) / days
+        if average > 0:
+            factors[st] = [u[i] / counts[i] / average for i in range(7)]
+    return factors
+
+def expected_usage(rate, factors, days, start=None):
+    """Amount expected to be used over the next few days
+
+    start is the first day, and defaults to today.
+    """
+    if start is None:
+        start = datetime.date.today()
+    return sum(rate * factors[(start + datetime.timedelta(days=i)).weekday()]
+               for i in range(days))
+
+def buylist(session, ahead, behind, min_rate, dept=None):
+    """What to buy to cover the next few days
+
+    ahead is the number of days to buy for, and behind the number of
+    days of sales to base the forecast on.  Returns a list of
+    (StockType, sold per day, amount to buy) tuples, most needed
+    first.  The StockType objects have their "instock" attribute
+    loaded.
+    """
+    if behind < 1:
+        return []
+    rates = usage_rates(session, behind, dept=dept, min_rate=min_rate)
+    if not rates:
+        return []
+    factors = weekday_factors(session, rates.keys(), behind)
+    sts = session.query(StockType)\
+                 .filter(StockType.id.in_(list(rates.keys())))\
+                 .options(lazyload(StockType.department),
+                          lazyload(StockType.unit),
+                          undefer(StockType.instock))\
+                 .all()
+    r = []
+    for st in sts:
+        rate = float(rates[st.id])
+        need = expected_usage(rate, factors[st.id], ahead)
+        r.append((st, rate, need - float(st.instock)))
+    r.sort(key=lambda x: x[2], reverse=True)
+    return r
+
+class refresh_stock_usage(cmdline.command):
+    """Bring the daily stock usage table up to date.
+
+    This is done automatically at the end of each session.  Use --all
+    after upgrading, or if stock used on earlier days has changed.
+    """
+    command = "refresh-stock-usage"
+    help = "update the daily stock usage table"
+
+    @staticmethod
+    def add_arguments(parser):
+        g = parser.add_mutually_exclusive_group()
+        g.add_argument("--all", action="store_true",
+                       help="recalculate every day")
+        g.add_argument("--start", type=_date,
+                       help="first day to recalculate (YYYY-MM-DD)")
+
+    @staticmethod
+    def run(args):
+        with td.orm_session():
+            if args.all:
+                start = datetime.date.min
+            else:
+                start = args.start
+            n = refresh(td.s, start)
+            print("{} rows written".format(n))
+
+def _date(s):
+    return datetime.datetime.strptime(s, "%Y-%m-%d").date()
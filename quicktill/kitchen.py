@@ -0,0 +1,219 @@
+"""Kitchen order display
+
+Shows the food orders waiting to be made at one or more kitchen
+destinations, oldest first.  The display listens for notifications
+from the database, so orders appear as soon as they are sent without
+the display having to poll the database.
+
+Use it as the first page of a till configuration, eg.
+
+'firstpage': lambda: quicktill.kitchen.page(["grill", "pizza"])
+"""
+
+import datetime
+from . import ui, td, keyboard, tillconfig, models
+from .models import KitchenOrder
+
+import logging
+log = logging.getLogger(__name__)
+
+class listener:
+    """Call a function when the kitchen order queue changes
+
+    The function is called with the set of destinations that have
+    changed, or None if they may all have changed (eg. after the
+    connection to the database has been lost and remade).  It is
+    called inside a database session.
+
+    The listener has a database connection of its own that is kept
+    out of the connection pool, because it spends all its time
+    waiting for notifications.
+    """
+    channel = "kitchen_orders"
+    reconnect_delay = 10
+
+    def __init__(self, func):
+        self.func = func
+        self._conn = None
+        self._handle = None
+        self._connect()
+
+    def _connect(self):
+        try:
+            c = models.metadata.bind.raw_connection()
+            c.detach()
+            self._conn = c.connection
+            # The pool's checkout ping leaves a transaction open
+            self._conn.rollback()
+            self._conn.autocommit = True
+            with self._conn.cursor() as cur:
+                cur.execute("LISTEN " + self.channel)
+        except Exception as e:
+            log.warning("Kitchen order listener: unable to connect: %s", e)
+            self._disconnect()
+            tillconfig.mainloop.add_timeout(
+                self.reconnect_delay, self._reconnect,
+                desc="kitchen order listener reconnect")
+            return False
+        self._handle = tillconfig.mainloop.add_fd(
+            self._conn.fileno(), self._ready, desc="kitchen order listener")
+        return True
+
+    def _disconnect(self):
+        if self._handle:
+            self._handle.remove()
+            self._handle = None
+        if self._conn:
+            try:
+                self._conn.close()
+            except Exception:
+                pass
+            self._conn = None
+
+    def _reconnect(self):
+        if self._connect():
+            # We may have missed notifications while disconnected
+            with td.orm_session():
+                self.func(None)
+
+    def _ready(self):
+        try:
+            self._conn.poll()
+        except Exception as e:
+            log.warning("Kitchen order listener: lost connection: %s", e)
+            self._disconnect()
+            tillconfig.mainloop.add_timeout(
+                self.reconnect_delay, self._reconnect,
+                desc="kitchen order listener reconnect")
+            return
+        destinations = set(n.payload for n in self._conn.notifies)
+        del self._conn.notifies[:]
+        if destinations:
+            with td.orm_session():
+                self.func(destinations)
+
+    def close(self):
+        self._disconnect()
+
+class orderline(ui.emptyline):
+    """An order in the kitchen queue, for use in a scrollable
+    """
+    def __init__(self, order, show_destination=False):
+        super().__init__(ui.colour_line)
+        # The order itself won't be usable after the database
+        # session ends, so keep what we need to display it
+        self.orderid = order.id
+        self.header = "Order {}".format(order.number)
+        if order.tablenumber:
+            self.header += "  Table {}".format(order.tablenumber)
+        if show_destination:
+            self.header += "  ({})".format(order.destination)
+        self.items = order.items
+        self.time = order.time
+
+    def idealwidth(self):
+        return max(len(x) + 2 for x in [self.header] + self.items)
+
+    def display(self, width):
+        self.cursor = (0, 0)
+        age = "{} min".format(
+            int((datetime.datetime.now() - self.time).total_seconds() // 60))
+        header = self.header[:width - len(age) - 1]
+        l = [header + " " * (width - len(header) - len(age)) + age]
+        l += ["  " + x[:width - 2] for x in self.items]
+        return l
+
+class page(ui.basicpage):
+    """Orders waiting at some kitchen destinations
+
+    If destinations is None, orders for all destinations are shown.
+    Press Cash/Enter to mark the highlighted order as completed, and
+    Cancel to bring back the order completed most recently.
+    """
+    def __init__(self, destinations=None):
+        super().__init__()
+        self.win.set_cursor(False)
+        self.destinations = destinations
+        self.completed = []
+        prompt = ("Cash/Enter = order completed.  "
+                  "Cancel = bring back last completed order.")
+        promptheight = self.win.wrapstr(0, 0, self.w, prompt, display=False)
+        self.win.wrapstr(self.h - promptheight, 0, self.w, prompt)
+        self.dl = []
+        self.s = ui.scrollable(0, 0, self.w, self.h - promptheight - 1,
+                               self.dl)
+        self.s.focus()
+        self._listener = listener(self.changed)
+        self.reload()
+        # The queue doesn't need polling, but the ages of the orders
+        # on display do need updating
+        self._alarm_handle = tillconfig.mainloop.add_timeout(
+            60, self.alarm, desc="kitchen display clock")
+
+    def pagename(self):
+        if self.destinations:
+            return "Kitchen: " + ", ".join(self.destinations)
+        return "Kitchen"
+
+    def pagesummary(self):
+        return "{} orders".format(len(self.dl))
+
+    def reload(self):
+        q = td.s.query(KitchenOrder).\
+            filter(KitchenOrder.completed == None).\
+            order_by(KitchenOrder.time, KitchenOrder.id)
+        if self.destinations:
+            q = q.filter(KitchenOrder.destination.in_(self.destinations))
+        current = None
+        if self.s.cursor is not None and self.s.cursor < len(self.dl):
+            current = self.dl[self.s.cursor].orderid
+        show_destination = not self.destinations or len(self.destinations) > 1
+        self.dl[:] = [orderline(o, show_destination) for o in q.all()]
+        for i, l in enumerate(self.dl):
+            if l.orderid == current:
+                self.s.cursor = i
+        self.s.redraw()
+        self.updateheader()
+
+    def changed(self, destinations):
+        if destinations is None or not self.destinations \
+           or destinations.intersection(self.destinations):
+            self.reload()
+
+    def alarm(self):
+        self._alarm_handle = tillconfig.mainloop.add_timeout(
+            60, self.alarm, desc="kitchen display clock")
+        self.s.redraw()
+
+    def complete(self):
+        if self.s.cursor is None or self.s.cursor >= len(self.dl):
+            return
+        order = td.s.query(KitchenOrder).get(self.dl[self.s.cursor].orderid)
+        if order.completed is None:
+            order.completed = datetime.datetime.now()
+            self.completed.append(order.id)
+        td.s.flush()
+        self.reload()
+
+    def recall(self):
+        if not self.completed:
+            ui.beep()
+            return
+        order = td.s.query(KitchenOrder).get(self.completed.pop())
+        if order:
+            order.completed = None
+            td.s.flush()
+        self.reload()
+
+    def keypress(self, k):
+        if k == keyboard.K_CASH:
+            self.complete()
+        elif k == keyboard.K_CANCEL:
+            self.recall()
+        else:
+            ui.beep()
+
+    def dismiss(self):
+        self._listener.close()
+        self._alarm_handle.cancel()
+        super().dismiss()
@@ -2,18 +2,21 @@
 
 from . import ui, td, keyboard, printer, user, usestock
 from . import stock, delivery, department, stocklines, stocktype
+from . import forecast
 from .models import Department, FinishCode, StockLine, StockType, StockAnnotation
 from .models import StockItem, Delivery, StockOut, func, desc
-from .models import Supplier
-from sqlalchemy.orm import lazyload, joinedload, undefer, contains_eager
+from .models import Supplier, StockUnit
+from sqlalchemy.orm import joinedload, undefer, contains_eager
 from sqlalchemy.orm import joinedload_all
-from sqlalchemy.sql import not_
+from sqlalchemy.orm.util import identity_key
+from sqlalchemy.sql import not_, select, union_all, literal, cast
+from sqlalchemy import Integer
 from decimal import Decimal
 import datetime
+import time
 
 import logging
 log = logging.getLogger(__name__)
-from functools import reduce
 
 def finish_reason(item, reason):
     stockitem = td.s.merge(item)
@@ -70,10 +73,13 @@ def stockdetail(sinfo):
                 print_stocklist_menu, (sinfo, "Stock Check"), False)},
             colour=ui.colour_confirm)
 
-@user.permission_required('stock-check', 'List unfinished stock items')
-def stockcheck(dept=None):
-    # Build a list of all not-finished stock items.
-    log.info("Stock check")
+def stockcheck_items(dept=None, stocktype_id=None):
+    """Unfinished stock items from checked deliveries
+
+    Returns StockItem objects with their stocktype and remaining
+    amount loaded, optionally only those in a department or of a
+    stock type.
+    """
     sq = td.s.query(StockItem)\
              .join(StockItem.stocktype)\
              .join(Delivery)\
@@ -85,40 +91,72 @@ def stockcheck(dept=None):
              .order_by(StockItem.id)
     if dept:
         sq = sq.filter(StockType.dept_id == dept)
-    sinfo = sq.all()
-    # Split into groups by stocktype
-    st = {}
-    for s in sinfo:
-        st.setdefault(s.stocktype_id, []).append(s)
-    # Convert to a list of lists; each inner list contains items with
-    # the same stocktype
-    st = [x for x in list(st.values())]
-    # We might want to sort the list at this point... sorting by ascending
-    # amount remaining will put the things that are closest to running out
-    # near the start - handy!
-    remfunc = lambda a: reduce(lambda x, y: x + y, [x.remaining for x in a])
-    st.sort(key=remfunc)
-    # We want to show name, remaining, items in each line
-    # and when a line is selected we want to pop up the list of individual
-    # items.
+    if stocktype_id:
+        sq = sq.filter(StockItem.stocktype_id == stocktype_id)
+    return sq.all()
+
+def stockcheck_summary(dept=None):
+    """Unfinished stock from checked deliveries, by stock type
+
+    Returns a list of (StockType, remaining, items, oldest delivery
+    date, earliest best before date) tuples, with the stock types
+    closest to running out first.  All the adding up is done by the
+    database, so no stock items are loaded.
+    """
+    used = select([func.coalesce(func.sum(StockOut.qty), 0)])\
+        .where(StockOut.stockid == StockItem.id)\
+        .correlate(StockItem.__table__)\
+        .as_scalar()
+    remaining = func.sum(StockUnit.size - used)
+    sq = td.s.query(StockItem.stocktype_id.label('stocktype_id'),
+                    remaining.label('remaining'),
+                    func.count(StockItem.id).label('numitems'),
+                    func.min(Delivery.date).label('oldest'),
+                    func.min(StockItem.bestbefore).label('bestbefore'))\
+             .join(Delivery)\
+             .join(StockUnit)\
+             .filter(StockItem.finished == None)\
+             .filter(Delivery.checked == True)\
+             .group_by(StockItem.stocktype_id)
+    if dept:
+        sq = sq.join(StockType).filter(StockType.dept_id == dept)
+    sq = sq.subquery()
+    return td.s.query(StockType, sq.c.remaining, sq.c.numitems, sq.c.oldest,
+                      sq.c.bestbefore)\
+               .join(sq, sq.c.stocktype_id == StockType.id)\
+               .options(joinedload(StockType.unit))\
+               .order_by(sq.c.remaining, StockType.id)\
+               .all()
+
+def stockcheck_detail(stocktype_id, dept=None):
+    stockdetail(stockcheck_items(dept=dept, stocktype_id=stocktype_id))
+
+def stockcheck_print(dept, title):
+    print_stocklist_menu(stockcheck_items(dept=dept), title)
+
+@user.permission_required('stock-check', 'List unfinished stock items')
+def stockcheck(dept=None):
+    # Show one line per stock type, with the ones closest to running
+    # out near the start.  The individual items are only loaded when
+    # a line is selected.
+    log.info("Stock check")
     sl = []
-    f = ui.tableformatter(' l l l ')
-    for i in st:
-        name = i[0].stocktype.format(maxw=40)
-        remaining = reduce(lambda x, y : x + y, [x.remaining for x in i])
-        items = len(i)
-        unit = i[0].stocktype.unit.name
+    f = ui.tableformatter(' l l l l l ')
+    for st, remaining, items, oldest, bestbefore in stockcheck_summary(dept):
         sl.append(
-            (f(name,
-               "{:.0f} {}s".format(remaining, unit),
-               "({} item{})".format(items, ("s", "")[items == 1])),
-             stockdetail, (i,)))
+            (f(st.format(maxw=40),
+               "{:.0f} {}s".format(remaining, st.unit.name),
+               "({} item{})".format(items, ("s", "")[items == 1]),
+               "oldest {}".format(ui.formatdate(oldest)),
+               "best before {}".format(ui.formatdate(bestbefore))
+               if bestbefore else ""),
+             stockcheck_detail, (st.id, dept)))
     title = "Stock Check" if dept is None \
             else "Stock Check department {}".format(dept)
     ui.menu(sl, title=title, blurb="Select a stock type and press "
             "Cash/Enter for details on individual items.",
             dismiss_on_select=False, keymap={
-            keyboard.K_PRINT: (print_stocklist_menu, (sinfo, title), False)})
+            keyboard.K_PRINT: (stockcheck_print, (dept, title), False)})
 
 @user.permission_required('stock-history', 'List finished stock')
 def stockhistory(dept=None):
@@ -180,24 +218,12 @@ class stocklevelcheck(user.permission_checked, ui.dismisspopup):
         behind = datetime.timedelta(days=months_behind * 30.4)
         dept = self.deptfield.read()
         self.dismiss()
-        q = td.s.query(StockType, func.sum(StockOut.qty) / behind.days)\
-                .join(StockItem)\
-                .join(StockOut)\
-                .options(lazyload(StockType.department))\
-                .options(lazyload(StockType.unit))\
-                .options(undefer(StockType.instock))\
-                .filter(StockOut.removecode_id == 'sold')\
-                .filter((func.now() - StockOut.time) < behind)\
-                .having(func.sum(StockOut.qty) / behind.days > min_sale)\
-                .group_by(StockType)
-        if dept:
-            q = q.filter(StockType.dept_id == dept.id)
-        r = q.all()
+        r = forecast.buylist(td.s, ahead.days, behind.days, min_sale,
+                             dept=dept.id if dept else None)
         f = ui.tableformatter(' l r  r  r ')
         lines = [f(st.format(), '{:0.1f}'.format(sold), st.instock,
-                   '{:0.1f}'.format(sold * ahead.days - st.instock))
-                 for st, sold in r]
-        lines.sort(key=lambda l: float(l.fields[3]), reverse=True)
+                   '{:0.1f}'.format(buy))
+                 for st, sold, buy in r]
         header = [f('Name', 'Sold per day', 'In stock', 'Buy')]
         ui.listpopup(lines, header=header,
                      title="Stock to buy for next {} weeks".format(weeks_ahead),
@@ -219,69 +245,105 @@ def stock_purge_internal(source):
     because stock items may be put back on display through the voiding
     mechanism during the session, but is also available as an option
     on the stock management menu.
+
+    There may be thousands of items on sale, so this is done with a
+    few set-based statements rather than by loading every item: one
+    query finds the items to purge, one INSERT ... SELECT annotates
+    them and one UPDATE marks them as finished.  Returns the set of
+    ids of the finished stock items.
     """
-    # Find stock that is ready for purging: remaining==0.0 on a
-    # display stockline
-
-    # NB the contains_eager() is necessary in this query to avoid
-    # multiple joins to StockLine which would negate the effect of the
-    # filter on linetype.
-    log.debug("Finding display stockline items to purge...")
-    finished = td.s.query(StockItem)\
-               .join(StockItem.stockline)\
-               .options(contains_eager(StockItem.stockline))\
-               .options(joinedload('stocktype'))\
-               .filter(StockItem.finished == None)\
-               .filter(StockLine.linetype == "display")\
-               .filter(StockItem.remaining == Decimal("0.0"))\
-               .all()
+    start = time.perf_counter()
+    td.s.flush()
+    stocktable = StockItem.__table__
+    linetable = StockLine.__table__
+    used = select([func.coalesce(func.sum(StockOut.qty), 0)])\
+        .where(StockOut.stockid == StockItem.id)\
+        .correlate(stocktable)\
+        .as_scalar()
+    remaining = StockUnit.size - used
 
-    # Find more stock that is ready for purging: remaining <= 0.0 if mentioned by
-    # a continuous stockline
-    log.debug("Finding continuous stockline items to purge...")
-    cfinished = td.s.query(StockItem)\
-                .join(StockLine,
-                      StockItem.stocktype_id == StockLine.stocktype_id)\
-                .options(joinedload('stocktype'))\
-                .options(contains_eager('stocktype.stocklines'))\
-                .filter(StockItem.finished == None)\
-                .filter(StockLine.linetype == "continuous")\
-                .filter(StockItem.remaining <= Decimal("0.0"))\
-                .all()
-
-    finished = finished + cfinished
+    # Stock that is ready for purging: remaining==0.0 on a display
+    # stockline, or remaining<=0.0 if mentioned by a continuous
+    # stockline.  Both of these only look at unfinished stock, which
+    # the stock_stocklineid_key and stock_unfinished_stocktype_key
+    # indexes find quickly.
+    display = select([StockItem.id])\
+        .select_from(stocktable.join(linetable).join(StockUnit.__table__))\
+        .where(StockItem.finished == None)\
+        .where(StockLine.linetype == "display")\
+        .where(remaining == Decimal("0.0"))
+    continuous = select([StockItem.id])\
+        .select_from(stocktable.join(
+            linetable, StockItem.stocktype_id == StockLine.stocktype_id)
+                     .join(StockUnit.__table__))\
+        .where(StockItem.finished == None)\
+        .where(StockLine.linetype == "continuous")\
+        .where(remaining <= Decimal("0.0"))
+    ids = [r[0] for r in td.s.execute(display.union(continuous))]
+    found = time.perf_counter()
+    if not ids:
+        log.info("Stock purge (%s): nothing to purge, %.3fs",
+                 source, found - start)
+        return set()
 
-    # Mark all these stockitems as finished, removing them from being
-    # on sale as we go
+    # Annotate the items: directly connected to a stockline...
     user = ui.current_user()
-    user = user.dbuser if user and hasattr(user, 'dbuser') else None
-    for item in finished:
-        if item.stockline:
-            # Directly connected to a stockline
-            td.s.add(StockAnnotation(
-                stockitem=item, atype="stop", user=user,
-                text="{} (display stockline, {})".format(
-                    item.stockline.name, source)))
-        else:
-            # Indirectly connected via a continuous stockline
-            for sl in item.stocktype.stocklines:
-                td.s.add(StockAnnotation(
-                    stockitem=item, atype="stop", user=user,
-                    text="{} (continuous stockline, {})".format(
-                        sl.name, source)))
-        item.finished = datetime.datetime.now()
-        item.finishcode_id = 'empty' # guaranteed to exist
-        item.displayqty = None
-        item.stockline = None
-    td.s.flush()
+    user = cast(user.dbuser.id if user and hasattr(user, 'dbuser')
+                else None, Integer)
+    direct = select([
+        StockItem.id, literal("stop"), user,
+        StockLine.name + " (display stockline, {})".format(source)])\
+        .select_from(stocktable.join(linetable))\
+        .where(StockItem.id.in_(ids))
+    # ...or indirectly connected via a continuous stockline
+    indirect = select([
+        StockItem.id, literal("stop"), user,
+        StockLine.name + " (continuous stockline, {})".format(source)])\
+        .select_from(stocktable.join(
+            linetable, StockItem.stocktype_id == StockLine.stocktype_id))\
+        .where(StockItem.id.in_(ids))\
+        .where(StockItem.stocklineid == None)\
+        .where(StockLine.linetype == "continuous")
+    annotations = union_all(direct, indirect).alias('annotations')
+    td.s.execute(StockAnnotation.__table__.insert().from_select(
+        ['stockid', 'atype', 'user', 'text'], select([annotations])))
+
+    # Mark all these stockitems as finished, removing them from being
+    # on sale
+    r = td.s.execute(stocktable.update()
+                     .where(StockItem.id.in_(ids))
+                     .values(finished=datetime.datetime.now(),
+                             finishcode='empty', # guaranteed to exist
+                             displayqty=None,
+                             stocklineid=None)
+                     .returning(StockItem.id))
+    finished = {row[0] for row in r}
+    log.info("Stock purge (%s): %d items found in %.3fs, finished in %.3fs",
+             source, len(finished), found - start,
+             time.perf_counter() - found)
+
+    # Any of these items already loaded are now out of date, as are
+    # the lists of stock on sale on stocklines
+    for stockid in finished:
+        item = td.s.identity_map.get(identity_key(StockItem, stockid))
+        if item:
+            td.s.expire(item)
+    for obj in list(td.s.identity_map.values()):
+        if isinstance(obj, StockLine):
+            td.s.expire(obj, ['stockonsale'])
     return finished
 
 @user.permission_required(
     'purge-finished-stock',
     "Mark empty stock items on display stocklines as finished")
 def purge_finished_stock():
-    purged = stock_purge_internal(source="explicit purge")
-    if purged:
+    finished = stock_purge_internal(source="explicit purge")
+    if finished:
+        purged = td.s.query(StockItem)\
+                     .filter(StockItem.id.in_(finished))\
+                     .options(joinedload('stocktype'))\
+                     .order_by(StockItem.id)\
+                     .all()
         ui.infopopup(
             ["The following stock items were marked as finished:", ""] +
             ["{} {}".format(p.id, p.stocktype.format()) for p in purged],
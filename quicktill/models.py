@@ -1588,6 +1588,29 @@ StockType.lastsale = column_property(
     deferred=True,
     doc="Date of last sale")
 
+class StockUsage(Base):
+    """Stock used per day
+
+    A summary of the stockout table: the total quantity of each stock
+    type removed for each reason on each day.  It is brought up to
+    date at the end of every session; see quicktill.forecast.
+    """
+    __tablename__ = 'stockusage'
+    date = Column(Date, nullable=False, primary_key=True)
+    stocktype_id = Column('stocktype', Integer,
+                          ForeignKey('stocktypes.stocktype',
+                                     ondelete='CASCADE'),
+                          nullable=False, primary_key=True)
+    removecode_id = Column('removecode', String(8),
+                           ForeignKey('stockremove.removecode'),
+                           nullable=False, primary_key=True)
+    qty = Column(quantity, nullable=False)
+    stocktype = relationship(StockType)
+    removecode = relationship(RemoveCode)
+    def __repr__(self):
+        return "<StockUsage('%s',%s,'%s',%s)>" % (
+            self.date, self.stocktype_id, self.removecode_id, self.qty)
+
 class KeyboardBinding(Base):
     __tablename__ = 'keyboard'
     keycode = Column(String(20), nullable=False, primary_key=True)
@@ -1693,6 +1716,57 @@ CREATE OR REPLACE RULE log_stocktype AS ON UPDATE TO stock
 DROP RULE log_stocktype ON stock
 """)
 
+kitchen_order_seq = Sequence('kitchen_order_seq')
+
+class KitchenOrder(Base):
+    """Part of a food order sent to the kitchen
+
+    A food order is split between destinations (kitchen printers and
+    displays) according to the department or menu item; there is one
+    of these for each destination an order was sent to.  It stays in
+    the queue until it is marked as completed.
+    """
+    __tablename__ = 'kitchen_orders'
+    id = Column(Integer, kitchen_order_seq, nullable=False, primary_key=True)
+    number = Column(Integer, nullable=False, doc="Food order number")
+    destination = Column(String(), nullable=False)
+    time = Column(DateTime, nullable=False,
+                  server_default=func.current_timestamp())
+    transid = Column(Integer, ForeignKey('transactions.transid',
+                                         ondelete='SET NULL'),
+                     nullable=True)
+    tablenumber = Column(String(), nullable=True)
+    user_id = Column('user', Integer, ForeignKey('users.id'), nullable=True,
+                     doc="User who sent the order")
+    text = Column(Text, nullable=False, doc="Items ordered, one per line")
+    completed = Column(DateTime, nullable=True)
+    transaction = relationship(Transaction)
+    user = relationship(User)
+    @property
+    def items(self):
+        return self.text.splitlines()
+    def __repr__(self):
+        return "<KitchenOrder({}, {}, '{}')>".format(
+            self.id, self.number, self.destination)
+
+# Kitchen displays LISTEN on this channel to find out about changes
+# to the queue without polling the database.  The payload is the
+# destination.
+add_ddl(KitchenOrder.__table__, """
+CREATE OR REPLACE FUNCTION notify_kitchen_order() RETURNS trigger AS $$
+BEGIN
+  PERFORM pg_notify('kitchen_orders', NEW.destination);
+  RETURN NULL;
+END;
+$$ LANGUAGE plpgsql;
+CREATE TRIGGER kitchen_order_changed
+  AFTER INSERT OR UPDATE ON kitchen_orders
+  FOR EACH ROW EXECUTE PROCEDURE notify_kitchen_order();
+""", """
+DROP TRIGGER kitchen_order_changed ON kitchen_orders;
+DROP FUNCTION notify_kitchen_order();
+""")
+
 # Add indexes here
 Index('translines_transid_key', Transline.transid)
 Index('payments_transid_key', Payment.transid)
@@ -1702,8 +1776,31 @@ Index('stockout_stockid_key', StockOut.stockid)
 Index('stockout_translineid_key', StockOut.translineid)
 Index('translines_time_key', Transline.time)
 
+# The tillweb pages for users list their sales most recent first, a
+# page at a time, seeking on (time, id).
+Index('translines_user_time_key', Transline.user_id, Transline.time,
+      Transline.id)
+
+# Prefix searches on supplier names (from ui.modelfield and
+# ui.querymenu) compare lower(name) with a LIKE pattern, which can
+# use this index.
+Index('suppliers_name_lower_key',
+      func.lower(Supplier.name).label('name_lower'),
+      postgresql_ops={'name_lower': 'text_pattern_ops'})
+
+# The end of session stock purge looks for unfinished stock on
+# display stocklines and of the stock types on continuous stocklines.
+Index('stock_stocklineid_key', StockItem.stocklineid)
+Index('stock_unfinished_stocktype_key', StockItem.stocktype_id,
+      postgresql_where=StockItem.finished == None)
+
 # The "find free drinks on this day" function is speeded up
 # considerably by an index on stockout.time::date.
 Index('stockout_date_key', func.cast(StockOut.time, Date))
 
+# Kitchen displays only ever look at orders that haven't been
+# completed yet.
+Index('kitchen_orders_pending_key', KitchenOrder.destination,
+      postgresql_where=KitchenOrder.completed == None)
+
 foodorder_seq = Sequence('foodorder_seq', metadata=metadata)
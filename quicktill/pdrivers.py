@@ -1,19 +1,32 @@
 import socket
+import select
 import os
 import tempfile
 import io
 import textwrap
+import functools
 import subprocess
 import fcntl
 import array
 import sys
+import time
+import threading
+import collections
 import cups
 import glob
+import hashlib
+from . import ui, tillconfig
 try:
     import qrcode
     _qrcode_supported = True
 except ImportError:
     _qrcode_supported = False
+try:
+    import PIL.Image
+    import PIL.ImageOps
+    _image_supported = True
+except ImportError:
+    _image_supported = False
 
 import logging
 log = logging.getLogger(__name__)
@@ -36,6 +49,10 @@ def test_ping(host):
         return True
     return False
 
+# Receipts tend to contain the same lines over and over again, so
+# the results of wrapping them are cached.  These functions return
+# tuples because the results are shared.
+@functools.lru_cache(maxsize=1024)
 def _lrwrap(l, r, width):
     w = textwrap.wrap(l, width)
     if len(w) == 0:
@@ -43,13 +60,14 @@ def _lrwrap(l, r, width):
     if len(w[-1]) + len(r) >= width:
         w.append("")
     w[-1] = w[-1] + (' ' * (width - len(w[-1]) - len(r))) + r
-    return w
+    return tuple(w)
 
+@functools.lru_cache(maxsize=1024)
 def _wrap(l, width):
     w = textwrap.wrap(l, width)
     if len(w) == 0:
         w = [""]
-    return w
+    return tuple(w)
 
 class ReceiptElement:
     """The null receipt element
@@ -75,7 +93,7 @@ class TextElement(ReceiptElement):
             self.underline = underline
 
     def __str__(self):
-        return "\t".join(self.left, self.center, self.right)
+        return "\t".join((self.left, self.center, self.right))
 
 class QRCodeElement(ReceiptElement):
     def __init__(self, data):
@@ -198,7 +216,7 @@ class nullprinter(printer):
 
     def print_canvas(self, canvas):
         for i in canvas:
-            logger.info("%s: %s", self._name, str(i))
+            log.info("%s: %s", self._name, str(i))
 
     def __str__(self):
         return self.description or self._name
@@ -297,11 +315,28 @@ class linux_lpprinter(fileprinter):
 
 class netprinter(printer):
     """Print to a network socket.  connection is a (hostname, port) tuple.
+
+    If keepalive is True the connection is kept open between jobs,
+    with TCP keepalives enabled so that a dead connection is noticed,
+    and reopened when necessary.  Not all printers will print until
+    the connection is closed, so this is not the default.
+
+    The printer status returned by offline() is cached for status_ttl
+    seconds, and is refreshed in the background so that checking it
+    doesn't hold up the till.  Set status_ttl to None to check the
+    status every time.
     """
     def __init__(self, connection, driver, description=None,
-                 family=socket.AF_INET):
+                 family=socket.AF_INET, keepalive=False, status_ttl=30):
         self._connection = connection
         self._family = family
+        self._keepalive = keepalive
+        self._status_ttl = status_ttl
+        self._status = None
+        self._status_time = None
+        self._poller = None
+        self._conn = None
+        self._lock = threading.Lock()
         super().__init__(driver, description=description)
 
     def __str__(self):
@@ -314,38 +349,110 @@ class netprinter(printer):
         If the printer is unavailable for any reason, return a description
         of that reason; otherwise return None.
         """
+        if not self._status_ttl:
+            return self._check_status()
+        if not self._poller:
+            self._poller = threading.Thread(
+                target=self._poll, name="status of {}".format(self),
+                daemon=True)
+            self._poller.start()
+        if self._status_time is None \
+           or time.monotonic() - self._status_time > self._status_ttl:
+            self._update_status()
+        return self._status
+
+    def _check_status(self):
         host = self._connection[0]
         if not test_ping(host):
             return "Printer {} did not respond to ping".format(host)
 
+    def _update_status(self):
+        status = self._check_status()
+        self._status, self._status_time = status, time.monotonic()
+
+    def _poll(self):
+        # Refresh the status often enough that offline() never finds
+        # it out of date
+        while True:
+            time.sleep(self._status_ttl / 2)
+            self._update_status()
+
     def _connect(self):
         s = socket.socket(self._family)
+        if self._keepalive:
+            s.setsockopt(socket.SOL_SOCKET, socket.SO_KEEPALIVE, 1)
+            if hasattr(socket, "TCP_KEEPIDLE"):
+                s.setsockopt(socket.IPPROTO_TCP, socket.TCP_KEEPIDLE, 60)
+                s.setsockopt(socket.IPPROTO_TCP, socket.TCP_KEEPINTVL, 10)
+                s.setsockopt(socket.IPPROTO_TCP, socket.TCP_KEEPCNT, 3)
         s.connect(self._connection)
         f = s.makefile('wb')
         return s, f
 
-    # XXX there's too much copy-and-paste here for my liking
+    def _disconnect(self):
+        if self._conn:
+            s, f = self._conn
+            self._conn = None
+            try:
+                f.close()
+            except OSError:
+                pass
+            s.close()
+
+    def _connection_alive(self):
+        # Anything the printer sends us (eg. automatic status back)
+        # is discarded; an empty read means it has closed the
+        # connection
+        s, f = self._conn
+        try:
+            while select.select([s], [], [], 0)[0]:
+                if not s.recv(4096):
+                    return False
+        except OSError:
+            return False
+        return True
+
+    def _send(self, output):
+        # output is called with a file object to write to
+        if not self._keepalive:
+            s, f = self._connect()
+            try:
+                output(f)
+            finally:
+                f.close()
+                s.close()
+            return
+        buf = io.BytesIO()
+        output(buf)
+        data = buf.getvalue()
+        with self._lock:
+            if self._conn and not self._connection_alive():
+                self._disconnect()
+            reconnected = not self._conn
+            while True:
+                if not self._conn:
+                    self._conn = self._connect()
+                try:
+                    self._conn[1].write(data)
+                    self._conn[1].flush()
+                    return
+                except OSError:
+                    self._disconnect()
+                    if reconnected:
+                        raise
+                    reconnected = True
+
     def print_canvas(self, canvas):
         offline = self.offline()
         if offline:
             raise PrinterError(self, offline)
-        s, f = self._connect()
-        try:
-            self._driver.process_canvas(canvas, f)
-        finally:
-            f.close()
-            s.close()
+        self._send(lambda f: self._driver.process_canvas(canvas, f))
 
     def kickout(self):
         offline = self.offline()
         if offline:
             raise PrinterError(self, offline)
-        s, f = self._connect()
-        try:
-            self._driver.kickout(f)
-        finally:
-            f.close()
-            s.close()
+        self._send(self._driver.kickout)
 
 class tmpfileprinter(printer):
     """Print to a temporary file.
@@ -439,6 +546,173 @@ class cupsprinter(printer):
         connection.finishDocument(self._printername)
         f.close()
 
+# All spoolers that have been created, so that we can wait for them
+# to finish when the till exits
+_spoolers = []
+
+class spooler(printer):
+    """Print to another printer in the background.
+
+    Printing to a spooler returns as soon as the canvas has been
+    drawn; a thread sends it on to the printer, so a slow or jammed
+    printer doesn't hold up the till.  Canvases are printed in the
+    order they were queued.
+
+    If the printer reports that it is offline or printing fails, the
+    job is retried with increasing delays (up to max_delay seconds
+    between attempts) until it has been failing for retry_for
+    seconds, after which it is discarded.  Problems, recoveries and
+    discarded jobs are reported to the user using ui.toast().  While
+    a job is failing, offline() reports its problem; otherwise it
+    reports the status of the printer.
+
+    Opening the cash drawer is passed straight on to the printer.
+    """
+    def __init__(self, printer, retry_for=300, max_delay=30,
+                 description=None):
+        super().__init__(printer._driver, description=description)
+        self._printer = printer
+        self._retry_for = retry_for
+        self._max_delay = max_delay
+        self._problem = None
+        self._jobs = collections.deque()
+        self._cond = threading.Condition()
+        self._thread = None
+        _spoolers.append(self)
+
+    def __str__(self):
+        return self.description or str(self._printer)
+
+    def offline(self):
+        # While jobs are failing, report the problem they are having;
+        # once the queue is empty the printer's own status is current
+        with self._cond:
+            if self._jobs and self._problem:
+                return self._problem
+        return self._printer.offline()
+
+    def print_canvas(self, canvas):
+        with self._cond:
+            self._jobs.append(canvas)
+            self._cond.notify()
+            if not self._thread:
+                self._thread = threading.Thread(
+                    target=self._run, name="spooler for {}".format(self),
+                    daemon=True)
+                self._thread.start()
+
+    def kickout(self):
+        self._printer.kickout()
+
+    def pending(self):
+        """The number of jobs waiting to be printed
+        """
+        with self._cond:
+            return len(self._jobs)
+
+    def wait(self, timeout=None):
+        """Wait for all queued jobs to be printed or discarded
+
+        Returns True if the queue is empty.
+        """
+        with self._cond:
+            return self._cond.wait_for(lambda: not self._jobs, timeout)
+
+    def _notify(self, message):
+        # Called from the spooler thread
+        tillconfig.mainloop.call_from_thread(
+            lambda: ui.toast(message), desc="spooler")
+
+    def _run(self):
+        while True:
+            with self._cond:
+                self._cond.wait_for(lambda: self._jobs)
+                canvas = self._jobs[0]
+            self._print(canvas)
+            with self._cond:
+                self._jobs.popleft()
+                self._cond.notify_all()
+
+    def _print(self, canvas):
+        give_up_at = time.monotonic() + self._retry_for
+        delay = 1
+        while True:
+            try:
+                problem = self._printer.offline()
+                if problem:
+                    raise PrinterError(self._printer, problem)
+                self._printer.print_canvas(canvas)
+            except Exception as e:
+                problem = e.desc if isinstance(e, PrinterError) else str(e)
+                log.warning("%s: print failed: %s", self, problem)
+                if time.monotonic() + delay > give_up_at:
+                    # The next job starts afresh, and reports its own
+                    # problems if the printer still isn't working
+                    self._problem = None
+                    self._notify("{}: gave up trying to print: {}".format(
+                        self, problem))
+                    return
+                if self._problem is None:
+                    self._notify("{}: {}.  Will keep trying; {} jobs "
+                                 "waiting.".format(self, problem,
+                                                   self.pending()))
+                self._problem = problem
+                time.sleep(delay)
+                delay = min(delay * 2, self._max_delay)
+                continue
+            if self._problem is not None:
+                self._problem = None
+                self._notify("{} is working again.".format(self))
+            return
+
+def wait_for_spoolers(timeout):
+    """Wait for jobs queued on all spoolers to be printed
+
+    Waits for at most timeout seconds in total.  Returns the number
+    of jobs still waiting to be printed.
+    """
+    give_up_at = time.monotonic() + timeout
+    for s in _spoolers:
+        s.wait(max(0, give_up_at - time.monotonic()))
+    return sum(s.pending() for s in _spoolers)
+
+class _lrucache:
+    """A cache of the least recently used results of a function
+
+    Safe to use from several threads, because spoolers render
+    canvases in their own threads.
+    """
+    def __init__(self, maxsize):
+        self._maxsize = maxsize
+        self._d = collections.OrderedDict()
+        self._lock = threading.Lock()
+
+    def get(self, key, make):
+        """Return the value for key, calling make() if it is not cached
+        """
+        with self._lock:
+            if key in self._d:
+                self._d.move_to_end(key)
+                return self._d[key]
+        value = make()
+        with self._lock:
+            self._d[key] = value
+            if len(self._d) > self._maxsize:
+                self._d.popitem(last=False)
+        return value
+
+# Rendered QR codes and images, keyed by everything that affects the
+# output
+_bitmap_cache = _lrucache(64)
+
+def _image_key(image):
+    # Images may be supplied as filenames or as PIL images
+    if isinstance(image, str):
+        st = os.stat(image)
+        return ("file", image, st.st_mtime_ns, st.st_size)
+    return ("image", image.mode, image.size,
+            hashlib.sha1(image.tobytes()).digest())
+
 class escpos:
     """The ESC/POS protocol for controlling receipt printers.
     """
@@ -467,6 +741,9 @@ class escpos:
     default_colour = 0
     default_emph = 0
 
+    # "L", "M", "Q" or "H" for 7%, 15%, 25% or 30% recovery
+    qrcode_error_correction = "H"
+
     @staticmethod
     def _ep_2d_cmd(*params):
         """Assemble an ESC/POS 2d barcode command.
@@ -481,94 +758,98 @@ class escpos:
 
     def __init__(self, cpl, dpl, coding, has_cutter=False,
                  lines_before_cut=3, default_font=0,
-                 native_qrcode_support=False):
+                 native_qrcode_support=False, raster_image_support=False):
         self.fontcpl = cpl
         self.dpl = dpl
         self.coding = coding
         self.has_cutter = has_cutter
         self.lines_before_cut = lines_before_cut
         self.default_font = default_font
-        if native_qrcode_support:
-            self._qrcode = self._qrcode_native
-        else:
-            self._qrcode = self._qrcode_emulated
+        self.native_qrcode_support = native_qrcode_support
+        self.raster_image_support = raster_image_support
+        # Control sequences sent at the start and end of every canvas
+        self._start = escpos.ep_reset + escpos.ep_font[default_font]
+        self._finish = escpos.ep_ff
+        if has_cutter:
+            self._finish += b'\n' * lines_before_cut + escpos.ep_left \
+                + escpos.ep_fullcut
 
     def get_canvas(self):
         return ReceiptCanvas()
 
     def process_canvas(self, canvas, f):
+        f.write(self.render(canvas))
+        f.flush()
+
+    def render(self, canvas):
+        """Compile a canvas into the bytes to send to the printer
+        """
         colour = self.default_colour
         font = self.default_font
         emph = self.default_emph
         underline = self.default_underline
         cpl = self.fontcpl[font]
-        f.write(escpos.ep_reset)
-        f.write(escpos.ep_font[font])
+        out = [self._start]
         printed = False
 
         for i in canvas:
             printed = True
-            if hasattr(i, 'left') \
-               or hasattr(i, 'center') \
-               or hasattr(i, 'right'):
-                left = getattr(i, 'left', '')
-                center = getattr(i, 'center', '')
-                right = getattr(i, 'right', '')
+            if isinstance(i, TextElement):
                 new_colour = getattr(i, 'colour', self.default_colour)
                 if new_colour != colour:
                     colour = new_colour
-                    f.write(escpos.ep_colour[colour])
+                    out.append(escpos.ep_colour[colour])
                 new_font = getattr(i, 'font', self.default_font)
                 if new_font != font:
                     font = new_font
-                    f.write(escpos.ep_font[font])
+                    out.append(escpos.ep_font[font])
                     cpl = self.fontcpl[font]
                 new_emph = getattr(i, 'emph', self.default_emph)
                 if new_emph != emph:
                     emph = new_emph
-                    f.write(escpos.ep_emph[emph])
+                    out.append(escpos.ep_emph[emph])
                 new_underline = getattr(i, 'underline', self.default_underline)
                 if new_underline != underline:
                     underline = new_underline
-                    f.write(escpos.ep_underline[underline])
-
-                # Possible cases:
-                # Center is empty - can use lrwrap()
-                # Center is not empty, left and right are empty - can use wrap,
-                # and send the "centered text" control code
-                # Center is not empty, and left and right are not empty -
-                # can't use any wrap (XXX or: much fancier wrap than
-                # currently implemented!)
-                if not center:
-                    ll = _lrwrap(left, right, cpl)
-                    for i in ll:
-                        f.write(("%s\n" % i).encode(self.coding))
-                elif not left and not right:
-                    f.write(escpos.ep_center)
-                    ll = _wrap(center, cpl)
-                    for i in ll:
-                        f.write(("%s\n" % i).encode(self.coding))
-                    f.write(escpos.ep_left)
-                else:
-                    pad = max(cpl - len(left) - len(center) - len(right), 0)
-                    padl = pad // 2
-                    padr = pad - padl
-                    f.write(("%s%s%s%s%s\n" % (
-                        left, ' ' * padl, center, ' ' * padr, right)).
-                            encode(self.coding))
-            elif hasattr(i, 'qrcode_data'):
-                self._qrcode(i.qrcode_data, f)
+                    out.append(escpos.ep_underline[underline])
+                out.append(self._text(i.left, i.center, i.right, cpl,
+                                      self.coding))
+            elif isinstance(i, QRCodeElement):
+                out.append(self._qrcode(i.qrcode_data))
+            elif isinstance(i, ImageElement):
+                out.append(self._image(i.image_data))
             else:
-                f.write(b'\n')
+                out.append(b'\n')
 
         if printed:
-            f.write(escpos.ep_ff)
-            if self.has_cutter:
-                f.write(b'\n' * self.lines_before_cut + escpos.ep_left)
-                f.write(escpos.ep_fullcut)
-            f.flush()
+            out.append(self._finish)
+        return b''.join(out)
+
+    @staticmethod
+    @functools.lru_cache(maxsize=4096)
+    def _text(left, center, right, cpl, coding):
+        # Possible cases:
+        # Center is empty - can use lrwrap()
+        # Center is not empty, left and right are empty - can use wrap,
+        # and send the "centered text" control code
+        # Center is not empty, and left and right are not empty -
+        # can't use any wrap (XXX or: much fancier wrap than
+        # currently implemented!)
+        if not center:
+            return "".join(
+                "%s\n" % l for l in _lrwrap(left, right, cpl)).encode(coding)
+        elif not left and not right:
+            return escpos.ep_center + "".join(
+                "%s\n" % l for l in _wrap(center, cpl)).encode(coding) \
+                + escpos.ep_left
+        else:
+            pad = max(cpl - len(left) - len(center) - len(right), 0)
+            padl = pad // 2
+            padr = pad - padl
+            return ("%s%s%s%s%s\n" % (
+                left, ' ' * padl, center, ' ' * padr, right)).encode(coding)
 
-    def _qrcode_native(self, data, f):
+    def _qrcode_native(self, data):
         # Set the size of a "module", in dots.  The default is apparently
         # 3 (which is also the lowest).  The maximum is 16.
 
@@ -590,7 +871,7 @@ class escpos:
             if len(data) > 177: ms = 5
             if len(data) > 250: ms = 4
             if len(data) > 439: ms = 3
-            if len(data) > 742: return # Too big to print
+            if len(data) > 742: return b'' # Too big to print
         else: # 80mm paper width
             #if len(data) > 34: ms = 15
             #if len(data) > 44: ms = 14
@@ -605,33 +886,39 @@ class escpos:
             if len(data) > 338: ms = 5
             if len(data) > 511: ms = 4
             if len(data) > 790: ms = 3
-            if len(data) > 1273: return # Too big to print
-        f.write(self._ep_2d_cmd(49, 67, ms))
+            if len(data) > 1273: return b'' # Too big to print
+        out = [self._ep_2d_cmd(49, 67, ms)]
 
         # Set error correction:
         # 48 = L = 7% recovery
         # 49 = M = 15% recovery
         # 50 = Q = 25% recovery
         # 51 = H = 30% recovery
-        f.write(self._ep_2d_cmd(49, 69, 51))
+        out.append(self._ep_2d_cmd(
+            49, 69, 48 + "LMQH".index(self.qrcode_error_correction)))
 
         # Send QR code data
-        f.write(self._ep_2d_cmd(49, 80, 48, data))
+        out.append(self._ep_2d_cmd(49, 80, 48, data))
 
         # Print the QR code
-        f.write(escpos.ep_center)
-        f.write(self._ep_2d_cmd(49, 81, 48))
-        f.write(escpos.ep_left)
+        out.append(escpos.ep_center)
+        out.append(self._ep_2d_cmd(49, 81, 48))
+        out.append(escpos.ep_left)
+        return b''.join(out)
 
-    def _qrcode_emulated(self, data, f):
+    def _qrcode_emulated(self, data):
         if not _qrcode_supported:
-            f.write("qrcode library not installed".encode(self.coding))
-            return
-        q = qrcode.QRCode(border=2,
-                          error_correction=qrcode.constants.ERROR_CORRECT_H)
+            return "qrcode library not installed".encode(self.coding)
+        q = qrcode.QRCode(border=2, error_correction=getattr(
+            qrcode.constants,
+            "ERROR_CORRECT_" + self.qrcode_error_correction))
         q.add_data(data)
-        code = q.get_matrix()
-        f.write(escpos.ep_unidirectional_on)
+        return self._bitimage_emulated(q.get_matrix())
+
+    def _bitimage_emulated(self, code):
+        # code is a list of rows of booleans; each is printed as a
+        # block of 3x3 dots
+        out = [escpos.ep_unidirectional_on]
         # To get a good print, we print two rows at a time - but only
         # feed the paper through by one row.  This means that each
         # part of the code should be printed twice.  We're also
@@ -644,12 +931,11 @@ class escpos:
             (True, False): bytes([0xe0]),
             (True, True): bytes([0xfc]),
             }
-        while len(code) > 0:
-            if len(code) > 1:
-                row = zip(code[0], code[1])
+        for y in range(len(code)):
+            if y + 1 < len(code):
+                row = zip(code[y], code[y + 1])
             else:
-                row = zip(code[0], [False] * len(code[0]))
-            code = code[1:]
+                row = zip(code[y], [False] * len(code[y]))
             row = b''.join(lt[x] * 3 for x in row)
             width = len(row)
             if width > self.dpl:
@@ -660,11 +946,74 @@ class escpos:
             padchars = bytes([0]) * padding
             header = escpos.ep_bitimage_sd + \
                      bytes([width & 0xff, (width >> 8) & 0xff])
-            f.write(header + padchars + row + b'\r')
-            f.write(escpos.ep_half_dot_feed)
-            f.write(header + padchars + row + b'\r')
-            f.write(escpos.ep_short_feed)
-        f.write(escpos.ep_unidirectional_off)
+            out.append(header + padchars + row + b'\r')
+            out.append(escpos.ep_half_dot_feed)
+            out.append(header + padchars + row + b'\r')
+            out.append(escpos.ep_short_feed)
+        out.append(escpos.ep_unidirectional_off)
+        return b''.join(out)
+
+    def _qrcode(self, data):
+        native = self.native_qrcode_support
+        return _bitmap_cache.get(
+            ("qrcode", native, data, self.qrcode_error_correction, self.dpl),
+            lambda: self._qrcode_native(data) if native
+            else self._qrcode_emulated(data))
+
+    def _image(self, image):
+        if not _image_supported:
+            return "Pillow library not installed\n".encode(self.coding)
+        raster = self.raster_image_support
+        return _bitmap_cache.get(
+            ("image", raster, _image_key(image), self.dpl),
+            lambda: self._image_raster(image) if raster
+            else self._image_emulated(image))
+
+    @staticmethod
+    def _load_image(image):
+        # Returns a greyscale version of the image on a white
+        # background
+        if isinstance(image, str):
+            image = PIL.Image.open(image)
+        if image.mode in ("RGBA", "LA", "P"):
+            background = PIL.Image.new("RGBA", image.size, "white")
+            background.alpha_composite(image.convert("RGBA"))
+            image = background
+        return image.convert("L")
+
+    def _image_raster(self, image):
+        # Print one dot per pixel using the "print raster bit image"
+        # command, scaling the image down if it is too wide
+        im = self._load_image(image)
+        if im.width > self.dpl:
+            im = im.resize(
+                (self.dpl, max(1, im.height * self.dpl // im.width)))
+        # In mode "1" a set bit is white; the printer wants set bits
+        # to be black.  Each row is padded to a whole number of bytes.
+        im = PIL.ImageOps.invert(im).convert("1")
+        data = im.tobytes()
+        rowbytes = (im.width + 7) // 8
+        out = [escpos.ep_center]
+        # Send the image in bands to stay within the printer's limits
+        for y in range(0, im.height, 256):
+            h = min(256, im.height - y)
+            out.append(bytes([29, ord('v'), ord('0'), 0,
+                              rowbytes & 0xff, rowbytes >> 8,
+                              h & 0xff, h >> 8]))
+            out.append(data[y * rowbytes:(y + h) * rowbytes])
+        out.append(escpos.ep_left)
+        return b''.join(out)
+
+    def _image_emulated(self, image):
+        # Each pixel is printed as a block of 3x3 dots, so the image
+        # is scaled down by a factor of three
+        im = self._load_image(image)
+        w = min(self.dpl // 3, max(1, (im.width + 2) // 3))
+        h = max(1, im.height * w // im.width)
+        im = im.resize((w, h)).convert("1")
+        px = im.load()
+        return self._bitimage_emulated(
+            [[px[x, y] == 0 for x in range(w)] for y in range(h)])
 
     def kickout(self, f):
         f.write(escpos.ep_pulse)
@@ -701,7 +1050,8 @@ class Epson_TM_T20_driver(escpos):
             raise Exception("Unknown paper width {}".format(paperwidth))
         escpos.__init__(self, cpl, dpl, coding, has_cutter=True,
                         lines_before_cut=0, default_font=0,
-                        native_qrcode_support=True)
+                        native_qrcode_support=True,
+                        raster_image_support=True)
 
 from reportlab.pdfgen import canvas
 from reportlab.lib.units import toLength
@@ -1,10 +1,17 @@
 from . import td, ui, tillconfig, payment
 from decimal import Decimal
-from .models import Delivery,VatBand,Business,Transline,Transaction
+from .models import Delivery,Business,Transline,Transaction
+from .models import StockItem
 from .models import zero,penny
 from . import pdrivers
+from . import printtemplate
+from . import report
+from sqlalchemy.orm import joinedload, contains_eager
+from reportlab.pdfbase.pdfmetrics import stringWidth
 
 import datetime
+import functools
+from types import SimpleNamespace
 now = datetime.datetime.now
 
 # XXX should be in tillconfig?
@@ -15,111 +22,105 @@ labelprinters = []
 # This should be the case if called during a keypress!  If being used
 # in any other context, use with td.orm_session(): around the call.
 
+def _vat_info(date):
+    """VAT rates and business details for each VAT band at a date
+
+    Returns a dict with VAT band as key and (rate, business) as
+    value, where business has name, address (a list of lines) and
+    vatno attributes.  The same businesses are used for every band
+    they appear in.
+
+    This is not cached, because the rates and business details may
+    be changed at any time and receipts must show the current ones;
+    the bands, rates and businesses are loaded in three queries.
+    """
+    vatrates = report.VatRates(td.s)
+    rates = {band: vatrates.at(band, date) for band in vatrates.bands}
+    businesses = {}
+    for business in td.s.query(Business).filter(
+            Business.id.in_({vr.businessid for vr in rates.values()})):
+        # The business address may be stored in the database with
+        # either the string "\n" (legacy) or a newline character
+        # (current) to separate the lines.
+        if "\\n" in business.address:
+            addrlines = business.address.split("\\n")
+        else:
+            addrlines = business.address.splitlines()
+        businesses[business.id] = SimpleNamespace(
+            id=business.id, name=business.name, address=addrlines,
+            vatno=business.vatno)
+    return {band: (vr.rate, businesses[vr.businessid])
+            for band, vr in rates.items()}
+
 def print_receipt(transid):
-    trans = td.s.query(Transaction).get(transid)
+    trans = td.s.query(Transaction)\
+                .options(joinedload('lines').joinedload('department'))\
+                .options(joinedload('payments'))\
+                .options(joinedload('session'))\
+                .get(transid)
     if trans is None:
         return
     if not trans.lines:
         return
+    bandtotals = {}
+    for tl in trans.lines:
+        bandtotals[tl.department.vatband] = bandtotals.get(
+            tl.department.vatband, Decimal("0.00")) + tl.total
+    lines = [SimpleNamespace(description=tl.description,
+                             regtotal=tl.regtotal(tillconfig.currency),
+                             band=tl.department.vatband)
+             for tl in trans.lines]
+    businesses = []
+    if trans.closed:
+        # We have a list of VAT bands; we need to look up rate and
+        # business information for each of them.  Once we have the
+        # list of businesses, we can print out a section per
+        # business.  In each section, show the business name and
+        # address, VAT number, and then for each VAT band the net
+        # amount, VAT and total.
+        vat = _vat_info(trans.session.date)
+        sections = {}
+        for band, gross in bandtotals.items():
+            rate, business = vat[band]
+            if business.id not in sections:
+                sections[business.id] = SimpleNamespace(
+                    bands=[], **vars(business))
+                businesses.append(sections[business.id])
+            net = (gross / ((rate / Decimal("100.0")) + Decimal("1.0")))\
+                  .quantize(penny)
+            sections[business.id].bands.append(SimpleNamespace(
+                band=band, net=tillconfig.fc(net),
+                vat=tillconfig.fc(gross - net), rate=rate,
+                gross=tillconfig.fc(gross)))
     with driver as d:
-        d.printline("\t{}".format(tillconfig.pubname), emph=1)
-        for i in tillconfig.pubaddr:
-            d.printline("\t{}".format(i), colour=1)
-        d.printline("\tTel. {}".format(tillconfig.pubnumber))
-        d.printline()
-        bandtotals = {}
-        for tl in trans.lines:
-            bandtotals[tl.department.vatband] = bandtotals.get(
-                tl.department.vatband, Decimal("0.00")) + tl.total
-        for tl in trans.lines:
-            left = tl.description
-            right = tl.regtotal(tillconfig.currency)
-            if len(bandtotals) > 1 and trans.closed:
-                d.printline(
-                    "{}\t\t{} {}".format(left, right, tl.department.vatband),
-                    font=1)
-            else:
-                d.printline("{}\t\t{}".format(left, right), font=1)
-        totalpad = "  " if len(bandtotals) > 1 else ""
-        d.printline("\t\tSubtotal {}{}".format(tillconfig.fc(trans.total), totalpad),
-                    colour=1, emph=1)
-        for p in trans.payments:
-            pl = payment.pline(p)
-            d.printline("\t\t{}{}".format(pl.text, totalpad))
-        d.printline("")
-        if not trans.closed:
-            d.printline("\tThis is not a VAT receipt", colour=1, emph=1)
-            d.printline("\tTransaction number {}".format(trans.id))
-        else:
-            # We have a list of VAT bands; we need to look up rate and
-            # business information for each of them.  Once we have the
-            # list of businesses, we can print out a section per
-            # business.  In each section, show the business name and
-            # address, VAT number, and then for each VAT band the net
-            # amount, VAT and total.
-            businesses = {} # Keys are business IDs, values are (band,rate) tuples
-            for i in list(bandtotals.keys()):
-                vr = td.s.query(VatBand).get(i).at(trans.session.date)
-                businesses.setdefault(vr.business.id, []).append((i, vr.rate))
-            for i in list(businesses.keys()):
-                business = td.s.query(Business).get(i)
-                bands = businesses[i]
-                # Print the business info
-                d.printline("\t{}".format(business.name))
-                # The business address may be stored in the database
-                # with either the string "\n" (legacy) or a newline
-                # character (current) to separate the lines.
-                if "\\n" in business.address:
-                    addrlines = business.address.split("\\n")
-                else:
-                    addrlines = business.address.splitlines()
-                for l in addrlines:
-                    d.printline("\t{}".format(l))
-                d.printline()
-                d.printline("VAT reg no. {}".format(business.vatno))
-                for band, rate in bands:
-                    # Print the band, amount ex VAT, amount inc VAT, gross
-                    gross = bandtotals[band]
-                    net = (gross / ((rate / Decimal("100.0")) + Decimal("1.0")))\
-                          .quantize(penny)
-                    vat = gross - net
-                    d.printline("{}: {} net, {} VAT @ {:0.1f}%\t\tTotal {}".format(
-                            band, tillconfig.fc(net), tillconfig.fc(vat), rate,
-                            tillconfig.fc(gross)), font=1)
-                d.printline("")
-            d.printline("\tReceipt number {}".format(trans.id))
-        d.printline("\t{}".format(ui.formatdate(trans.session.date)))
+        printtemplate.render(
+            d, 'receipt', trans=trans, lines=lines,
+            show_bands=len(bandtotals) > 1 and trans.closed,
+            total=tillconfig.fc(trans.total),
+            totalpad="  " if len(bandtotals) > 1 else "",
+            payments=[payment.pline(p).text for p in trans.payments],
+            closed=trans.closed, businesses=businesses,
+            date=ui.formatdate(trans.session.date))
 
 def print_sessioncountup(s):
+    counts = []
+    # Go through the current payment methods printing out their
+    # input fields, with countup totals if necessary
+    for pm in tillconfig.all_payment_methods:
+        for name, validator, print_fields in pm.total_fields:
+            counts.append(SimpleNamespace(
+                print_fields=print_fields or [],
+                title="{} {}".format(pm.description, name)
+                if len(pm.total_fields) > 1 else pm.description))
     with driver as d:
-        d.printline("\t%s"%tillconfig.pubname,emph=1)
-        d.printline("\tSession %d"%s.id,colour=1)
-        d.printline("\t%s"%ui.formatdate(s.date),colour=1)
-        d.printline("Started %s"%ui.formattime(s.starttime))
-        d.printline("  Ended %s"%ui.formattime(s.endtime))
-        d.printline()
-        d.printline("Amounts registered:")
-        for paytype,total in s.payment_totals:
-            d.printline("%s: %s"%(paytype.description,tillconfig.fc(total)))
-        d.printline()
-        # Now go through the current payment methods printing out their
-        # input fields, with countup totals if necessary
-        d.printline("",underline=1)
-        for pm in tillconfig.all_payment_methods:
-            for name,validator,print_fields in pm.total_fields:
-                for i in print_fields if print_fields else []:
-                    d.printline("{:>10}".format(i))
-                    d.printline()
-                if print_fields: d.printline("",underline=1)
-                if len(pm.total_fields)>1:
-                    d.printline("{} {}".format(pm.description,name),
-                                     colour=1,emph=1)
-                else:
-                    d.printline(pm.description,colour=1,emph=1)
-                d.printline()
-                d.printline("",underline=1)
-        d.printline("Enter totals into till using")
-        d.printline("management menu option 1,3.")
+        printtemplate.render(
+            d, 'sessioncountup', session=s, date=ui.formatdate(s.date),
+            started=ui.formattime(s.starttime),
+            ended=ui.formattime(s.endtime),
+            payments=[SimpleNamespace(description=paytype.description,
+                                      total=tillconfig.fc(total))
+                      for paytype, total in s.payment_totals],
+            counts=counts)
 
 def print_sessiontotals(s):
     """Print a session totals report given a Session object.
@@ -143,54 +144,73 @@ def print_sessiontotals(s):
         if pt not in pts:
             pms.append(payment.methods[pt])
 
-    with driver as d:
-        d.printline("\t%s"%tillconfig.pubname,emph=1)
-        d.printline("\tSession %d"%s.id,colour=1)
-        d.printline("\t%s"%ui.formatdate(s.date),colour=1)
-        d.printline("Started %s"%ui.formattime(s.starttime))
-        if s.endtime is None:
-            d.printline("Session still in progress")
-            d.printline("Printed %s"%ui.formattime(now()))
+    payments = []
+    ttt = Decimal("0.00")
+    att = Decimal("0.00")
+    for pm in pms:
+        pt = pm.paytype
+        if pt in till_totals:
+            tt = tillconfig.fc(till_totals[pt])
+            ttt = ttt + till_totals[pt]
         else:
-            d.printline("  Ended %s"%ui.formattime(s.endtime))
-        d.printline("Till total:\t\tActual total:")
-        ttt = Decimal("0.00")
-        att = Decimal("0.00")
-        for pm in pms:
-            desc = pm.description
-            pt = pm.paytype
-            if pt in till_totals:
-                tt = tillconfig.fc(till_totals[pt])
-                ttt = ttt + till_totals[pt]
-            else:
-                tt = ""
-            if pt in actual_totals:
-                at = tillconfig.fc(actual_totals[pt])
-                att = att + actual_totals[pt]
-            else:
-                at = ""
-            if tt or at:
-                d.printline("%s: %s\t\t%s" % (desc, tt, at))
-        if len(pms) > 1:
-            tt = tillconfig.fc(ttt)
-            if att > Decimal("0.00"):
-                at = tillconfig.fc(att)
-            else:
-                at = ""
-            d.printline("Total: %s\t\t%s" % (tt, at), colour=1, emph=1)
-        d.printline()
-        dt = Decimal("0.00")
-        for dept, total in depts:
-            d.printline("%2d %s\t\t%s" % (dept.id, dept.description,
-                                          tillconfig.fc(total)))
-            dt = dt + total
-        d.printline("\t\tTotal: %s" % tillconfig.fc(dt), colour=1, emph=1)
-        d.printline()
-        d.printline("\tPrinted %s" % ui.formattime(now()))
+            tt = ""
+        if pt in actual_totals:
+            at = tillconfig.fc(actual_totals[pt])
+            att = att + actual_totals[pt]
+        else:
+            at = ""
+        if tt or at:
+            payments.append(SimpleNamespace(
+                description=pm.description, till=tt, actual=at))
+    departments = []
+    dt = Decimal("0.00")
+    for dept, total in depts:
+        departments.append(SimpleNamespace(
+            id=dept.id, description=dept.description,
+            total=tillconfig.fc(total)))
+        dt = dt + total
+
+    with driver as d:
+        printtemplate.render(
+            d, 'sessiontotals', session=s, date=ui.formatdate(s.date),
+            started=ui.formattime(s.starttime),
+            ended=ui.formattime(s.endtime), printed=ui.formattime(now()),
+            payments=payments, show_total=len(pms) > 1,
+            till_total=tillconfig.fc(ttt),
+            actual_total=tillconfig.fc(att) if att > Decimal("0.00") else "",
+            departments=departments, department_total=tillconfig.fc(dt))
+
+def _label_query():
+    # Everything drawn on a stock label, loaded with the item
+    return td.s.query(StockItem)\
+               .options(joinedload('stocktype'))\
+               .options(joinedload('stockunit'))
 
 def label_print_delivery(p,delivery):
-    d=td.s.query(Delivery).get(delivery)
-    stocklabel_print(p,d.items)
+    stocklabel_print(
+        p, _label_query()\
+        .filter(StockItem.deliveryid == delivery)\
+        .options(joinedload('delivery').joinedload('supplier'))\
+        .order_by(StockItem.id))
+
+def label_print_delivery_range(p, start, end):
+    """Print stock labels for all the deliveries dated between start
+    and end inclusive as a single job.
+
+    """
+    stocklabel_print(
+        p, _label_query()\
+        .join(Delivery)\
+        .filter(Delivery.date >= start)\
+        .filter(Delivery.date <= end)\
+        .options(contains_eager('delivery').joinedload('supplier'))\
+        .order_by(Delivery.date, Delivery.id, StockItem.id))
+
+# Stock labels use the same few strings, fonts and sizes over and
+# over again
+@functools.lru_cache(maxsize=4096)
+def _string_width(s, fontname, fontsize):
+    return stringWidth(s, fontname, fontsize)
 
 def stock_label(f,d):
     """Draw a stock label (d) on a PDF canvas (f).
@@ -203,7 +223,7 @@ def stock_label(f,d):
     fontname="Times-Roman"
     f.setFont(fontname,fontsize)
     def fits(s):
-        sw=f.stringWidth(s,fontname,fontsize)
+        sw=_string_width(s,fontname,fontsize)
         return sw<(width-(2*margin))
     y=height-margin-fontsize
     f.drawCentredString(width/2,y,d.stocktype.format(fits))
@@ -221,11 +241,17 @@ def stock_label(f,d):
     f.showPage()
 
 def stocklabel_print(p,sl):
-    """Print stock labels for a list of stock numbers to the specified
+    """Print stock labels for a list of stock items to the specified
     printer.
 
+    sl may also be a query returning stock items, in which case the
+    items are fetched from the database in batches as the labels are
+    drawn rather than all being loaded at once.
     """
-    td.s.add_all(sl)
+    if hasattr(sl, 'yield_per'):
+        sl = sl.yield_per(100)
+    else:
+        td.s.add_all(sl)
     with p as d:
         for sd in sl:
             stock_label(d,sd)
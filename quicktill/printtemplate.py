@@ -0,0 +1,354 @@
+"""Templates for printed receipts and reports
+
+A template is a list of elements describing what to print.  The text
+in each element is formatted using str.format() with the values
+passed when the template is printed, so fields can use attribute
+access and format specifications, eg. "{trans.id}" or
+"{band.rate:0.1f}".  As for printline(), tabs separate the left,
+centre and right parts of a line.
+
+The elements are:
+
+line(text, colour=None, font=None, emph=None, underline=None)
+  A line of text.
+
+blank()
+  A blank line.
+
+qrcode(name)
+  A QR code containing the value called name.
+
+each(name, template, var="item")
+  The template printed once for each item in the value called name,
+  with the item available as var.
+
+when(name, template, otherwise=[])
+  The template printed if the value called name is true, otherwise
+  the "otherwise" template.
+
+Names in each() and when() may use attribute access, eg.
+"business.address".
+
+Templates are compiled once into a list of functions.  As well as
+the values passed when printing, templates can use "pubname",
+"pubaddr" and "pubnumber" from the till configuration; anything that
+only depends on these is formatted when the template is compiled
+rather than every time it is printed.
+
+Till configurations can replace the default templates by supplying
+a dict of templates using the 'print_templates' key.
+"""
+
+import string
+from collections import ChainMap
+from . import tillconfig
+from .pdrivers import TextElement
+
+import logging
+log = logging.getLogger(__name__)
+
+_formatter = string.Formatter()
+
+def _lookup(values, name):
+    parts = name.split('.')
+    v = values[parts[0]]
+    for p in parts[1:]:
+        v = getattr(v, p)
+    return v
+
+def _fieldnames(text):
+    # The names of the values used in format string text
+    names = set()
+    for literal, field, spec, conversion in _formatter.parse(text):
+        if field is not None:
+            names.add(field.split('.')[0].split('[')[0])
+        if spec:
+            names |= _fieldnames(spec)
+    return names
+
+class line:
+    """A line of text
+    """
+    def __init__(self, text="", colour=None, font=None, emph=None,
+                 underline=None):
+        self.text = text
+        self.style = {'colour': colour, 'font': font, 'emph': emph,
+                      'underline': underline}
+
+    def compile(self, constants):
+        text = self.text
+        style = self.style
+        if _fieldnames(text) <= constants.keys():
+            # The line can be formatted now, and the same element
+            # added to every canvas
+            s = text.format_map(constants).split("\t")
+            element = [TextElement(*s[:3], **style)]
+            return [lambda canvas, values: canvas.add_story(element)]
+        return [lambda canvas, values: canvas.printline(
+            text.format_map(values), **style)]
+
+def blank():
+    """A blank line
+    """
+    return line()
+
+class qrcode:
+    """A QR code
+    """
+    def __init__(self, name):
+        self.name = name
+
+    def compile(self, constants):
+        name = self.name
+        return [lambda canvas, values: canvas.printqrcode(
+            _lookup(values, name))]
+
+class each:
+    """A template repeated for each item in a list
+    """
+    def __init__(self, name, template, var="item"):
+        self.name = name
+        self.template = template
+        self.var = var
+
+    def compile(self, constants):
+        name = self.name
+        var = self.var
+        if name in constants:
+            # The list is fixed, so the loop can be unrolled
+            ops = []
+            for item in constants[name]:
+                ops += _compile(self.template,
+                                ChainMap({var: item}, constants))
+            return ops
+        plan = _compile(self.template, {
+            k: v for k, v in constants.items() if k != var})
+        def op(canvas, values):
+            for item in _lookup(values, name):
+                inner = ChainMap({var: item}, values)
+                for f in plan:
+                    f(canvas, inner)
+        return [op]
+
+class when:
+    """A template printed only if a value is true
+    """
+    def __init__(self, name, template, otherwise=[]):
+        self.name = name
+        self.template = template
+        self.otherwise = otherwise
+
+    def compile(self, constants):
+        name = self.name
+        if name in constants:
+            return _compile(self.template if constants[name]
+                            else self.otherwise, constants)
+        plan = _compile(self.template, constants)
+        otherwise = _compile(self.otherwise, constants)
+        def op(canvas, values):
+            for f in plan if _lookup(values, name) else otherwise:
+                f(canvas, values)
+        return [op]
+
+def _compile(template, constants):
+    ops = []
+    for element in template:
+        ops += element.compile(constants)
+    return ops
+
+class compiled_template:
+    """A template ready to be printed
+    """
+    def __init__(self, template, constants):
+        self._constants = constants
+        self._ops = _compile(template, constants)
+
+    def render(self, canvas, **values):
+        """Add the template to a receipt canvas
+        """
+        values = ChainMap(values, self._constants)
+        for op in self._ops:
+            op(canvas, values)
+
+def _constants():
+    return {
+        'pubname': tillconfig.pubname,
+        'pubaddr': tillconfig.pubaddr,
+        'pubnumber': tillconfig.pubnumber,
+    }
+
+_compiled = {}
+
+def get(name):
+    """The compiled version of a template
+    """
+    c = _compiled.get(name)
+    if not c:
+        c = compiled_template(templates[name], _constants())
+        _compiled[name] = c
+    return c
+
+def compile_all():
+    """Compile all the templates
+
+    Called at startup so that mistakes in templates are found early.
+    """
+    _compiled.clear()
+    for name in templates:
+        get(name)
+
+def render(canvas, name, **values):
+    """Add a template to a receipt canvas
+    """
+    get(name).render(canvas, **values)
+
+_header = [
+    line("\t{pubname}", emph=1),
+    each("pubaddr", [line("\t{item}", colour=1)]),
+    line("\tTel. {pubnumber}"),
+    blank(),
+]
+
+templates = {
+    # Values: trans, lines (description, regtotal, band), show_bands,
+    # total, totalpad, payments, closed, businesses (name, address,
+    # vatno, bands (band, net, vat, rate, gross)), date
+    'receipt': _header + [
+        each("lines", [
+            when("show_bands", [
+                line("{item.description}\t\t{item.regtotal} {item.band}",
+                     font=1),
+            ], otherwise=[
+                line("{item.description}\t\t{item.regtotal}", font=1),
+            ]),
+        ]),
+        line("\t\tSubtotal {total}{totalpad}", colour=1, emph=1),
+        each("payments", [line("\t\t{item}{totalpad}")]),
+        blank(),
+        when("closed", [
+            each("businesses", var="business", template=[
+                line("\t{business.name}"),
+                each("business.address", [line("\t{item}")]),
+                blank(),
+                line("VAT reg no. {business.vatno}"),
+                each("business.bands", var="band", template=[
+                    line("{band.band}: {band.net} net, {band.vat} VAT @ "
+                         "{band.rate:0.1f}%\t\tTotal {band.gross}", font=1),
+                ]),
+                blank(),
+            ]),
+            line("\tReceipt number {trans.id}"),
+        ], otherwise=[
+            line("\tThis is not a VAT receipt", colour=1, emph=1),
+            line("\tTransaction number {trans.id}"),
+        ]),
+        line("\t{date}"),
+    ],
+
+    # Values: session, date, started, ended, payments (description,
+    # total), counts (print_fields, title)
+    'sessioncountup': [
+        line("\t{pubname}", emph=1),
+        line("\tSession {session.id}", colour=1),
+        line("\t{date}", colour=1),
+        line("Started {started}"),
+        line("  Ended {ended}"),
+        blank(),
+        line("Amounts registered:"),
+        each("payments", [line("{item.description}: {item.total}")]),
+        blank(),
+        line("", underline=1),
+        each("counts", var="count", template=[
+            each("count.print_fields", [line("{item:>10}"), blank()]),
+            when("count.print_fields", [line("", underline=1)]),
+            line("{count.title}", colour=1, emph=1),
+            blank(),
+            line("", underline=1),
+        ]),
+        line("Enter totals into till using"),
+        line("management menu option 1,3."),
+    ],
+
+    # Values: session, date, started, ended, printed, payments
+    # (description, till, actual), show_total, till_total,
+    # actual_total, departments (id, description, total),
+    # department_total
+    'sessiontotals': [
+        line("\t{pubname}", emph=1),
+        line("\tSession {session.id}", colour=1),
+        line("\t{date}", colour=1),
+        line("Started {started}"),
+        when("ended", [
+            line("  Ended {ended}"),
+        ], otherwise=[
+            line("Session still in progress"),
+            line("Printed {printed}"),
+        ]),
+        line("Till total:\t\tActual total:"),
+        each("payments", [line("{item.description}: {item.till}\t\t"
+                               "{item.actual}")]),
+        when("show_total", [
+            line("Total: {till_total}\t\t{actual_total}", colour=1, emph=1),
+        ]),
+        blank(),
+        each("departments", [
+            line("{item.id:2d} {item.description}\t\t{item.total}"),
+        ]),
+        line("\t\tTotal: {department_total}", colour=1, emph=1),
+        blank(),
+        line("\tPrinted {printed}"),
+    ],
+
+    # Values: verbose, tablenumber, has_table, transid, has_transid,
+    # user, number, time, items (ltext, rtext), print_total, total,
+    # footer
+    'foodorder': [
+        when("verbose", _header),
+        when("has_table", [
+            line("\tTable number {tablenumber}", colour=1, emph=1),
+            blank(),
+        ]),
+        when("has_transid", [
+            line("\tTransaction {transid}"),
+            blank(),
+        ]),
+        when("user", [
+            line("\t{user}"),
+            blank(),
+        ]),
+        line("\tFood order {number}", colour=1, emph=1),
+        blank(),
+        line("\t{time}"),
+        blank(),
+        each("items", [line("{item.ltext}\t\t{item.rtext}")]),
+        when("print_total", [line("\t\tTotal {total}", emph=1)]),
+        blank(),
+        line("\tFood order {number}", colour=1, emph=1),
+        when("has_table", [
+            blank(),
+            line("\tTable number {tablenumber}", colour=1, emph=1),
+        ]),
+        when("verbose", [
+            blank(),
+            line("\t{footer}"),
+        ], otherwise=[
+            blank(),
+            blank(),
+        ]),
+    ],
+
+    # Values: method, description, amount, to_pay, currency, data,
+    # address
+    'qrcode_payment': [
+        line("\t{pubname}", emph=1),
+        line("\t{method} payment"),
+        line("\t{description}"),
+        line("\t{amount}"),
+        line("\t{to_pay} {currency} to pay"),
+        qrcode("data"),
+        blank(),
+        line("\t{address}"),
+        blank(),
+        blank(),
+    ],
+}
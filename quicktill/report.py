@@ -0,0 +1,167 @@
+"""Session totals for many sessions at once
+
+Working out the totals for a session using the properties of the
+Session model takes several queries, and more for each VAT band.
+This module fetches the department, VAT band and payment totals for
+any number of sessions in a single grouped query, and works out the
+VAT for each band in Python using VAT rates that are loaded once.
+"""
+
+from sqlalchemy.sql import select, union_all, func, null
+from sqlalchemy.sql.expression import cast
+from sqlalchemy import Integer, String, CHAR
+from .models import Session, SessionTotal, Transaction, Transline
+from .models import Department, VatBand, VatRate, zero
+
+class SessionTotals:
+    """Totals for a session
+
+    depts is a dict of department id to total, vatbands is a dict of
+    VAT band to total, and payments is a dict of payment type to
+    actual total as recorded when the session was closed.
+    """
+    def __init__(self, id, date, starttime, endtime):
+        self.id = id
+        self.date = date
+        self.starttime = starttime
+        self.endtime = endtime
+        self.depts = {}
+        self.vatbands = {}
+        self.payments = {}
+        self.vatband_totals = []
+
+    def __repr__(self):
+        return "<SessionTotals({}, '{}')>".format(self.id, self.date)
+
+    @property
+    def total(self):
+        "Transaction lines total"
+        return sum(self.depts.values(), zero)
+
+    @property
+    def actual_total(self):
+        "Actual recorded total, or None if not recorded"
+        if not self.payments:
+            return None
+        return sum(self.payments.values(), zero)
+
+    @property
+    def error(self):
+        "Difference between actual total and transaction line total"
+        return self.actual_total - self.total
+
+    @property
+    def business_totals(self):
+        """Totals by business
+
+        A dict of business id to (total, ex-VAT total, VAT) tuples.
+        """
+        b = {}
+        for rate, amount, exc, vat in self.vatband_totals:
+            o = b.get(rate.businessid, (zero, zero, zero))
+            b[rate.businessid] = (o[0] + amount, o[1] + exc, o[2] + vat)
+        return b
+
+class VatRates:
+    """All the VAT bands and the rates that replace them over time
+    """
+    def __init__(self, s):
+        self.bands = {b.band: b for b in s.query(VatBand).all()}
+        self.rates = {}
+        for r in s.query(VatRate).order_by(VatRate.active).all():
+            self.rates.setdefault(r.band, []).append(r)
+
+    def at(self, band, date):
+        """The VatRate or VatBand for a band at a date
+
+        Equivalent to VatBand.at(), without a query.
+        """
+        rate = self.bands[band]
+        for r in self.rates.get(band, []):
+            if r.active <= date:
+                rate = r
+        return rate
+
+def session_totals(s, start=None, end=None, sessionids=None,
+                   recorded_only=False):
+    """Totals for closed sessions
+
+    Sessions can be chosen by date (start and end are inclusive) or
+    by id.  If recorded_only is set, sessions that haven't had their
+    actual totals recorded are left out.
+
+    Yields SessionTotals objects in order of date and session id.
+    The rows are read through a server-side cursor, so any number of
+    sessions may be included.
+    """
+    vatrates = VatRates(s)
+
+    def chosen(q):
+        q = q.where(Session.endtime != None)
+        if start:
+            q = q.where(Session.date >= start)
+        if end:
+            q = q.where(Session.date <= end)
+        if sessionids is not None:
+            q = q.where(Session.id.in_(sessionids))
+        return q
+
+    depts = chosen(select([
+        Transaction.sessionid.label('sessionid'),
+        Transline.dept_id.label('dept'),
+        Department.vatband.label('band'),
+        cast(null(), String(8)).label('paytype'),
+        func.sum(Transline.items * Transline.amount).label('amount')])\
+        .select_from(Session.__table__.join(Transaction.__table__)
+                     .join(Transline.__table__)
+                     .join(Department.__table__)))\
+        .group_by(Transaction.sessionid, Transline.dept_id,
+                  Department.vatband)
+
+    payments = chosen(select([
+        SessionTotal.sessionid,
+        cast(null(), Integer),
+        cast(null(), CHAR(1)),
+        SessionTotal.paytype_id,
+        SessionTotal.amount])
+        .select_from(Session.__table__.join(SessionTotal.__table__)))
+
+    totals = union_all(depts, payments).alias('totals')
+
+    q = chosen(select([
+        Session.id, Session.date, Session.starttime, Session.endtime,
+        totals.c.dept, totals.c.band, totals.c.paytype, totals.c.amount])
+        .select_from(Session.__table__.outerjoin(
+            totals, totals.c.sessionid == Session.id)))\
+        .order_by(Session.date, Session.id, totals.c.dept,
+                  totals.c.paytype)
+
+    conn = s.connection().execution_options(stream_results=True)
+    result = conn.execute(q)
+
+    def finish(t):
+        t.vatband_totals = []
+        for band, amount in sorted(t.vatbands.items()):
+            rate = vatrates.at(band, t.date)
+            t.vatband_totals.append(
+                (rate, amount, rate.inc_to_exc(amount),
+                 rate.inc_to_vat(amount)))
+        return t
+
+    t = None
+    try:
+        for row in result:
+            sid, date, starttime, endtime, dept, band, paytype, amount = row
+            if not t or t.id != sid:
+                if t and (t.payments or not recorded_only):
+                    yield finish(t)
+                t = SessionTotals(sid, date, starttime, endtime)
+            if dept is not None:
+                t.depts[dept] = amount
+                t.vatbands[band] = t.vatbands.get(band, zero) + amount
+            elif paytype is not None:
+                t.payments[paytype] = amount
+        if t and (t.payments or not recorded_only):
+            yield finish(t)
+    finally:
+        result.close()
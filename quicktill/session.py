@@ -1,6 +1,7 @@
 """Starting, ending, and recording totals for sessions."""
 
 from . import ui, keyboard, td, printer, tillconfig, user, managestock
+from . import forecast
 from .models import Session, SessionTotal, PayType, Transaction, penny, zero
 from .td import undefer, func, desc, select
 from .plugins import InstancePluginMount
@@ -126,6 +127,7 @@ def confirmendsession():
         printer.print_sessioncountup(r)
     printer.kickout()
     managestock.stock_purge_internal(source="session end")
+    forecast.refresh(td.s)
 
 @user.permission_required("end-session", "End a session")
 def end():
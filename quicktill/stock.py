@@ -7,7 +7,7 @@ from decimal import Decimal
 from . import ui,td,keyboard,tillconfig,linekeys,department,user
 from .models import Department,StockType,StockItem,StockAnnotation
 from .models import AnnotationType,Delivery,desc,StockLineTypeLog
-from sqlalchemy.orm import joinedload,undefer
+from sqlalchemy.orm import joinedload,undefer,contains_eager
 log = logging.getLogger(__name__)
 
 def stockinfo_linelist(sn):
@@ -141,10 +141,10 @@ class stockfilter:
         if not department_id:
             department_id = self.department_id
         q = td.s.query(StockItem).join(Delivery).filter(Delivery.checked == True)
+        q = q.join(StockType)
         # Unfinished items are sorted to the top
         q = q.order_by(StockItem.finished != None)
         if department_id:
-            q = q.join(StockType)
             q = q.filter(StockType.dept_id == department_id)
         if self.stocktype_id:
             q = q.filter(StockItem.stocktype_id == self.stocktype_id)
@@ -284,15 +284,17 @@ class stockpicker(ui.dismisspopup):
                         "belongs to and press Cash/Enter:")
 
     def popup_menu(self, department_id):
-        items = self.filter.query_items(department_id)\
-                           .options(joinedload('stocktype'))\
-                           .options(undefer('remaining'))[:100]
         f = ui.tableformatter(' r l c ')
-        sl = [ (f(s.id, s.stocktype.format(), "{} {}s".format(
-            s.remaining, s.stockunit.unit.name)),
-                self.item_chosen, (s.id,))
-               for s in items]
-        ui.menu(sl, title=self.title)
+        ui.querymenu(
+            lambda: self.filter.query_items(department_id)\
+                               .options(contains_eager('stocktype'))\
+                               .options(undefer('remaining')),
+            lambda s: f(s.id, s.stocktype.format(), "{} {}s".format(
+                s.remaining, s.stockunit.unit.name)),
+            lambda s: self.item_chosen(s.id),
+            title=self.title, filter_fields=[StockType.fullname],
+            filter_contains=True,
+            blurb="Type to search, select a line and press Cash/Enter")
 
     def item_chosen(self, stockid):
         # An item has been chosen from the popup menu
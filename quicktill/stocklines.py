@@ -3,20 +3,124 @@ from . import keyboard, ui, td, tillconfig, printer, user, linekeys, modifiers
 from . import stocktype
 from .models import Department, StockLine, KeyboardBinding
 from .models import StockType, StockLineTypeLog
-from sqlalchemy.sql import select
+from .models import StockItem, StockUnit, StockOut
+from sqlalchemy.sql import select, func, case, literal, text
+from sqlalchemy.orm import subqueryload
+from sqlalchemy.orm.util import identity_key
 from sqlalchemy.exc import IntegrityError
 from decimal import Decimal
 log = logging.getLogger(__name__)
 
+def restock_plan(stocklines, target=None):
+    """Work out the stock movements needed to restock display stocklines
+
+    Does the same as StockLine.calculate_restock() for each of the
+    display stocklines in the list, in a single query: a recursive
+    query visits the stock on sale on each line in the same order as
+    calculate_restock() does, carrying the amount still needed from
+    item to item.  target is used for every line if it is specified.
+
+    Returns a list of (stockline, stockmovement) tuples, in the same
+    order as stocklines, for the lines that need stock moving.  A
+    stockmovement is a list of (stockitem, fetchqty, newdisplayqty,
+    qtyremain) tuples.  The StockLine objects are loaded with their
+    stock on sale, so that they can be printed without further
+    queries.
+    """
+    ids = [sl.id for sl in stocklines]
+    if not ids:
+        return []
+    items = select([
+        StockItem.id.label('stockid'),
+        StockItem.stocklineid.label('stocklineid'),
+        StockLine.capacity.label('capacity'),
+        func.coalesce(StockItem.displayqty, 0).label('dq'),
+        StockUnit.size.label('size'),
+        select([func.coalesce(func.sum(StockOut.qty), 0)])
+        .where(StockOut.stockid == StockItem.id)
+        .correlate(StockItem.__table__)
+        .as_scalar().label('used')])\
+        .select_from(StockItem.__table__.join(StockLine.__table__)
+                     .join(StockUnit.__table__))\
+        .where(StockLine.id.in_(ids))\
+        .where(StockLine.linetype == "display")\
+        .alias('items')
+    i = items.c
+    line = i.stocklineid
+    capacity = i.capacity if target is None else literal(target)
+    ordered = select([
+        i.stockid, line, i.dq, i.size,
+        (i.dq - i.used).label('ondisplay'),
+        (i.size - i.dq).label('instock'),
+        (capacity - func.sum(i.dq - i.used).over(partition_by=line))
+        .label('needed'),
+        func.row_number().over(
+            partition_by=line, order_by=[i.dq.desc(), i.stockid])
+        .label('forward'),
+        func.row_number().over(
+            partition_by=line, order_by=[i.dq, i.stockid.desc()])
+        .label('backward')]).alias('ordered')
+    o = ordered.c
+    # If stock needs to be taken off display, the items are visited
+    # in reverse order
+    steps = select([
+        o.stockid, o.stocklineid, o.dq, o.size, o.ondisplay, o.instock,
+        o.needed,
+        case([(o.needed < 0, o.backward)], else_=o.forward).label('n')])\
+        .alias('steps')
+    s = steps.c
+
+    def move(needed, step):
+        # The same as the loop in StockLine.calculate_restock()
+        return case([
+            (needed > 0, func.least(needed, step.instock)),
+            (needed < 0, func.greatest(needed, -step.ondisplay))],
+                    else_=0)
+
+    # Walk along each line's items one at a time, carrying the amount
+    # still needed from one item to the next
+    first = move(s.needed, s)
+    walk = select([s.stocklineid, s.n, s.stockid, s.dq, s.size,
+                   first.label('move'),
+                   (s.needed - first).label('needed')])\
+        .where(s.n == 1)\
+        .cte('walk', recursive=True)
+    w = walk.alias('w')
+    nextstep = steps.alias('nextstep')
+    nxt = move(w.c.needed, nextstep.c)
+    walk = walk.union_all(
+        select([nextstep.c.stocklineid, nextstep.c.n, nextstep.c.stockid,
+                nextstep.c.dq, nextstep.c.size, nxt, w.c.needed - nxt])
+        .where(nextstep.c.stocklineid == w.c.stocklineid)
+        .where(nextstep.c.n == w.c.n + 1))
+    rows = td.s.execute(
+        select([walk.c.stockid, walk.c.stocklineid, walk.c.n, walk.c.dq,
+                walk.c.size, walk.c.move])
+        .where(walk.c.move != 0)
+        .order_by(walk.c.stocklineid, walk.c.n)).fetchall()
+    if not rows:
+        return []
+
+    lines = td.s.query(StockLine)\
+                .filter(StockLine.id.in_({r.stocklineid for r in rows}))\
+                .options(subqueryload(StockLine.stockonsale)
+                         .undefer_group('qtys'))\
+                .all()
+    lines = {sl.id: sl for sl in lines}
+    sos = {item.id: item for sl in lines.values() for item in sl.stockonsale}
+    moves = {}
+    for r in rows:
+        newdisplayqty = r.dq + r.move
+        moves.setdefault(r.stocklineid, []).append(
+            (sos[r.stockid], r.move, newdisplayqty,
+             int(r.size) - newdisplayqty))
+    return [(lines[id], moves[id]) for id in ids if id in moves]
+
 def restock_list(stockline_list):
     # Print out list of things to fetch and put on display
     # Display prompt: have you fetched them all?
     # If yes, update records.  If no, don't.
-    sl=[]
-    for i in stockline_list:
-        td.s.add(i)
-        r=i.calculate_restock()
-        if len(r)>0: sl.append((i,r))
+    sl = restock_plan(stockline_list)
     if sl==[]:
         ui.infopopup(["There is no stock to be put on display."],
                      title="Stock movement")
@@ -37,13 +141,48 @@ def abandon_restock(sl):
     ui.infopopup(["The stock movements in the list HAVE NOT been recorded."],
                  title="Stock movement abandoned")
 
-def finish_restock(rsl):
-    for stockline,stockmovement in rsl:
-        td.s.add(stockline)
-        for sos,move,newdisplayqty,instock_after_move in stockmovement:
-            td.s.add(sos)
-            sos.displayqty=newdisplayqty
+def apply_restock(rsl):
+    """Record the stock movements from restock_plan()
+
+    All the display quantities are set in a single UPDATE statement.
+    """
+    values = [(sos.id, newdisplayqty) for stockline, stockmovement in rsl
+              for sos, move, newdisplayqty, instock_after_move
+              in stockmovement]
+    if not values:
+        return
+    params = {}
+    rows = []
+    for n, (stockid, displayqty) in enumerate(values):
+        rows.append("(CAST(:s{n} AS integer), CAST(:q{n} AS numeric))"
+                    .format(n=n))
+        params["s{}".format(n)] = stockid
+        params["q{}".format(n)] = displayqty
     td.s.flush()
+    # The log_stocktype rule inserts a row into stockline_stocktype_log
+    # for every row updated, and the rule that ignores duplicates only
+    # looks at rows already in the table; make sure they are all there
+    # first so that several items of the same type on a line can be
+    # updated at once.
+    td.s.execute(StockLineTypeLog.__table__.insert().from_select(
+        ['stocklineid', 'stocktype'],
+        select([StockItem.stocklineid, StockItem.stocktype_id])
+        .where(StockItem.id.in_([stockid for stockid, dq in values]))
+        .where(StockItem.stocklineid != None)
+        .distinct()))
+    td.s.execute(text(
+        "UPDATE stock SET displayqty = v.displayqty "
+        "FROM (VALUES {}) AS v(stockid, displayqty) "
+        "WHERE stock.stockid = v.stockid".format(", ".join(rows))),
+                 params)
+    # Any of these items already loaded are now out of date
+    for stockid, displayqty in values:
+        item = td.s.identity_map.get(identity_key(StockItem, stockid))
+        if item:
+            td.s.expire(item, ['displayqty'])
+
+def finish_restock(rsl):
+    apply_restock(rsl)
     ui.infopopup(["The till has recorded all the stock movements "
                   "in the list."],title="Stock movement confirmed",
                  colour=ui.colour_info,dismiss=keyboard.K_CASH)
@@ -67,6 +206,7 @@ def restock_all():
     """
     restock_list(td.s.query(StockLine)
                  .filter(StockLine.linetype == "display")
+                 .order_by(StockLine.location, StockLine.name)
                  .all())
 
 class stockline_associations(user.permission_checked,ui.listpopup):
@@ -111,13 +251,11 @@ class stockline_associations(user.permission_checked,ui.listpopup):
             ui.listpopup.keypress(self,k)
 
 def return_stock(stockline):
-    td.s.add(stockline)
-    rsl=stockline.calculate_restock(target=0)
-    if not rsl:
+    restock=restock_plan([stockline], target=0)
+    if not restock:
         ui.infopopup(["The till has no record of stock on display for "
                       "this line."],title="Remove stock")
         return
-    restock=[(stockline,rsl)]
     printer.print_restock_list(restock)
     ui.infopopup([
         "The list of stock to be taken off display has been printed.",
@@ -1,5 +1,8 @@
 from . import models
+from . import forecast
+from . import report
 import unittest
+from unittest import mock
 import datetime
 from decimal import Decimal
 from sqlalchemy.orm import sessionmaker
@@ -237,5 +240,297 @@ class ModelTest(unittest.TestCase):
         self.s.commit()
         self.assertIsNone(delivery.costprice)
 
+    def template_display_stockline_setup(self, name, capacity, items):
+        """Add a display stockline with stock on sale
+
+        items is a list of (displayqty, used) tuples for cases of 24
+        pints of beer from a single delivery.  Returns the stockline.
+        """
+        beer = self.s.query(models.StockType).one()
+        case = self.s.merge(models.StockUnit(
+            id='case24', name='Case', size=24, unit_id='pt'))
+        delivery = self.s.query(models.Delivery).first() \
+                   or models.Delivery(
+                       date=datetime.date.today(),
+                       supplier=models.Supplier(name="Test supplier"),
+                       docnumber="test")
+        sold = self.s.merge(models.RemoveCode(id='sold', reason='Sold'))
+        stockline = models.StockLine(
+            name=name, location="Test", linetype="display",
+            capacity=capacity, stocktype=beer)
+        self.s.add(stockline)
+        for displayqty, used in items:
+            item = models.StockItem(
+                delivery=delivery, stocktype=beer, stockunit=case,
+                stockline=stockline, displayqty=displayqty)
+            self.s.add(item)
+            if used:
+                self.s.add(models.StockOut(
+                    stockitem=item, qty=used, removecode=sold))
+        self.s.commit()
+        return stockline
+
+    def test_restock_plan(self):
+        """stocklines.restock_plan() should agree with
+        StockLine.calculate_restock(), including on lines where more
+        has been sold than was recorded as being on display.
+        """
+        # stocklines needs the till's printer drivers, so is only
+        # imported by the tests that use it
+        from . import td, stocklines
+        self.template_setup()
+        self.template_stocktype_setup()
+        lines = [
+            # Short of stock, with one item oversold
+            self.template_display_stockline_setup(
+                "Short", 10, [(6, 9), (4, 0), (None, 0)]),
+            # Too much on display, with one item oversold
+            self.template_display_stockline_setup(
+                "Over", 10, [(24, 2), (3, 5)]),
+            # Nothing to do
+            self.template_display_stockline_setup(
+                "Full", 10, [(10, 0), (None, 0)]),
+        ]
+        with mock.patch.object(td, 's', self.s):
+            for target in (None, 0, 5):
+                expected = [(sl, sl.calculate_restock(target))
+                            for sl in lines]
+                expected = [(sl, sm) for sl, sm in expected if sm]
+                self.assertEqual(stocklines.restock_plan(lines, target),
+                                 expected)
+            stocklines.apply_restock(stocklines.restock_plan(lines))
+            for sl in lines:
+                self.s.expire(sl)
+                self.assertEqual(sl.ondisplay, sl.capacity)
+            self.assertEqual(stocklines.restock_plan(lines), [])
+
+    def test_weekday_factors(self):
+        """Usage should be spread over the days of the week in
+        proportion to the amount used on each of them, once there are
+        enough weeks to tell.
+        """
+        self.template_setup()
+        beer = self.template_stocktype_setup()
+        cider = models.StockType(
+            manufacturer="A Farm", name="A Cider", shortname="A Cider",
+            abv=6, unit=beer.unit, dept_id=1)
+        sold = models.RemoveCode(id='sold', reason='Sold')
+        waste = models.RemoveCode(id='waste', reason='Waste')
+        self.s.add_all([cider, sold, waste])
+        # Four weeks ending on a Sunday; twice as much is used on
+        # Fridays as the rest of the week, plus some waste
+        end = datetime.date(2020, 3, 1)
+        for i in range(28):
+            day = end - datetime.timedelta(days=i)
+            self.s.add(models.StockUsage(
+                date=day, stocktype=beer, removecode=sold,
+                qty=8 if day.weekday() == 4 else 2))
+            self.s.add(models.StockUsage(
+                date=day, stocktype=beer, removecode=waste, qty=5))
+        self.s.commit()
+        rates = forecast.usage_rates(self.s, 28, end=end)
+        self.assertEqual(rates.keys(), {beer.id})
+        self.assertAlmostEqual(float(rates[beer.id]), 20 / 7)
+        factors = forecast.weekday_factors(
+            self.s, [beer.id, cider.id], 28, end=end)
+        for day, factor in enumerate(factors[beer.id]):
+            self.assertAlmostEqual(factor, 2.8 if day == 4 else 0.7)
+        self.assertEqual(factors[cider.id], [1.0] * 7)
+        # Not enough weeks to tell
+        self.assertEqual(forecast.weekday_factors(
+            self.s, [beer.id], 27, end=end), {beer.id: [1.0] * 7})
+        # A week uses the same amount however the days are spread
+        rate = float(rates[beer.id])
+        self.assertAlmostEqual(forecast.expected_usage(
+            rate, factors[beer.id], 7, start=end), 20)
+        friday = datetime.date(2020, 3, 6)
+        self.assertAlmostEqual(forecast.expected_usage(
+            rate, factors[beer.id], 1, start=friday), 8)
+        self.assertAlmostEqual(forecast.expected_usage(
+            rate, factors[beer.id], 2, start=friday), 10)
+
+    def test_report_session_totals(self):
+        """report.session_totals() should agree with the totals worked
+        out by the Session model, including VAT rate changes.
+        """
+        self.template_setup()
+        zero = models.VatBand(band='B', businessid=1, rate=0)
+        food = models.Department(id=2, description="Food", vat=zero)
+        cash = models.PayType(paytype='CASH', description='Cash')
+        card = models.PayType(paytype='CARD', description='Card')
+        self.s.add_all([zero, food, cash, card, models.VatRate(
+            band='A', businessid=1, rate=5,
+            active=datetime.date(2020, 3, 1))])
+        def add_session(date, lines, totals=None, closed=True):
+            session = models.Session(date)
+            if closed:
+                session.endtime = datetime.datetime.now()
+            trans = models.Transaction(session=session)
+            for dept, amount in lines:
+                self.s.add(models.Transline(
+                    transaction=trans, items=2, amount=Decimal(amount),
+                    dept_id=dept, transcode='S', text="Test sale"))
+            for paytype, amount in (totals or {}).items():
+                self.s.add(models.SessionTotal(
+                    session=session, paytype=paytype,
+                    amount=Decimal(amount)))
+            self.s.add(session)
+            self.s.flush()
+            return session.id
+        early = add_session(datetime.date(2020, 1, 1),
+                            [(1, "3.50"), (2, "1.25"), (1, "2.00")],
+                            {cash: "10.00", card: "2.00"})
+        late = add_session(datetime.date(2020, 6, 1), [(1, "4.99")])
+        empty = add_session(datetime.date(2020, 7, 1), [])
+        add_session(datetime.date(2020, 8, 1), [(2, "1.00")], closed=False)
+        self.s.commit()
+        totals = list(report.session_totals(self.s))
+        self.assertEqual([t.id for t in totals], [early, late, empty])
+        for t in totals:
+            session = self.s.query(models.Session).get(t.id)
+            self.assertEqual(t.depts, {d.id: amount for d, amount
+                                       in session.dept_totals})
+            self.assertEqual(t.payments, {st.paytype_id: st.amount for st
+                                          in session.actual_totals})
+            self.assertEqual(t.total, session.total)
+            self.assertEqual(t.actual_total, session.actual_total)
+            self.assertEqual(t.vatband_totals, session.vatband_totals)
+        self.assertEqual([t.id for t in report.session_totals(
+            self.s, recorded_only=True)], [early])
+        self.assertEqual([t.id for t in report.session_totals(
+            self.s, start=datetime.date(2020, 6, 1),
+            end=datetime.date(2020, 6, 30))], [late])
+        self.assertEqual([t.id for t in report.session_totals(
+            self.s, sessionids=[early, empty])], [early, empty])
+
+    def tillweb_views(self):
+        """The tillweb views module, setting up django if necessary
+        """
+        # tillweb needs django, which the till itself doesn't
+        try:
+            import django
+        except ImportError:
+            self.skipTest("django is not installed")
+        from django.conf import settings
+        if not settings.configured:
+            settings.configure(INSTALLED_APPS=[
+                'django.contrib.auth', 'django.contrib.contenttypes',
+                'quicktill.tillweb'])
+            django.setup()
+        from .tillweb import views
+        return views
+
+    def test_keyset_pager_keys(self):
+        """Keys in KeysetPager links should convert back to the values
+        of the key columns, and anything else should be rejected.
+        """
+        views = self.tillweb_views()
+        key = [models.Session.starttime, models.Session.id]
+        t = datetime.datetime(2020, 1, 2, 3, 4, 5, 6)
+        s = views._key_to_str([t, 12])
+        self.assertEqual(views._key_from_str(key, s), [t, 12])
+        for bad in ("12", "{},12,1".format(s), "2020-01-02,12",
+                    "{},x".format(s.split(",")[0])):
+            with self.assertRaises(ValueError):
+                views._key_from_str(key, bad)
+
+    def test_keyset_pager(self):
+        """KeysetPager should page through a query by following its
+        links, and start at the beginning if a link's key is no good.
+        """
+        views = self.tillweb_views()
+        from django.test import RequestFactory
+        session = models.Session(datetime.date.today())
+        transactions = [models.Transaction(session=session)
+                        for i in range(5)]
+        self.s.add_all(transactions)
+        self.s.commit()
+        transactions.sort(key=lambda t: t.id)
+        q = self.s.query(models.Transaction)
+        def pager(link="?"):
+            return views.KeysetPager(RequestFactory().get("/" + link), q,
+                                     [models.Transaction.id],
+                                     items_per_page=2)
+        p = pager()
+        self.assertFalse(p.has_previous())
+        seen = p.items()
+        while p.has_next():
+            p = pager(p.nextlink())
+            seen += p.items()
+        self.assertEqual(seen, transactions)
+        self.assertEqual(p.items(), transactions[4:])
+        self.assertEqual(p.page, 3)
+        p = pager(pager().lastlink())
+        self.assertEqual(p.items(), transactions[3:])
+        self.assertFalse(p.has_next())
+        self.assertEqual(pager(p.prevlink()).items(), transactions[1:3])
+        for link in ("?after=junk", "?before=1,2",
+                     "?after={}".format(transactions[-1].id)):
+            p = pager(link)
+            self.assertEqual(p.items(), transactions[:2])
+            self.assertEqual(p.page, 1)
+
+class PrintTemplateTest(unittest.TestCase):
+    def setUp(self):
+        # printtemplate needs the till's printer drivers, so is only
+        # imported by the tests that use it
+        from . import printtemplate
+        self.pt = printtemplate
+
+    def test_constants_folded(self):
+        """Lines that only use constants should be formatted when the
+        template is compiled, and each() over a constant unrolled.
+        """
+        pt = self.pt
+        t = pt.compiled_template([
+            pt.line("\t{pubname}", emph=1),
+            pt.each("pubaddr", [pt.line("{item}")]),
+        ], {'pubname': "The Pub", 'pubaddr': ["1 High St", "Town"]})
+        canvases = [mock.Mock(), mock.Mock()]
+        for canvas in canvases:
+            # Values passed when printing don't change folded lines
+            t.render(canvas, pubname="Other", pubaddr=["Elsewhere"])
+            canvas.printline.assert_not_called()
+        stories = [[c[0][0] for c in canvas.add_story.call_args_list]
+                   for canvas in canvases]
+        self.assertEqual([[str(e) for e in s] for s in stories[0]],
+                         [["\tThe Pub\t"], ["1 High St\t\t"], ["Town\t\t"]])
+        self.assertEqual(stories[0][0][0].emph, 1)
+        # The elements are made once and shared between canvases
+        for a, b in zip(*stories):
+            self.assertIs(a, b)
+
+    def test_values(self):
+        """Lines using values passed when printing should be formatted
+        then, with each() and when() looking values up by name.
+        """
+        pt = self.pt
+        t = pt.compiled_template([
+            pt.line("{trans.id}\t{pubname}", colour=1),
+            pt.each("trans.lines", var="l", template=[
+                pt.when("l.band", [pt.line("{l.text} {l.band}")],
+                        otherwise=[pt.line("{l.text}")]),
+            ]),
+        ], {'pubname': "The Pub"})
+        trans = mock.Mock(id=12, lines=[mock.Mock(text="Beer", band="A"),
+                                        mock.Mock(text="Crisps", band=None)])
+        canvas = mock.Mock()
+        t.render(canvas, trans=trans)
+        canvas.add_story.assert_not_called()
+        self.assertEqual(canvas.printline.call_args_list, [
+            mock.call("12\tThe Pub", colour=1, font=None, emph=None,
+                      underline=None),
+            mock.call("Beer A", colour=None, font=None, emph=None,
+                      underline=None),
+            mock.call("Crisps", colour=None, font=None, emph=None,
+                      underline=None),
+        ])
+
+    def test_default_templates_compile(self):
+        with mock.patch.object(self.pt, '_compiled', {}):
+            self.pt.compile_all()
+            self.assertEqual(self.pt._compiled.keys(),
+                             self.pt.templates.keys())
+
 if __name__ == '__main__':
     unittest.main()
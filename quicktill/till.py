@@ -21,6 +21,10 @@ import fcntl
 import array
 import socket
 import time
+import datetime
+import io
+import csv
+import json
 from types import ModuleType
 from . import ui
 from . import td
@@ -29,11 +33,13 @@ from . import tillconfig
 from . import foodorder
 from . import user
 from . import pdrivers
+from . import printtemplate
 from . import cmdline
 from . import kbdrivers
 from . import keyboard
+from . import report
 from .version import version
-from .models import Session, Business, zero
+from .models import Business, zero
 import subprocess
 
 # The following imports are to ensure subcommands are loaded
@@ -41,6 +47,8 @@ from . import extras
 from . import dbsetup
 from . import dbutils
 from . import foodcheck
+from . import export
+from . import forecast
 # End of subcommand imports
 
 log = logging.getLogger(__name__)
@@ -143,6 +151,16 @@ class runtill(cmdline.command):
         debugp.add_argument(
             "--glib-mainloop", action="store_true", dest="glibmainloop",
             help="Use GLib mainloop")
+        debugp.add_argument(
+            "--measure-display-output", action="store_true",
+            dest="measure_output",
+            help="Log the number of bytes per second sent to the terminal "
+            "by the ncurses display system")
+        debugp.add_argument(
+            "--record-keyboard", dest="recordfile", metavar="FILE",
+            type=argparse.FileType('a'),
+            help="Append all keyboard input and user tokens to FILE, "
+            "for later use with the 'replay' command")
         gtkp = parser.add_argument_group(
             title="display system arguments",
             description="The Gtk display system can be used instead of the "
@@ -165,7 +183,8 @@ class runtill(cmdline.command):
             "--keyboard-font", dest="kbfont", default="sans 8",
             action="store", type=str, metavar="FONT_DESCRIPTION",
             help="Set the font to be used for the on-screen keyboard")
-        parser.set_defaults(command=runtill, nolisten=False)
+        parser.set_defaults(command=runtill, nolisten=False,
+                            measure_output=False, recordfile=None)
 
     class _dbg_kbd_input:
         """Process input from debug keyboard
@@ -193,10 +212,15 @@ class runtill(cmdline.command):
     @staticmethod
     def run(args):
         log.info("Starting version %s", version)
+        printtemplate.compile_all()
         if tillconfig.keyboard and tillconfig.keyboard_driver \
            and args.hwkeyboard:
             ui.keyboard_filter_stack.insert(
                 0, tillconfig.keyboard_driver(tillconfig.keyboard))
+        if args.recordfile:
+            from . import ui_headless
+            ui.keyboard_filter_stack.append(
+                ui_headless.recorder(args.recordfile))
 
         # Initialise event loop
         if args.glibmainloop or args.gtk:
@@ -247,7 +271,7 @@ class runtill(cmdline.command):
                     keyboard=tillconfig.keyboard if args.keyboard else None)
             else:
                 from . import ui_ncurses
-                ui_ncurses.run()
+                ui_ncurses.run(measure_output=args.measure_output)
         except:
             log.exception("Exception caught at top level")
         finally:
@@ -255,10 +279,196 @@ class runtill(cmdline.command):
                 dbg_kbd.stdin.close()
                 dbg_kbd.wait()
 
+        unprinted = pdrivers.wait_for_spoolers(timeout=30)
+        if unprinted:
+            log.warning("Exiting with %d print jobs not printed", unprinted)
         log.info("Shutting down")
         logging.shutdown()
         return tillconfig.mainloop.exit_code
 
+class headless(cmdline.command):
+    """
+    Run the till without a display, taking keyboard input from a
+    script, and report how long each keypress took to handle.
+
+    The script has one item of keyboard input per line: a keycode
+    name like K_CASH, "usertoken:" followed by a user token, or a
+    string.  Lines starting with "chars:" are sent one character at
+    a time, for example to simulate a barcode scanner.  The script
+    can be run repeatedly, for example to simulate many sales.
+
+    This should be run against a test database.  You will probably
+    want to use --disable-printer as well.
+
+    """
+    help = "run the till without a display using a script of keyboard input"
+
+    @staticmethod
+    def add_arguments(parser):
+        parser.add_argument(
+            "script", type=argparse.FileType('r'),
+            help="File containing keyboard input")
+        parser.add_argument(
+            "-n", "--repeat", dest="repeat", type=int, default=1,
+            metavar="N", help="Run the script N times")
+        parser.add_argument(
+            "--latency-file", dest="latencyfile",
+            type=argparse.FileType('w'), metavar="FILE",
+            help="Write the time taken to handle each keypress to FILE "
+            "in CSV format")
+        parser.add_argument(
+            "--snapshot", action="store_true", dest="snapshot",
+            help="Print the contents of the display at the end of the run")
+        parser.add_argument(
+            "--no-hardware-keyboard", dest="hwkeyboard", default=True,
+            action="store_false",
+            help="Don't pass input through the hardware keyboard driver")
+
+    @staticmethod
+    def run(args):
+        from . import ui_headless
+        from . import event
+        if tillconfig.keyboard and tillconfig.keyboard_driver \
+           and args.hwkeyboard:
+            ui.keyboard_filter_stack.insert(
+                0, tillconfig.keyboard_driver(tillconfig.keyboard))
+        tillconfig.mainloop = event.SelectorsMainLoop()
+        tillconfig.start_time = time.time()
+        keys = ui_headless.decode_script(args.script)
+        args.script.close()
+        for l in ui_headless.run_and_report(
+                keys, repeat=args.repeat, latencyfile=args.latencyfile,
+                snapshot=args.snapshot):
+            print(l)
+        return tillconfig.mainloop.exit_code
+
+class replay(cmdline.command):
+    """
+    Run the till without a display, taking keyboard input from a
+    file recorded using the --record-keyboard option of runtill, and
+    report how long each keypress took to handle and how many SQL
+    statements were issued.
+
+    The recording should be replayed against a copy of the database
+    taken before it was made.  You will probably want to use
+    --disable-printer as well.
+
+    """
+    help = "replay recorded keyboard input without a display"
+
+    @staticmethod
+    def add_arguments(parser):
+        parser.add_argument(
+            "recording", type=argparse.FileType('r'),
+            help="File containing recorded keyboard input")
+        speed = parser.add_mutually_exclusive_group()
+        speed.add_argument(
+            "--realtime", action="store_const", const=1.0, dest="speed",
+            help="Replay the input at the speed it was recorded")
+        speed.add_argument(
+            "--speed", type=float, dest="speed", metavar="FACTOR",
+            help="Replay the input FACTOR times faster than it was "
+            "recorded")
+        parser.add_argument(
+            "--latency-file", dest="latencyfile",
+            type=argparse.FileType('w'), metavar="FILE",
+            help="Write the time taken to handle each keypress to FILE "
+            "in CSV format")
+        parser.add_argument(
+            "--snapshot", action="store_true", dest="snapshot",
+            help="Print the contents of the display at the end of the run")
+        parser.set_defaults(speed=None)
+
+    @staticmethod
+    def run(args):
+        from . import ui_headless
+        from . import event
+        # The recording was made after the keyboard driver had
+        # processed the input, so we don't install it here
+        tillconfig.mainloop = event.SelectorsMainLoop()
+        tillconfig.start_time = time.time()
+        keys, delays = ui_headless.read_recording(args.recording)
+        args.recording.close()
+        if args.speed:
+            delays = [d / args.speed for d in delays]
+        else:
+            delays = None
+        for l in ui_headless.run_and_report(
+                keys, delays=delays, latencyfile=args.latencyfile,
+                snapshot=args.snapshot):
+            print(l)
+        return tillconfig.mainloop.exit_code
+
+class printer_benchmark(cmdline.command):
+    """
+    Measure how many typical receipts per second can be converted
+    into the output for the configured receipt printer.  Nothing is
+    sent to the printer.
+
+    """
+    command = "printer-benchmark"
+    help = "measure receipt rendering speed"
+    database_required = False
+
+    @staticmethod
+    def add_arguments(parser):
+        parser.add_argument(
+            "-l", "--lines", dest="lines", type=int, default=20,
+            help="Number of transaction lines on each receipt")
+        parser.add_argument(
+            "-t", "--time", dest="time", type=float, default=5.0,
+            metavar="SECONDS", help="Run the benchmark for SECONDS")
+        parser.add_argument(
+            "--qrcode", action="store_true", dest="qrcode",
+            help="Include a QR code on each receipt")
+
+    @staticmethod
+    def _receipt(d, lines, qrcode):
+        d.printline("\t{}".format(tillconfig.pubname), emph=1)
+        for i in tillconfig.pubaddr:
+            d.printline("\t{}".format(i), colour=1)
+        d.printline("\tTel. {}".format(tillconfig.pubnumber))
+        d.printline()
+        for i in range(lines):
+            d.printline("Example Brewery Example Bitter (4.2% ABV) "
+                        "pint\t\t{}".format(tillconfig.fc(zero + 3 + i % 4)),
+                        font=1)
+        d.printline("\t\tSubtotal {}".format(tillconfig.fc(zero + lines * 4)),
+                    colour=1, emph=1)
+        d.printline("\t\tCash {}".format(tillconfig.fc(zero + lines * 4)))
+        d.printline()
+        d.printline("VAT reg no. 123 4567 89")
+        d.printline("A: {} net, {} VAT @ 20.0%\t\tTotal {}".format(
+            tillconfig.fc(zero + lines * 3), tillconfig.fc(zero + lines),
+            tillconfig.fc(zero + lines * 4)), font=1)
+        if qrcode:
+            d.printqrcode(b"https://example.org/receipt/1234")
+        d.printline("\tReceipt number 1234")
+        d.printline("\t{}".format(ui.formatdate(datetime.date.today())))
+
+    @staticmethod
+    def run(args):
+        p = printer.driver
+        if p.canvastype != "receipt" \
+           or not hasattr(p._driver, "process_canvas"):
+            print("The receipt printer ({}) can't be used for this "
+                  "benchmark".format(p))
+            return 1
+        canvas = p.get_canvas()
+        printer_benchmark._receipt(canvas, args.lines, args.qrcode)
+        count = 0
+        output = 0
+        start = time.perf_counter()
+        while time.perf_counter() - start < args.time:
+            f = io.BytesIO()
+            p._driver.process_canvas(canvas, f)
+            output += len(f.getvalue())
+            count += 1
+        elapsed = time.perf_counter() - start
+        print("{}: {} receipts in {:.2f} seconds, {:.1f} receipts per "
+              "second, {} bytes per receipt".format(
+                  p, count, elapsed, count / elapsed, output // count))
+
 class on_screen_keyboard(cmdline.command):
     command = "on-screen-keyboard"
     help = "internal helper command for on-screen-keyboard"
@@ -292,6 +502,9 @@ class totals(cmdline.command):
     """
     Display a table of session totals.
 
+    Sessions whose dates are within the last few days are shown.  All
+    the totals are read in a single query, so any number of days may
+    be displayed.
     """
     help = "display table of session totals"
 
@@ -299,49 +512,107 @@ class totals(cmdline.command):
     def add_arguments(parser):
         parser.add_argument("-d","--days",type=int,dest="days",
                             help="number of days to display",default=40)
+        parser.add_argument("-f","--format",dest="format",
+                            choices=["table","csv","json"],default="table",
+                            help="output format")
     @staticmethod
     def run(args):
+        start=datetime.date.today()-datetime.timedelta(days=args.days)
         with td.orm_session():
-            sessions=td.s.query(Session).\
-                filter(Session.endtime!=None).\
-                order_by(Session.id)[-args.days:]
             businesses=td.s.query(Business).order_by(Business.id).all()
-            f="{s.id:>5} | {s.date} | "
-            h="  ID  |    Date    | "
+            sessions=report.session_totals(td.s,start=start,
+                                           recorded_only=True)
+            if args.format=="json":
+                totals._json(sessions,businesses)
+            elif args.format=="csv":
+                totals._csv(sessions,businesses)
+            else:
+                totals._table(sessions,businesses)
+
+    @staticmethod
+    def _business_totals(s,businesses):
+        b={}
+        for x in businesses:
+            b[x.id]=(zero,zero,zero)
+        b.update(s.business_totals)
+        return b
+
+    @staticmethod
+    def _table(sessions,businesses):
+        f="{s.id:>5} | {s.date} | "
+        h="  ID  |    Date    | "
+        for x in tillconfig.all_payment_methods:
+            f=f+"{p[%s]:>8} | "%x.paytype
+            h=h+"{:^8} | ".format(x.description)
+        f=f+"{error:>7} | "
+        h=h+" Error  | "
+        for b in businesses:
+            if b.show_vat_breakdown:
+                f=f+"{b[%s][1]:>10} | {b[%s][2]:>8} | "%(b.id,b.id)
+                h=h+"{:^10} | {:^8} | ".format(
+                    b.abbrev+" ex-VAT",b.abbrev+" VAT")
+            else:
+                f=f+"{b[%s][0]:>8} | "%b.id
+                h=h+"{:^8} | ".format(b.abbrev)
+        f=f[:-2]
+        h=h[:-2]
+        print(h)
+        for s in sessions:
+            p={}
+            for x in tillconfig.all_payment_methods:
+                p[x.paytype]=""
+            p.update(s.payments)
+            b=totals._business_totals(s,businesses)
+            print(f.format(s=s,p=p,error=s.error,b=b))
+
+    @staticmethod
+    def _csv(sessions,businesses):
+        w=csv.writer(sys.stdout)
+        h=["id","date"]
+        for x in tillconfig.all_payment_methods:
+            h.append(x.paytype)
+        h.append("error")
+        for b in businesses:
+            if b.show_vat_breakdown:
+                h=h+[b.abbrev+" ex-VAT",b.abbrev+" VAT"]
+            else:
+                h.append(b.abbrev)
+        w.writerow(h)
+        for s in sessions:
+            r=[s.id,s.date]
             for x in tillconfig.all_payment_methods:
-                f=f+"{p[%s]:>8} | "%x.paytype
-                h=h+"{:^8} | ".format(x.description)
-            f=f+"{error:>7} | "
-            h=h+" Error  | "
+                r.append(s.payments.get(x.paytype,""))
+            r.append(s.error)
+            bt=totals._business_totals(s,businesses)
             for b in businesses:
                 if b.show_vat_breakdown:
-                    f=f+"{b[%s][1]:>10} | {b[%s][2]:>8} | "%(b.id,b.id)
-                    h=h+"{:^10} | {:^8} | ".format(
-                        b.abbrev+" ex-VAT",b.abbrev+" VAT")
+                    r=r+[bt[b.id][1],bt[b.id][2]]
                 else:
-                    f=f+"{b[%s][0]:>8} | "%b.id
-                    h=h+"{:^8} | ".format(b.abbrev)
-            f=f[:-2]
-            h=h[:-2]
-            print(h)
-            for s in sessions:
-                # Sessions with no total recorded will report actual_total
-                # of None
-                if s.actual_total is None: continue
-                vbt=s.vatband_totals
-                p={}
-                for x in tillconfig.all_payment_methods:
-                    p[x.paytype]=""
-                for t in s.actual_totals:
-                    p[t.paytype_id]=t.amount
-                b={}
-                for x in businesses:
-                    b[x.id]=(zero,zero,zero)
-                for x in vbt:
-                    o=b[x[0].businessid]
-                    o=(o[0]+x[1],o[1]+x[2],o[2]+x[3])
-                    b[x[0].businessid]=o
-                print(f.format(s=s,p=p,error=s.actual_total-s.total,b=b))
+                    r.append(bt[b.id][0])
+            w.writerow(r)
+
+    @staticmethod
+    def _json(sessions,businesses):
+        # Amounts are written as strings so that they are exact
+        out=[]
+        for s in sessions:
+            bt=totals._business_totals(s,businesses)
+            out.append({
+                'id':s.id,
+                'date':str(s.date),
+                'total':str(s.total),
+                'actual_total':str(s.actual_total),
+                'error':str(s.error),
+                'payments':{k:str(v) for k,v in s.payments.items()},
+                'businesses':{
+                    b.abbrev:{'total':str(bt[b.id][0]),
+                              'exvat':str(bt[b.id][1]),
+                              'vat':str(bt[b.id][2])}
+                    for b in businesses},
+                'departments':{str(k):str(v) for k,v in s.depts.items()},
+            })
+        json.dump(out,sys.stdout,indent=2)
+        print()
 
 def _linux_unblank_screen():
     TIOCL_UNBLANKSCREEN=4
@@ -485,10 +756,16 @@ def main():
         tillconfig.database = args.database
     if 'kitchenprinter' in config:
         foodorder.kitchenprinter = config['kitchenprinter']
+    foodorder.kitchenprinters = config.get('kitchenprinters', {})
+    foodorder.kitchen_routes = config.get('kitchen_routes', {})
+    if config.get('spool_kitchenprinters', False):
+        foodorder.spool_kitchen_printers()
     foodorder.menuurl = config.get('menuurl')
     tillconfig.pubname = config['pubname']
     tillconfig.pubnumber = config['pubnumber']
     tillconfig.pubaddr = config['pubaddr']
+    if 'print_templates' in config:
+        printtemplate.templates.update(config['print_templates'])
     tillconfig.currency = config['currency']
     tillconfig.all_payment_methods = config['all_payment_methods']
     tillconfig.payment_methods = config['payment_methods']
@@ -0,0 +1,213 @@
+"""Reports covering all the tills a user can access
+
+When tillweb is integrated into a larger website, each person may
+have access to several tills.  The all-tills report shows takings by
+week, department and business, and the stock sold most, for all of
+them side by side.
+
+The queries for each till are run at the same time in a pool of
+threads, using the replica of each till database if there is one
+(see replica.py).  Each till's queries are cancelled if they take
+longer than TILLWEB_ALLTILLS_TIMEOUT seconds (default 30), and the
+report is shown without that till.  TILLWEB_ALLTILLS_WORKERS is the
+largest number of tills queried at once (default 8).
+
+At most max_days days (a year) can be shown at once; longer ranges
+are cut short at the start.
+
+The results for each till are kept for TILLWEB_ALLTILLS_TTL seconds
+(default 300) in the cache named by the TILLWEB_CACHE setting, or the
+default cache if that isn't set, so that looking at the same dates
+again doesn't query the tills again.
+"""
+
+from django.conf import settings
+from django.core.cache import caches
+from concurrent.futures import ThreadPoolExecutor, wait
+from sqlalchemy.sql import func
+from quicktill.models import *
+from . import dashboard
+from . import replica
+import datetime
+
+import logging
+log = logging.getLogger(__name__)
+
+# The longest range of dates covered by the report
+max_days = 366
+
+def _cache():
+    return caches[getattr(settings, 'TILLWEB_CACHE', None) or 'default']
+
+def timeout():
+    return getattr(settings, 'TILLWEB_ALLTILLS_TIMEOUT', 30)
+
+def weeks(start, end):
+    """Weeks covering a range of dates
+
+    Returns a list of (monday, firstday, lastday) tuples; the first
+    and last weeks are cut short to fit the range.
+    """
+    monday = start - datetime.timedelta(days=start.weekday())
+    r = []
+    while monday <= end:
+        r.append((monday, max(monday, start),
+                  min(monday + datetime.timedelta(days=6), end)))
+        monday = monday + datetime.timedelta(days=7)
+    return r
+
+def till_report(session, start, end):
+    """The figures for one till
+
+    Returns a dict of plain values that can be cached:
+
+    weeks - list of (monday, total)
+    businesses - list of (business name, total)
+    depts - list of (department description, total)
+    stock - list of (manufacturer, name, unit name, quantity sold,
+      value sold)
+    """
+    w = weeks(start, end)
+    totals = dashboard.business_totals_by_week(
+        session, [(first, last) for monday, first, last in w])
+    businesses = {}
+    for week in totals:
+        for business, total in week:
+            businesses[business.name] = \
+                businesses.get(business.name, zero) + total
+
+    depts = session\
+            .query(Department.description,
+                   func.sum(Transline.items * Transline.amount))\
+            .select_from(Department)\
+            .join(Transline, Transaction, Session)\
+            .filter(Session.date >= start)\
+            .filter(Session.date <= end)\
+            .group_by(Department.id, Department.description)\
+            .order_by(Department.id)\
+            .all()
+
+    # A transaction line may have used several stock items, with a
+    # stockout row for each; its value is shared between them in
+    # proportion to the quantity taken from each, so that it is only
+    # counted once.
+    share = Transline.items * Transline.amount * StockOut.qty \
+            / func.nullif(func.sum(StockOut.qty).over(
+                partition_by=StockOut.translineid), 0)
+    sold = session\
+           .query(StockItem.stocktype_id.label('stocktype'),
+                  StockOut.qty.label('qty'),
+                  share.label('value'))\
+           .select_from(StockOut)\
+           .join(StockItem, Transline, Transaction, Session)\
+           .filter(Session.date >= start)\
+           .filter(Session.date <= end)\
+           .subquery()
+    stock = session\
+            .query(StockType.manufacturer, StockType.name, UnitType.name,
+                   func.sum(sold.c.qty),
+                   func.round(func.sum(sold.c.value), 2))\
+            .select_from(sold)\
+            .join(StockType, StockType.id == sold.c.stocktype)\
+            .join(UnitType)\
+            .group_by(StockType.manufacturer, StockType.name, UnitType.name)\
+            .all()
+
+    return {
+        'weeks': [(monday, sum((t for b, t in week), zero))
+                  for (monday, first, last), week in zip(w, totals)],
+        'businesses': sorted(businesses.items()),
+        'depts': [tuple(x) for x in depts],
+        'stock': [tuple(x) for x in stock],
+    }
+
+def _run(till, start, end):
+    # Runs in a worker thread, with its own database session
+    session = replica.session(
+        till.database, settings.SQLALCHEMY_SESSIONS[till.database],
+        getattr(settings, 'TILLWEB_REPLICAS', {}).get(till.database))
+    try:
+        # Make the database give up at the same time as we do
+        session.execute("SET LOCAL statement_timeout = {:d}".format(
+            int(timeout() * 1000)))
+        return till_report(session, start, end)
+    finally:
+        session.close()
+
+def reports(tills, start, end):
+    """The figures for several tills
+
+    Returns a list of (till, report) tuples in the same order as
+    tills; report is None if the till's figures could not be found.
+    """
+    cache = _cache()
+    keys = {t: "tillweb-alltills:{}:{}:{}".format(t.database, start, end)
+            for t in tills}
+    results = {t: cache.get(keys[t]) for t in tills}
+    missing = [t for t in tills if results[t] is None]
+    if missing:
+        workers = min(len(missing),
+                      getattr(settings, 'TILLWEB_ALLTILLS_WORKERS', 8))
+        pool = ThreadPoolExecutor(max_workers=workers)
+        try:
+            futures = {pool.submit(_run, t, start, end): t for t in missing}
+            # The database cancels slow queries, but give up waiting
+            # for a till that can't even be connected to
+            wait(futures, timeout=timeout() + 5)
+            for future, t in futures.items():
+                if not future.done():
+                    future.cancel()
+                    log.warning("All-tills report: %s timed out", t)
+                elif future.exception():
+                    log.warning("All-tills report: %s failed: %s",
+                                t, future.exception())
+                else:
+                    results[t] = future.result()
+                    cache.set(keys[t], results[t],
+                              getattr(settings, 'TILLWEB_ALLTILLS_TTL', 300))
+        finally:
+            # Don't wait for threads stuck on unreachable tills
+            pool.shutdown(wait=False)
+    return [(t, results[t]) for t in tills]
+
+def _merge(reports, part, key, value):
+    """Merge part of several tills' reports into a table
+
+    Returns a list of (key, [value for each till], total) tuples,
+    ordered by key.  Tills without a report get None.
+    """
+    rows = {}
+    for i, (till, report) in enumerate(reports):
+        if not report:
+            continue
+        for item in report[part]:
+            k = key(item)
+            if k not in rows:
+                rows[k] = [None] * len(reports)
+            v = value(item)
+            rows[k][i] = v if rows[k][i] is None else rows[k][i] + v
+    return [(k, v, sum(x for x in v if x is not None))
+            for k, v in sorted(rows.items())]
+
+def merged(reports, top_stock=30):
+    """Tables combining the figures for several tills
+
+    Returns a dict of tables for the template; see _merge() for their
+    format.  The stock table has the value sold at each till, and
+    only the top_stock items with the highest total value, highest
+    first; each of its rows has the total quantity sold added.
+    Quantities can't be compared between stock with different units,
+    so value is used to choose the top items.
+    """
+    qtys = {k: total for k, v, total in _merge(
+        reports, 'stock', lambda x: x[:3], lambda x: x[3])}
+    stock = [(k, v, total, qtys[k]) for k, v, total in _merge(
+        reports, 'stock', lambda x: x[:3], lambda x: x[4])]
+    stock.sort(key=lambda x: x[2], reverse=True)
+    return {
+        'weeks': _merge(reports, 'weeks', lambda x: x[0], lambda x: x[1]),
+        'businesses': _merge(reports, 'businesses',
+                             lambda x: x[0], lambda x: x[1]),
+        'depts': _merge(reports, 'depts', lambda x: x[0], lambda x: x[1]),
+        'stock': stock[:top_stock],
+    }
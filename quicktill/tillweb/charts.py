@@ -0,0 +1,139 @@
+"""Simple charts drawn as SVG
+
+These replace the charts that used to be drawn by matplotlib.  They
+are much quicker to draw, and don't need matplotlib to be installed
+on the web server.  Each function returns an SVG document as a
+string.
+"""
+
+from xml.sax.saxutils import escape
+import math
+
+# The colours matplotlib used for the old pie charts
+colours = ["#ff0000", "#008000", "#0000ff", "#00bfbf", "#bfbf00", "#bf00bf",
+           "#808000", "#a52a2a", "#da70d6", "#4169e1", "#a0522d", "#4682b4"]
+
+_fontsize = 11
+
+def _svg(width, height, body):
+    return ('<?xml version="1.0" encoding="utf-8"?>\n'
+            '<svg xmlns="http://www.w3.org/2000/svg" version="1.1" '
+            'width="{w}" height="{h}" viewBox="0 0 {w} {h}" '
+            'font-family="sans-serif" font-size="{fs}">\n'
+            '{body}</svg>\n').format(
+                w=width, h=height, fs=_fontsize, body="".join(body))
+
+def _text(x, y, text, anchor="start", extra=""):
+    return '<text x="{:.1f}" y="{:.1f}" text-anchor="{}"{}>{}</text>\n'.format(
+        x, y, anchor, extra, escape(str(text)))
+
+def pie_chart(slices, size=400):
+    """A pie chart
+
+    slices is a list of (label, value) tuples.  Slices with values
+    that aren't positive are left out.  The pie starts at three
+    o'clock and goes anticlockwise, as matplotlib's did.
+    """
+    slices = [(label, value) for label, value in slices
+              if value and value > 0]
+    total = float(sum(v for l, v in slices))
+    # Leave room either side for the labels
+    margin = 100
+    cx = size / 2 + margin
+    cy = size / 2
+    r = size * 0.35
+    body = []
+    angle = 0.0
+    for i, (label, value) in enumerate(slices):
+        colour = colours[i % len(colours)]
+        sweep = float(value) / total * 2 * math.pi
+        if len(slices) == 1:
+            body.append('<circle cx="{:.1f}" cy="{:.1f}" r="{:.1f}" '
+                        'fill="{}" stroke="#000" stroke-width="0.5"/>\n'
+                        .format(cx, cy, r, colour))
+        else:
+            x1 = cx + r * math.cos(angle)
+            y1 = cy - r * math.sin(angle)
+            x2 = cx + r * math.cos(angle + sweep)
+            y2 = cy - r * math.sin(angle + sweep)
+            body.append(
+                '<path d="M{:.1f},{:.1f} L{:.1f},{:.1f} '
+                'A{:.1f},{:.1f} 0 {:d},0 {:.1f},{:.1f} Z" fill="{}" '
+                'stroke="#000" stroke-width="0.5" stroke-linejoin="bevel">'
+                '<title>{}</title></path>\n'.format(
+                    cx, cy, x1, y1, r, r, 1 if sweep > math.pi else 0,
+                    x2, y2, colour, escape("{}: {}".format(label, value))))
+        middle = angle + sweep / 2
+        lx = cx + r * 1.1 * math.cos(middle)
+        ly = cy - r * 1.1 * math.sin(middle)
+        body.append(_text(
+            lx, ly + _fontsize / 3, label,
+            anchor="start" if math.cos(middle) >= 0 else "end"))
+        angle += sweep
+    return _svg(size + margin * 2, size, body)
+
+def _ticks(low, high, count=5):
+    """Round numbers for the axis of a chart covering low to high
+    """
+    span = high - low
+    if span <= 0:
+        return [low]
+    step = 10 ** math.floor(math.log10(span / count))
+    for m in (1, 2, 5, 10):
+        if span / (step * m) <= count:
+            step = step * m
+            break
+    first = math.floor(low / step)
+    last = math.ceil(high / step)
+    return [i * step for i in range(first, last + 1)]
+
+def _ticklabel(v):
+    return "{:.0f}".format(v) if v == int(v) else "{:g}".format(v)
+
+def bar_chart(bars, width=600, height=300, label_every=1, title=None):
+    """A bar chart
+
+    bars is a list of (label, value) tuples, drawn left to right.
+    Only every label_every'th label is drawn, for charts with too
+    many bars to label them all.
+    """
+    values = [float(v or 0) for l, v in bars]
+    ticks = _ticks(min(values + [0.0]), max(values + [0.0]))
+    low, high = ticks[0], ticks[-1]
+    left = 10 + 7 * max(len(_ticklabel(t)) for t in ticks)
+    top = 25 if title else 10
+    bottom = 25
+    plotw = width - left - 10
+    ploth = height - top - bottom
+    def y(v):
+        if high == low:
+            return top + ploth
+        return top + ploth - (v - low) / (high - low) * ploth
+
+    body = []
+    if title:
+        body.append(_text(width / 2, 15, title, anchor="middle",
+                          extra=' font-weight="bold"'))
+    for t in ticks:
+        body.append('<line x1="{:.1f}" y1="{:.1f}" x2="{:.1f}" y2="{:.1f}" '
+                    'stroke="#ccc" stroke-width="0.5"/>\n'.format(
+                        left, y(t), left + plotw, y(t)))
+        body.append(_text(left - 4, y(t) + _fontsize / 3, _ticklabel(t),
+                          anchor="end"))
+    if bars:
+        slot = plotw / len(bars)
+        for i, (label, value) in enumerate(bars):
+            x = left + i * slot
+            y0, y1 = sorted((y(0), y(values[i])))
+            body.append(
+                '<rect x="{:.1f}" y="{:.1f}" width="{:.1f}" height="{:.1f}" '
+                'fill="{}"><title>{}</title></rect>\n'.format(
+                    x + slot * 0.1, y0, slot * 0.8, y1 - y0, colours[9],
+                    escape("{}: {}".format(label, value))))
+            if i % label_every == 0:
+                body.append(_text(x + slot / 2, top + ploth + 15, label,
+                                  anchor="middle"))
+    body.append('<line x1="{:.1f}" y1="{:.1f}" x2="{:.1f}" y2="{:.1f}" '
+                'stroke="#000" stroke-width="1"/>\n'.format(
+                    left, y(0), left + plotw, y(0)))
+    return _svg(width, height, body)
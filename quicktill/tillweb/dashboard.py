@@ -0,0 +1,178 @@
+"""Snapshot of the information on the tillweb front page
+
+The front page is often left on wall-mounted screens that reload it
+every few seconds.  Rather than querying the till database on every
+request, the page is built from a snapshot made of several parts,
+each of which is rendered to HTML and kept in a cache until it
+expires.  Only the parts that have expired are recomputed.
+
+The page polls the dashboard.json view, passing the versions of the
+parts it has, and is sent only the parts that have changed.
+
+Parts are kept in the cache named by the TILLWEB_CACHE setting, or
+the default cache if that isn't set.  TILLWEB_DASHBOARD_TTL is the
+number of seconds to keep the parts that change most often; the
+default is 30.
+"""
+
+from django.conf import settings
+from django.core.cache import caches
+from django.template.loader import render_to_string
+from sqlalchemy.orm import joinedload_all, undefer
+from sqlalchemy.sql import select, and_, case
+from sqlalchemy.sql.expression import tuple_, func, null
+from quicktill.models import *
+import datetime
+import hashlib
+
+def _cache():
+    return caches[getattr(settings, 'TILLWEB_CACHE', None) or 'default']
+
+def ttl():
+    """Number of seconds the parts that change most often are kept
+    """
+    return getattr(settings, 'TILLWEB_DASHBOARD_TTL', 30)
+
+def business_totals_by_week(session, weeks):
+    """Sales by business for several ranges of dates
+
+    weeks is a list of (firstday, lastday) tuples, which must not
+    overlap.  Returns a list of lists of (Business, total) tuples,
+    one list for each range of dates, in a single query.
+    """
+    # This query is wrong in that it ignores the 'business' field in
+    # VatRate objects.  Fixes that don't involve a database round-trip
+    # per session are welcome!
+    week = case([(and_(Session.date >= firstday, Session.date <= lastday), i)
+                 for i, (firstday, lastday) in enumerate(weeks)])
+    rows = session.query(
+        week,
+        Business,
+        func.sum(Transline.items * Transline.amount))\
+                  .join(VatBand)\
+                  .join(Department)\
+                  .join(Transline)\
+                  .join(Transaction)\
+                  .join(Session)\
+                  .filter(Session.date <= max(x[1] for x in weeks))\
+                  .filter(Session.date >= min(x[0] for x in weeks))\
+                  .order_by(Business.id)\
+                  .group_by(week, Business)\
+                  .all()
+    return [[(business, total) for w, business, total in rows if w == i]
+            for i in range(len(weeks))]
+
+def _takings(session):
+    date = datetime.date.today()
+    # If it's the early hours of the morning, it's more useful for us
+    # to consider it still to be yesterday.
+    if datetime.datetime.now().hour < 4:
+        date = date - datetime.timedelta(1)
+    thisweek_start = date - datetime.timedelta(date.weekday())
+    thisweek_end = thisweek_start + datetime.timedelta(6)
+    lastweek_start = thisweek_start - datetime.timedelta(7)
+    lastweek_end = thisweek_end - datetime.timedelta(7)
+    weekbefore_start = lastweek_start - datetime.timedelta(7)
+    weekbefore_end = lastweek_end - datetime.timedelta(7)
+
+    ranges = [("Current week", thisweek_start, thisweek_end),
+              ("Last week", lastweek_start, lastweek_end),
+              ("The week before last", weekbefore_start, weekbefore_end)]
+    totals = business_totals_by_week(
+        session, [(start, end) for desc, start, end in ranges])
+    weeks = [(desc, start, end, t)
+             for (desc, start, end), t in zip(ranges, totals)]
+
+    currentsession = session\
+                     .query(Session)\
+                     .filter_by(endtime=None)\
+                     .options(undefer('total'),
+                              undefer('closed_total'))\
+                     .first()
+
+    deferred = session\
+               .query(func.sum(Transline.items * Transline.amount))\
+               .select_from(Transaction)\
+               .join(Transline)\
+               .filter(Transaction.sessionid == None)\
+               .scalar()
+
+    return {'weeks': weeks,
+            'currentsession': currentsession,
+            'deferred': deferred}
+
+def _bar(session):
+    # Deferred here to avoid a circular import
+    from .views import undefer_qtys
+    barsummary = session\
+                 .query(StockLine)\
+                 .filter(StockLine.location == "Bar")\
+                 .order_by(StockLine.dept_id,StockLine.name)\
+                 .options(joinedload_all('stockonsale.stocktype.unit'))\
+                 .options(undefer_qtys("stockonsale"))\
+                 .all()
+    return {'barsummary': barsummary}
+
+def _stillage(session):
+    from .views import undefer_qtys
+    stillage = session\
+               .query(StockAnnotation)\
+               .join(StockItem)\
+               .outerjoin(StockLine)\
+               .filter(tuple_(StockAnnotation.text, StockAnnotation.time).in_(
+                   select([StockAnnotation.text,
+                           func.max(StockAnnotation.time)],
+                          StockAnnotation.atype == 'location')\
+                   .group_by(StockAnnotation.text)))\
+               .filter(StockItem.finished == None)\
+               .order_by(StockLine.name != null(), StockAnnotation.time)\
+               .options(joinedload_all('stockitem.stocktype.unit'),
+                        joinedload_all('stockitem.stockline'),
+                        undefer_qtys('stockitem'))\
+               .all()
+    return {'stillage': stillage}
+
+# name: (function, template, multiple of ttl() to keep it for)
+parts = {
+    'takings': (_takings, 'dashboard-takings.html', 1),
+    'bar': (_bar, 'dashboard-bar.html', 2),
+    'stillage': (_stillage, 'dashboard-stillage.html', 2),
+}
+
+def part(session, pubname, name, context):
+    """A part of the dashboard
+
+    Returns a dict with the version of the part, its HTML and whether
+    it is empty.  context is passed to the part's template as well as
+    the result of the part's function.
+    """
+    compute, template, lifetime = parts[name]
+    cache = _cache()
+    key = "tillweb-dashboard:{}:{}".format(pubname, name)
+    p = cache.get(key)
+    if p:
+        return p
+    d = compute(session)
+    c = dict(context)
+    c.update(d)
+    html = render_to_string('tillweb/' + template, c)
+    p = {
+        'version': hashlib.sha1(html.encode('utf-8')).hexdigest()[:16],
+        'html': html,
+        'empty': not any(d.values()),
+    }
+    cache.set(key, p, ttl() * lifetime)
+    return p
+
+def snapshot(session, pubname, context, have={}):
+    """The dashboard
+
+    Returns a dict of part name to part.  Parts whose versions are
+    given in have are left out if they haven't changed.
+    """
+    result = {}
+    for name in parts:
+        p = part(session, pubname, name, context)
+        if have.get(name) != p['version']:
+            result[name] = p
+    return result
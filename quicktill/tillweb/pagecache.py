@@ -0,0 +1,117 @@
+"""Caching of tillweb pages that can't change
+
+Some pages, for example the pages for a session that has been closed
+and had its takings recorded, will never change.  Views for these
+pages declare this using the "immutable" argument to the
+@tillweb_view decorator; see the comment above it in views.py.
+
+Pages with a version are sent with ETag and Last-Modified headers
+so that browsers can make conditional requests, which are answered
+without running the view at all.  If the TILLWEB_CACHE setting names
+one of the caches in the Django CACHES setting, the rendered pages
+are also stored there.  Any Django cache backend may be used: for
+example "django.core.cache.backends.filebased.FileBasedCache" keeps
+pages in the local filesystem, which is usually the best choice
+because the pages never expire.
+
+TILLWEB_CACHE_TIMEOUT is the number of seconds to keep pages in the
+cache; the default of None keeps them until the cache is full.
+"""
+
+from django.conf import settings
+from django.core.cache import caches
+from django.http import HttpResponse, HttpResponseNotModified
+from django.utils.http import http_date, parse_http_date_safe, quote_etag
+from quicktill.version import version as till_version
+import hashlib
+import calendar
+
+# Bump this if the format of cached responses changes
+_format = 1
+
+def _cache():
+    alias = getattr(settings, 'TILLWEB_CACHE', None)
+    if alias:
+        return caches[alias]
+
+def page_key(pubname, viewname, args, kwargs, version, access, user, ajax):
+    """Key for a version of a page
+
+    The rendered page depends on the till, the view and its
+    arguments, the version of the object being viewed, the version
+    of the till software, and the access level and web user of the
+    person looking at it (because the site's base template may
+    include the user's name).
+    """
+    key = repr((_format, till_version, pubname, viewname, args,
+                sorted(kwargs.items()), version, access, user, ajax))
+    return "tillweb-page:" + hashlib.sha1(key.encode('utf-8')).hexdigest()
+
+class cached_page:
+    """A page with a version
+
+    last_modified is a datetime or None.
+    """
+    def __init__(self, key, last_modified):
+        self.key = key
+        self.etag = quote_etag(key.split(":")[1])
+        self.last_modified = None
+        if last_modified:
+            self.last_modified = calendar.timegm(last_modified.utctimetuple())
+
+    def not_modified(self, request):
+        """Does the client already have this version of the page?
+        """
+        if_none_match = request.META.get('HTTP_IF_NONE_MATCH')
+        if if_none_match:
+            # If-None-Match takes precedence over If-Modified-Since
+            etags = [x.strip() for x in if_none_match.split(",")]
+            return self.etag in etags or "*" in etags
+        if self.last_modified:
+            since = parse_http_date_safe(
+                request.META.get('HTTP_IF_MODIFIED_SINCE', ''))
+            return since is not None and since >= self.last_modified
+        return False
+
+    def get(self):
+        """The page from the cache, or None
+        """
+        cache = _cache()
+        if not cache:
+            return None
+        cached = cache.get(self.key)
+        if not cached:
+            return None
+        headers, content = cached
+        response = HttpResponse(content)
+        for header, value in headers:
+            response[header] = value
+        return response
+
+    def put(self, response):
+        """Store a response in the cache
+
+        Only successful responses are stored.
+        """
+        cache = _cache()
+        if not cache or response.status_code != 200 or response.streaming:
+            return
+        # Spreadsheets have a Content-Disposition header as well as
+        # Content-Type
+        headers = [(header, value) for header, value in response.items()
+                   if header.lower() in ('content-type',
+                                         'content-disposition')]
+        cache.set(self.key, (headers, response.content),
+                  getattr(settings, 'TILLWEB_CACHE_TIMEOUT', None))
+
+    def add_headers(self, response):
+        response['ETag'] = self.etag
+        if self.last_modified:
+            response['Last-Modified'] = http_date(self.last_modified)
+        # The page may depend on who is looking at it, so it mustn't
+        # be stored by shared caches
+        response['Cache-Control'] = "private, no-cache"
+        return response
+
+    def not_modified_response(self):
+        return self.add_headers(HttpResponseNotModified())
@@ -0,0 +1,117 @@
+"""Running tillweb queries on a replica of the till database
+
+Reports such as month-end spreadsheets can keep the database busy for
+a long time.  To stop them slowing down the tills, tillweb can read
+from a streaming replica of the till database instead of the server
+the tills write to.
+
+For a single site, set TILLWEB_REPLICA_DATABASE to a sessionmaker for
+the replica, alongside TILLWEB_DATABASE.  When there are several
+tills, set TILLWEB_REPLICAS to a dict of database name (as used in
+SQLALCHEMY_SESSIONS) to sessionmaker.  engine() makes engines with
+sensible pool settings and a statement timeout, for example:
+
+TILLWEB_REPLICA_DATABASE = sessionmaker(bind=replica.engine(
+    "dbname=till host=replica", statement_timeout=60))
+
+engine() can be used for the primary databases as well, to give each
+till its own pool of connections with its own limits.
+
+Views use the replica unless they are declared with
+@tillweb_view(write=True), or the replica is more than
+TILLWEB_REPLICA_MAX_LAG seconds (default 30) behind the primary or
+can't be reached, in which case they use the primary.  The lag is
+checked at most once every TILLWEB_REPLICA_CHECK_INTERVAL seconds
+(default 10) for each replica.
+"""
+
+from django.conf import settings
+from sqlalchemy import create_engine
+from sqlalchemy.exc import DBAPIError
+from quicktill import td
+import time
+
+import logging
+log = logging.getLogger(__name__)
+
+# Replica: (time checked, usable)
+_checked = {}
+
+def max_lag():
+    return getattr(settings, 'TILLWEB_REPLICA_MAX_LAG', 30)
+
+def check_interval():
+    return getattr(settings, 'TILLWEB_REPLICA_CHECK_INTERVAL', 10)
+
+def engine(database, pool_size=5, max_overflow=10, pool_timeout=30,
+           pool_recycle=3600, statement_timeout=None):
+    """An engine for a till database
+
+    database is a libpq connection string or sqlalchemy URL.
+    statement_timeout is the number of seconds after which queries
+    are cancelled; cancelled queries show the "database problem" page.
+    """
+    connect_args = {}
+    if statement_timeout:
+        connect_args['options'] = "-c statement_timeout={:d}".format(
+            int(statement_timeout * 1000))
+    return create_engine(td.parse_database_name(database),
+                         pool_size=pool_size, max_overflow=max_overflow,
+                         pool_timeout=pool_timeout, pool_recycle=pool_recycle,
+                         connect_args=connect_args)
+
+def lag(session):
+    """How many seconds a replica is behind the primary
+
+    A replica that is streaming from the primary and has replayed
+    everything it has received is not behind, however long ago the
+    last transaction was.  If it isn't streaming, it can't tell
+    whether it has missed anything, so the time since the last
+    transaction it replayed is used, or None if it hasn't replayed
+    any.  Returns 0 if the database is not a replica.
+
+    The pid column of pg_stat_wal_receiver can be read by any user,
+    but its status column needs the pg_read_all_stats role; without
+    it, a running WAL receiver is assumed to be streaming.
+    """
+    return session.execute(
+        "SELECT CASE "
+        "WHEN NOT pg_is_in_recovery() THEN 0 "
+        "WHEN EXISTS (SELECT 1 FROM pg_stat_wal_receiver "
+        "             WHERE pid IS NOT NULL "
+        "             AND coalesce(status, 'streaming') = 'streaming') "
+        "  AND pg_last_wal_receive_lsn() = pg_last_wal_replay_lsn() THEN 0 "
+        "ELSE extract(epoch FROM now() - pg_last_xact_replay_timestamp()) "
+        "END").scalar()
+
+def session(key, primary, replica=None):
+    """A database session for a view
+
+    primary and replica are sessionmakers; key identifies the
+    replica.  Returns a session on the replica if there is one and it
+    is up to date, otherwise a session on the primary.
+    """
+    if replica is None:
+        return primary()
+    now = time.monotonic()
+    checked = _checked.get(key)
+    if checked and now - checked[0] < check_interval():
+        return replica() if checked[1] else primary()
+    s = replica()
+    try:
+        behind = lag(s)
+        if behind is None:
+            log.warning("Replica %s has not replayed any transactions", key)
+    except DBAPIError as e:
+        log.warning("Replica %s unavailable: %s", key, e)
+        behind = None
+    usable = behind is not None and behind <= max_lag()
+    if behind is not None and not usable:
+        log.warning("Replica %s is %.0f seconds behind", key, behind)
+    _checked[key] = (now, usable)
+    if usable:
+        # Start the view with a fresh transaction
+        s.rollback()
+        return s
+    s.close()
+    return primary()
@@ -1,15 +1,20 @@
 # -*- coding: utf-8 -*-
-from django.http import HttpResponse
+from django.http import HttpResponse, StreamingHttpResponse
 from quicktill.models import *
-from sqlalchemy.orm import undefer
+from quicktill.export import chunkbuffer
+from quicktill import report
 from sqlalchemy.orm import contains_eager
-from sqlalchemy.sql import select
 from odf.opendocument import OpenDocumentSpreadsheet
+from odf.office import DocumentContent
+from odf import manifest
 from odf.style import Style, TextProperties, ParagraphProperties
 from odf.style import TableColumnProperties
 from odf.text import P
 from odf.table import Table, TableColumn, TableRow, TableCell
 import odf.number as number
+import io
+import time
+import zipfile
 
 class Sheet:
     """A table in a spreadsheet"""
@@ -229,79 +234,218 @@ class Document:
         self.doc.write(r)
         return r
 
+class StreamingSheet(Sheet):
+    """A table in a spreadsheet whose rows are produced while the
+    spreadsheet is being sent
+
+    rows is an iterable of lists of cells, one list for each row; None
+    in a list leaves that cell empty.  The cell() method can't be
+    used, but column styles can be set until the spreadsheet starts
+    to be sent.
+    """
+    def __init__(self, name, rows):
+        super().__init__(name)
+        self.rows = rows
+
+    def cell(self, col, row, contents):
+        raise NotImplementedError("StreamingSheet cells come from rows")
+
+    def write(self, f):
+        """Write the table to f, which accepts strings
+
+        Yields after every few rows so that the caller can send what
+        has been written so far.
+        """
+        t = Table(name=self.name)
+        t.write_open_tag(3, f)
+        if self._columnstyles:
+            for c in range(0, max(self._columnstyles.keys()) + 1):
+                s = self._columnstyles.get(c, None)
+                if s:
+                    TableColumn(stylename=s).toXml(4, f)
+                else:
+                    TableColumn().toXml(4, f)
+        for n, cells in enumerate(self.rows):
+            tr = TableRow()
+            for cell in cells:
+                tr.addElement(cell if cell else TableCell())
+            tr.toXml(4, f)
+            if n % 100 == 99:
+                yield
+        t.write_close_tag(3, f)
+
+class StreamingDocument(Document):
+    """An OpenDocumentSpreadsheet that is sent as it is generated
+
+    Add StreamingSheet tables to it, then return as_response() from
+    the view.  The rows of each table are only generated as the
+    response is sent, so a large spreadsheet never has to be held in
+    memory: use Query.yield_per() to fetch the rows through a
+    server-side cursor.
+
+    The view's database session will have been closed by the time
+    the rows are generated; it is used again (which starts a new
+    transaction) and is closed again at the end.  Pass it as ds.
+    """
+    # Amount of content to compress before sending it
+    chunk_size = 64 * 1024
+
+    def __init__(self, filename=None, ds=None):
+        super().__init__(filename)
+        self._ds = ds
+        self._tables = []
+
+    def add_table(self, table):
+        self._tables.append(table)
+
+    def _content_header(self, f):
+        # Make sure every namespace used in the tables has been
+        # registered before the root element lists them
+        TableCell(valuetype="float", value=0).addElement(P(text=""))
+        TableRow()
+        f.write("<?xml version='1.0' encoding='UTF-8'?>\n")
+        DocumentContent().write_open_tag(0, f)
+        if self.doc.fontfacedecls.hasChildNodes():
+            self.doc.fontfacedecls.toXml(1, f)
+        # Column width styles are automatic styles, so they have to
+        # be known before the tables are written
+        self.doc.automaticstyles.toXml(1, f)
+        self.doc.body.write_open_tag(1, f)
+        self.doc.spreadsheet.write_open_tag(2, f)
+
+    def _content_footer(self, f):
+        self.doc.spreadsheet.write_close_tag(2, f)
+        self.doc.body.write_close_tag(1, f)
+        f.write("</office:document-content>")
+
+    def _manifest(self, files):
+        m = manifest.Manifest()
+        m.addElement(manifest.FileEntry(
+            fullpath="/", mediatype=self.mimetype))
+        for name in files:
+            m.addElement(manifest.FileEntry(
+                fullpath=name, mediatype="text/xml"))
+        f = io.StringIO()
+        f.write("<?xml version='1.0' encoding='UTF-8'?>\n")
+        m.toXml(0, f)
+        return f.getvalue().encode("utf-8")
+
+    def _generate(self):
+        try:
+            out = chunkbuffer()
+            z = zipfile.ZipFile(out, "w")
+            now = time.localtime()[:6]
+
+            # The mimetype must be first, and not compressed
+            zi = zipfile.ZipInfo("mimetype", now)
+            zi.compress_type = zipfile.ZIP_STORED
+            z.writestr(zi, self.mimetype.encode("utf-8"))
+
+            zi = zipfile.ZipInfo("content.xml", now)
+            zi.compress_type = zipfile.ZIP_DEFLATED
+            with z.open(zi, "w") as content:
+                f = io.StringIO()
+                def flush():
+                    content.write(f.getvalue().encode("utf-8"))
+                    f.seek(0)
+                    f.truncate()
+                self._content_header(f)
+                for table in self._tables:
+                    for _ in table.write(f):
+                        if f.tell() >= self.chunk_size:
+                            flush()
+                            data = out.take()
+                            if data:
+                                yield data
+                self._content_footer(f)
+                flush()
+
+            # Styles used by cells, for example dates, are only added
+            # as the cells are created, so styles.xml goes after the
+            # content
+            z.writestr(zipfile.ZipInfo("styles.xml", now),
+                       self.doc.stylesxml().encode("utf-8"),
+                       compress_type=zipfile.ZIP_DEFLATED)
+            z.writestr(zipfile.ZipInfo("meta.xml", now),
+                       self.doc.metaxml().encode("utf-8"),
+                       compress_type=zipfile.ZIP_DEFLATED)
+            z.writestr(zipfile.ZipInfo("META-INF/manifest.xml", now),
+                       self._manifest(
+                           ["content.xml", "styles.xml", "meta.xml"]),
+                       compress_type=zipfile.ZIP_DEFLATED)
+            z.close()
+            yield out.take()
+        finally:
+            if self._ds:
+                self._ds.close()
+
+    def as_response(self):
+        r = StreamingHttpResponse(self._generate(),
+                                  content_type=self.mimetype)
+        if self.filename:
+            r['Content-Disposition'] = 'attachment; filename={}'.format(
+                self.filename)
+        return r
+
+class _daterange:
+    """Totals for the sessions in a range of dates"""
+    def __init__(self, start):
+        self.start = start
+        self.end = start
+        self.depts = {}
+        self.actual_total = None
+
+    def add(self, t):
+        self.end = t.date
+        for dept, total in t.depts.items():
+            self.depts[dept] = self.depts.get(dept, zero) + total
+        if t.actual_total is not None:
+            self.actual_total = (self.actual_total or zero) + t.actual_total
+
+def _sessionrange_rows(ds, start, end, rows):
+    """Rows for the sessionrange spreadsheet
+
+    Sessions without any transaction lines are left out.  For
+    "Sessions", sessions without recorded totals are left out too;
+    for "Days" and "Weeks", the sessions are added up by date.
+    """
+    totals = report.session_totals(ds, start=start, end=end,
+                                   recorded_only=(rows == "Sessions"))
+    if rows == "Sessions":
+        for t in totals:
+            if t.depts:
+                yield t
+        return
+    r = None
+    key = None
+    for t in totals:
+        if not t.depts:
+            continue
+        if rows == "Days":
+            k = t.date
+        else:
+            # I believe weeks run Monday to Sunday!
+            k = (t.date - datetime.date(2002, 8, 5)).days // 7
+        if r and k != key:
+            yield r
+            r = None
+        if not r:
+            r = _daterange(t.date)
+            key = k
+        r.add(t)
+    if r:
+        yield r
+
 def sessionrange(ds, start=None, end=None, rows="Sessions", tillname="Till"):
     """A spreadsheet summarising sessions between the start and end date.
     """
     depts = ds.query(Department).order_by(Department.id).all()
-    tf = func.sum(Transline.items * Transline.amount).label("depttotal")
-    # I believe weeks run Monday to Sunday!
-    weeks = func.div(Session.date - datetime.date(2002, 8, 5), 7)
 
     if start is None:
         start = ds.query(func.min(Session.date)).scalar()
     if end is None:
         end = ds.query(func.max(Session.date)).scalar()
 
-    if rows == "Sessions":
-        depttotals = ds.query(Session, Department.id, tf)\
-                       .select_from(Session)\
-                       .options(undefer('actual_total'))\
-                       .order_by(Session.id, Department.id)\
-                       .group_by(Session.id, Department.id)\
-                       .filter(select([func.count(SessionTotal.sessionid)],
-                                      whereclause=SessionTotal.sessionid == Session.id)\
-                               .correlate(Session.__table__)\
-                               .as_scalar() != 0)\
-                       .filter(Session.endtime != None)\
-                       .filter(Session.date >= start)\
-                       .filter(Session.date <= end)\
-                       .join(Transaction, Transline, Department)
-    else:
-        dateranges = ds.query(func.min(Session.date).label("start"),
-                              func.max(Session.date).label("end"))\
-                       .filter(Session.date >= start)\
-                       .filter(Session.date <= end)\
-                       .filter(Session.endtime != None)
-
-        if rows == "Days":
-            dateranges = dateranges.group_by(Session.date)
-        else:
-            dateranges = dateranges.group_by(weeks)
-        dateranges = dateranges.cte(name="dateranges")
-
-        depttotals = ds.query(
-            dateranges.c.start,
-            dateranges.c.end,
-            Transline.dept_id,
-            tf)\
-                       .select_from(dateranges.join(Session, and_(
-                           Session.date >= dateranges.c.start,
-                           Session.date <= dateranges.c.end))
-                                    .join(Transaction)\
-                                    .join(Transline))\
-                       .group_by(dateranges.c.start,
-                                 dateranges.c.end,
-                                 Transline.dept_id)\
-                       .order_by(dateranges.c.start, Transline.dept_id)
-
-        acttotals = ds.query(
-            dateranges.c.start, dateranges.c.end,
-            select([func.sum(SessionTotal.amount)])\
-            .correlate(dateranges)\
-            .where(and_(
-                Session.date >= dateranges.c.start,
-                Session.date <= dateranges.c.end))\
-            .select_from(Session.__table__.join(SessionTotal))\
-            .label('actual_total'))\
-                      .select_from(dateranges)\
-                      .group_by(dateranges.c.start,
-                                dateranges.c.end)\
-                      .order_by(dateranges.c.start)
-
-        acttotal_dict = {}
-        for start, end, total in acttotals:
-            acttotal_dict[(start, end)] = total
-
     filename = "{}-summary".format(tillname)
 
     if start:
@@ -314,9 +458,10 @@ def sessionrange(ds, start=None, end=None, rows="Sessions", tillname="Till"):
         filename += "-weekly"
     filename = filename + ".ods"
 
-    doc = Document(filename=filename)
+    doc = StreamingDocument(filename=filename, ds=ds)
 
-    table = Sheet(tillname)
+    header = []
+    table = StreamingSheet(tillname, rows=None)
 
     widthshort = doc.colwidth("2.0cm")
     widthtotal = doc.colwidth("2.2cm")
@@ -325,92 +470,85 @@ def sessionrange(ds, start=None, end=None, rows="Sessions", tillname="Till"):
     col = 0
     if rows == "Sessions":
         table.colstyle(col, widthshort)
-        table.cell(col, 0, doc.headercell("ID"))
+        header.append(doc.headercell("ID"))
         idcol = col
         col += 1
     if rows == "Sessions" or rows == "Days":
         table.colstyle(col, widthshort)
-        table.cell(col, 0, doc.headercell("Date"))
+        header.append(doc.headercell("Date"))
         datecol = col
         col += 1
     else:
         table.colstyle(col, widthshort)
-        table.cell(col, 0, doc.headercell("From"))
+        header.append(doc.headercell("From"))
         startdatecol = col
         col += 1
         table.colstyle(col, widthshort)
-        table.cell(col, 0, doc.headercell("To"))
+        header.append(doc.headercell("To"))
         enddatecol = col
         col += 1
 
     # Till total and actual total
     table.colstyle(col, widthtotal)
-    table.cell(col, 0, doc.headercell("Till Total"))
+    header.append(doc.headercell("Till Total"))
     tilltotalcol = col
     col += 1
     table.colstyle(col, widthtotal)
-    table.cell(col, 0, doc.headercell("Actual Total"))
+    header.append(doc.headercell("Actual Total"))
     actualtotalcol = col
     col += 1
 
     # Difference between till total and actual total
     table.colstyle(col, widthshort)
-    table.cell(col, 0, doc.headercell("Error"))
+    header.append(doc.headercell("Error"))
     errorcol = col
     col += 1
 
     table.colstyle(col, widthgap)
+    header.append(None)
     col += 1
 
     deptscol = col
+    deptcols = {}
 
-    for c in range(deptscol, deptscol + len(depts)):
-        table.colstyle(c, widthshort)
     for d in depts:
-        table.cell(col, 0, doc.headercell(d.description))
+        table.colstyle(col, widthshort)
+        header.append(doc.headercell(d.description))
+        deptcols[d.id] = col
         col += 1
 
-    row = 0
-    prev_row = None
-    for x in depttotals:
-        if rows == "Sessions":
-            session, dept, total = x
-            actual_total = session.actual_total
-            rowspec = session.id
-        else:
-            startdate, enddate, dept, total = x
-            rowspec = (startdate, enddate)
-            actual_total = acttotal_dict[rowspec]
-        if rowspec != prev_row:
-            prev_row = rowspec
+    def summary_rows():
+        # Called as the spreadsheet is sent; the session totals are
+        # read from a server-side cursor in order of date
+        yield header
+        row = 0
+        for r in _sessionrange_rows(ds, start, end, rows):
             row += 1
+            cells = [None] * col
             if rows == "Sessions":
-                table.cell(idcol, row, doc.intcell(session.id))
-                table.cell(datecol, row, doc.datecell(session.date))
+                cells[idcol] = doc.intcell(r.id)
+                cells[datecol] = doc.datecell(r.date)
             elif rows == "Days":
-                table.cell(datecol, row, doc.datecell(startdate))
+                cells[datecol] = doc.datecell(r.start)
             else:
-                table.cell(startdatecol, row, doc.datecell(startdate))
-                table.cell(enddatecol, row, doc.datecell(enddate))
+                cells[startdatecol] = doc.datecell(r.start)
+                cells[enddatecol] = doc.datecell(r.end)
 
-            table.cell(tilltotalcol, row, doc.moneycell(
+            cells[tilltotalcol] = doc.moneycell(
                 None, formula="oooc:=SUM([.{}:.{}])".format(
                     table.ref(deptscol, row),
-                    table.ref(deptscol + len(depts) - 1, row))))
-            table.cell(actualtotalcol, row, doc.moneycell(actual_total))
-            table.cell(errorcol, row, doc.moneycell(
+                    table.ref(deptscol + len(depts) - 1, row)))
+            cells[actualtotalcol] = doc.moneycell(r.actual_total)
+            cells[errorcol] = doc.moneycell(
                 None, formula="oooc:=[.{}]-[.{}]".format(
                     table.ref(actualtotalcol, row),
-                    table.ref(tilltotalcol, row))))
-            di = iter(depts)
-            col = deptscol - 1
-        while True:
-            col += 1
-            if next(di).id == dept:
+                    table.ref(tilltotalcol, row)))
+            for dept, total in r.depts.items():
                 if total:
-                    table.cell(col, row, doc.moneycell(total))
-                break
+                    cells[deptcols[dept]] = doc.moneycell(total)
+            yield cells
 
+    table.rows = summary_rows()
     doc.add_table(table)
 
     return doc.as_response()
@@ -575,32 +713,35 @@ def waste(ds, start=None, end=None, cols="depts", tillname="Till"):
     wastes = ds.query(RemoveCode).order_by(RemoveCode.id).all()
 
     date = func.date(StockOut.time)
-    data = ds.query(date,
-                    StockType.dept_id,
-                    StockOut.removecode_id,
-                    func.sum(StockOut.qty))\
-             .join(StockItem, StockType)
-    if start:
-        data = data.filter(date >= start)
-    else:
+    if not start:
         start = ds.query(func.min(date)).scalar()
-    if end:
-        data = data.filter(date <= end)
-    else:
+    if not end:
         end = ds.query(func.max(date)).scalar()
-    data = data.group_by(date, StockType.dept_id, StockOut.removecode_id).all()
 
     filename = "{}-waste.ods".format(tillname)
-    doc = Document(filename)
-
-    def date_to_row(date):
-        return (date - start).days + 1
-
-    def add_dates(table):
-        row = 1
-        for date in daterange(start, end):
-            table.cell(0, row, doc.datecell(date))
-            row += 1
+    doc = StreamingDocument(filename, ds)
+
+    def sheet_rows(headers, column, columns, data):
+        # data is a query giving (date, column key, qty) for the sheet
+        # in order of date; it is only run when the sheet is sent
+        yield [None] + [doc.headercell(h) for h in headers]
+        data = iter(data.order_by(date)
+                    .filter(date >= start)
+                    .filter(date <= end)
+                    .group_by(date, column)
+                    .yield_per(500))
+        n = next(data, None)
+        for d in daterange(start, end):
+            cells = [doc.datecell(d)] + [None] * len(columns)
+            while n and n[0] == d:
+                cells[columns[n[1]]] = doc.numbercell(n[2])
+                n = next(data, None)
+            yield cells
+
+    def data(column):
+        return ds.query(date, column, func.sum(StockOut.qty))\
+                 .select_from(StockOut)\
+                 .join(StockItem, StockType)
 
     if cols == "depts":
         # Sheets are remove codes
@@ -609,14 +750,12 @@ def waste(ds, start=None, end=None, cols="depts", tillname="Till"):
         for dept in depts:
             dept_cols[dept.id] = col
             col += 1
-        waste_sheets = {} # Sheet indexed by removecode_id
         for rc in wastes:
-            table = Sheet(rc.reason)
-            waste_sheets[rc.id] = table
-            add_dates(table)
-            for dept in depts:
-                table.cell(dept_cols[dept.id], 0,
-                           doc.headercell(dept.description))
+            doc.add_table(StreamingSheet(rc.reason, sheet_rows(
+                [dept.description for dept in depts],
+                StockType.dept_id, dept_cols,
+                data(StockType.dept_id)\
+                .filter(StockOut.removecode_id == rc.id))))
     else:
         # Sheets are departments
         waste_cols = {} # Column indexed by removecode_id
@@ -624,30 +763,12 @@ def waste(ds, start=None, end=None, cols="depts", tillname="Till"):
         for rc in wastes:
             waste_cols[rc.id] = col
             col += 1
-        dept_sheets = {} # Sheet indexed by dept_id
         for dept in depts:
-            table = Sheet(dept.description)
-            dept_sheets[dept.id] = table
-            add_dates(table)
-            for rc in wastes:
-                table.cell(waste_cols[rc.id], 0,
-                           doc.headercell(rc.reason))
-
-    for date, dept_id, removecode_id, qty in data:
-        row = date_to_row(date)
-        if cols == "depts":
-            table = waste_sheets[removecode_id]
-            table.cell(dept_cols[dept_id], row, doc.numbercell(qty))
-        else:
-            table = dept_sheets[dept_id]
-            table.cell(waste_cols[removecode_id], row, doc.numbercell(qty))
-
-    if cols == "depts":
-        for rc in wastes:
-            doc.add_table(waste_sheets[rc.id])
-    else:
-        for dept in depts:
-            doc.add_table(dept_sheets[dept.id])
+            doc.add_table(StreamingSheet(dept.description, sheet_rows(
+                [rc.reason for rc in wastes],
+                StockOut.removecode_id, waste_cols,
+                data(StockOut.removecode_id)\
+                .filter(StockType.dept_id == dept.id))))
 
     return doc.as_response()
 
@@ -677,28 +798,24 @@ def stocksold(ds, start=None, end=None, dates="transaction", tillname="Till"):
                 StockOut.time < (end + datetime.timedelta(days=1)))
 
     filename = "{}-stock-sold.ods".format(tillname)
-    doc = Document(filename)
-
-    sheet = Sheet("Stock sold")
-    # Columns are:
-    # Manufacturer  Name  ABV  Dept  qty  UnitType
-    sheet.cell(0, 0, doc.headercell("Manufacturer"))
-    sheet.cell(1, 0, doc.headercell("Name"))
-    sheet.cell(2, 0, doc.headercell("ABV"))
-    sheet.cell(3, 0, doc.headercell("Dept"))
-    sheet.cell(4, 0, doc.headercell("Qty"))
-    sheet.cell(5, 0, doc.headercell("Unit"))
-
-    row = 1
-    for st, qty in sold.all():
-        sheet.cell(0, row, doc.textcell(st.manufacturer))
-        sheet.cell(1, row, doc.textcell(st.name))
-        if st.abv:
-            sheet.cell(2, row, doc.numbercell(st.abv))
-        sheet.cell(3, row, doc.textcell(st.department.description))
-        sheet.cell(4, row, doc.numbercell(qty))
-        sheet.cell(5, row, doc.textcell(st.unit.name))
-        row += 1
-
-    doc.add_table(sheet)
+    doc = StreamingDocument(filename, ds)
+
+    def sold_rows():
+        # Columns are:
+        # Manufacturer  Name  ABV  Dept  qty  UnitType
+        yield [doc.headercell("Manufacturer"),
+               doc.headercell("Name"),
+               doc.headercell("ABV"),
+               doc.headercell("Dept"),
+               doc.headercell("Qty"),
+               doc.headercell("Unit")]
+        for st, qty in sold.yield_per(500):
+            yield [doc.textcell(st.manufacturer),
+                   doc.textcell(st.name),
+                   doc.numbercell(st.abv) if st.abv else None,
+                   doc.textcell(st.department.description),
+                   doc.numbercell(qty),
+                   doc.textcell(st.unit.name)]
+
+    doc.add_table(StreamingSheet("Stock sold", sold_rows()))
     return doc.as_response()
@@ -3,8 +3,11 @@ from quicktill.tillweb.views import *
 
 tillurls = [
     url(r'^$', pubroot, name="tillweb-pubroot"),
+    url(r'^dashboard.json$', dashboard_json, name="tillweb-dashboard-json"),
 
     url(r'^session/$', sessionfinder, name="tillweb-sessions"),
+    url(r'^session/takings-by-day.svg$', takings_by_day_chart,
+        name="tillweb-takings-by-day-chart"),
     url(r'^session/(?P<sessionid>\d+)/', include([
         url(r'^$', session, name="tillweb-session"),
         url(r'^spreadsheet.ods$', session_spreadsheet,
@@ -21,6 +24,8 @@ tillurls = [
             name="tillweb-session-sales-pie-chart"),
         url(r'^users-pie-chart.svg$', session_users_pie_chart,
             name="tillweb-session-users-pie-chart"),
+        url(r'^takings-by-hour.svg$', session_takings_by_hour_chart,
+            name="tillweb-session-takings-by-hour-chart"),
         url(r'^dept(?P<dept>\d+)/$', sessiondept,
             name="tillweb-session-department"),
         ])),
@@ -72,10 +77,13 @@ tillurls = [
     url(r'^user/(?P<userid>\d+)/$', user, name="tillweb-till-user"),
 
     url(r'^reports/$', reportindex, name="tillweb-reports"),
+    url(r'^export/(?P<table>\w+)\.(?P<format>\w+)$', export_table,
+        name="tillweb-export"),
 ]
 
 urls = [
     # Index page
     url(r'^$', publist, name="tillweb-publist"),
+    url(r'^all-tills/$', alltills_report, name="tillweb-alltills"),
     url(r'^(?P<pubname>[\w\-]+)/', include(tillurls)),
 ]
@@ -1,4 +1,6 @@
 from django.http import HttpResponse, Http404, HttpResponseRedirect
+from django.http import JsonResponse, StreamingHttpResponse
+from django.http.response import HttpResponseBase
 from django.contrib.auth.decorators import login_required
 from django.shortcuts import render
 from django.template import RequestContext, Context
@@ -11,17 +13,23 @@ import sqlalchemy
 from sqlalchemy.exc import OperationalError
 from sqlalchemy.orm import subqueryload, subqueryload_all
 from sqlalchemy.orm import joinedload, joinedload_all
-from sqlalchemy.orm import lazyload
 from sqlalchemy.orm import defaultload
 from sqlalchemy.orm import undefer, defer, undefer_group
 from sqlalchemy.orm.exc import NoResultFound
 from sqlalchemy.sql import desc
-from sqlalchemy.sql.expression import tuple_, func, null
+from sqlalchemy.sql.expression import tuple_, func
 from sqlalchemy import distinct
 from quicktill.models import *
 from quicktill.version import version
+from quicktill import export
+from quicktill import forecast
 from . import spreadsheets
-import io
+from . import pagecache
+from . import dashboard
+from . import replica
+from . import alltills
+from . import charts
+import functools
 
 # We use this date format in templates - defined here so we don't have
 # to keep repeating it.  It's available in templates as 'dtf'
@@ -35,6 +43,25 @@ def publist(request):
     return render(request, 'tillweb/publist.html',
                   {'access': access})
 
+# Also only used when integrated into another website: figures for
+# all the tills the user can access, side by side.  See alltills.py.
+@login_required
+def alltills_report(request):
+    tills = list(Till.objects.filter(access__user=request.user)
+                 .order_by('name'))
+    end = _getdate(request, 'end') or datetime.date.today()
+    start = _getdate(request, 'start') or end - datetime.timedelta(days=27)
+    if start > end:
+        start, end = end, start
+    # Every week is a column in the query run on each till, so don't
+    # let the range grow without limit; the form shows the dates used
+    start = max(start, end - datetime.timedelta(days=alltills.max_days - 1))
+    reports = alltills.reports(tills, start, end)
+    d = {'tills': tills, 'start': start, 'end': end,
+         'failed': [t for t, r in reports if r is None]}
+    d.update(alltills.merged(reports))
+    return render(request, 'tillweb/alltills.html', d)
+
 # The remainder of the view functions in this file follow a similar
 # pattern.  They are kept separate rather than implemented as a
 # generic view so that page-specific optimisations (the ".options()"
@@ -59,7 +86,23 @@ def publist(request):
 # user - the quicktill.models.User object if available, or 'R','M','F'
 # session - sqlalchemy database session
 
-def tillweb_view(view):
+# Views for pages that can't change once the object they show reaches
+# a particular state can be declared using @tillweb_view(immutable=f).
+# f is called with the database session and the view's arguments
+# before the view, and returns None if the page may change, or a
+# (version, last_modified) tuple if it will stay the same for as long
+# as the version does.  last_modified may be None if there is no time
+# that changes whenever the version does.  These pages are cached: see pagecache.py.
+
+# Views are given a session on a replica of the till database if one
+# is configured: see replica.py.  Views that change the database must
+# be declared using @tillweb_view(write=True) so that they always use
+# the primary.
+
+def tillweb_view(view=None, immutable=None, write=False):
+    if view is None:
+        return functools.partial(tillweb_view, immutable=immutable,
+                                 write=write)
     single_site = getattr(settings, 'TILLWEB_SINGLE_SITE', False)
     tillweb_login_required = getattr(settings, 'TILLWEB_LOGIN_REQUIRED', True)
     def new_view(request, pubname="", *args, **kwargs):
@@ -67,7 +110,10 @@ def tillweb_view(view):
             till = None
             tillname = settings.TILLWEB_PUBNAME
             access = settings.TILLWEB_DEFAULT_ACCESS
-            session = settings.TILLWEB_DATABASE()
+            session = replica.session(
+                tillname, settings.TILLWEB_DATABASE,
+                None if write else getattr(
+                    settings, 'TILLWEB_REPLICA_DATABASE', None))
         else:
             try:
                 till = Till.objects.get(slug=pubname)
@@ -79,7 +125,10 @@ def tillweb_view(view):
                 # Pretend it doesn't exist!
                 raise Http404
             try:
-                session = settings.SQLALCHEMY_SESSIONS[till.database]()
+                session = replica.session(
+                    till.database, settings.SQLALCHEMY_SESSIONS[till.database],
+                    None if write else getattr(
+                        settings, 'TILLWEB_REPLICAS', {}).get(till.database))
             except ValueError:
                 # The database doesn't exist
                 raise Http404
@@ -91,26 +140,25 @@ def tillweb_view(view):
                 'tillname': tillname, # Formatted for people
                 'pubname': pubname, # Used in url
             }
-            result = view(request, info, session, *args, **kwargs)
-            if isinstance(result, HttpResponse):
-                return result
-            t, d = result
-            # object is the Till object, possibly used for a nav menu
-            # (it's None if we are set up for a single site)
-            # till is the name of the till
-            # access is 'R','M','F'
-            defaults = {'object': till,
-                        'till': tillname, 'access': access,
-                        'dtf': dtf, 'pubname': pubname,
-                        'version': version}
-            if t.endswith(".ajax"):
-                # AJAX content typically is not a fully-formed HTML document.
-                # If requested in a non-AJAX context, add a HTML container.
-                if not request.is_ajax():
-                    defaults['ajax_content'] = 'tillweb/' + t
-                    t = 'non-ajax-container.html'
-            defaults.update(d)
-            return render(request, 'tillweb/' + t, defaults)
+            page = None
+            v = immutable(session, *args, **kwargs) if immutable else None
+            if v:
+                webuser = request.user.pk if hasattr(request, 'user') \
+                          else None
+                page = pagecache.cached_page(pagecache.page_key(
+                    pubname, view.__name__, args, kwargs, v[0], access,
+                    webuser, request.is_ajax()), v[1])
+                if page.not_modified(request):
+                    return page.not_modified_response()
+                response = page.get()
+                if response:
+                    return page.add_headers(response)
+            response = _render_view(request, view, info, session, till,
+                                    args, kwargs)
+            if page:
+                page.put(response)
+                page.add_headers(response)
+            return response
         except OperationalError as oe:
             t = get_template('tillweb/operationalerror.html')
             return HttpResponse(
@@ -123,6 +171,28 @@ def tillweb_view(view):
         new_view = login_required(new_view)
     return new_view
 
+def _render_view(request, view, info, session, till, args, kwargs):
+    result = view(request, info, session, *args, **kwargs)
+    if isinstance(result, HttpResponseBase):
+        return result
+    t, d = result
+    # object is the Till object, possibly used for a nav menu
+    # (it's None if we are set up for a single site)
+    # till is the name of the till
+    # access is 'R','M','F'
+    defaults = {'object': till,
+                'till': info['tillname'], 'access': info['access'],
+                'dtf': dtf, 'pubname': info['pubname'],
+                'version': version}
+    if t.endswith(".ajax"):
+        # AJAX content typically is not a fully-formed HTML document.
+        # If requested in a non-AJAX context, add a HTML container.
+        if not request.is_ajax():
+            defaults['ajax_content'] = 'tillweb/' + t
+            t = 'non-ajax-container.html'
+    defaults.update(d)
+    return render(request, 'tillweb/' + t, defaults)
+
 # undefer_group on a related entity is broken until sqlalchemy 1.1.14
 def undefer_qtys(entity):
     """Return options to undefer the qtys group on a related entity"""
@@ -133,35 +203,18 @@ def undefer_qtys(entity):
             .undefer("remaining")
     return defaultload(entity).undefer_group("qtys")
 
-def business_totals(session, firstday, lastday):
-    # This query is wrong in that it ignores the 'business' field in
-    # VatRate objects.  Fixes that don't involve a database round-trip
-    # per session are welcome!
-    return session.query(
-        Business,
-        func.sum(Transline.items * Transline.amount))\
-                  .join(VatBand)\
-                  .join(Department)\
-                  .join(Transline)\
-                  .join(Transaction)\
-                  .join(Session)\
-                  .filter(Session.date <= lastday)\
-                  .filter(Session.date >= firstday)\
-                  .order_by(Business.id)\
-                  .group_by(Business)\
-                  .all()
-
 class _pager_page:
-    def __init__(self, pager, page):
+    def __init__(self, pager, page, link=None):
         self._pager = pager
         self._page = page
+        self._link = link
 
     @property
     def page(self):
         return self._page
 
     def pagelink(self):
-        return self._pager.pagelink(self._page)
+        return self._link or self._pager.pagelink(self._page)
 
 class Pager:
     """Manage paginated data
@@ -189,9 +242,13 @@ class Pager:
 
         # If the requested page is outside the range of the available items,
         # reset it to 1
+        if not self._page_in_range():
+            self.page = 1
+
+    def _page_in_range(self):
         if self.items_per_page:
-            if ((self.page - 1) * self.items_per_page) > self.count():
-                self.page = 1
+            return ((self.page - 1) * self.items_per_page) <= self.count()
+        return True
 
     def count(self):
         """Number of items to display
@@ -237,11 +294,14 @@ class Pager:
         return self.has_next() or self.has_previous()
 
     def items(self):
-        q = self._query
-        if self.items_per_page:
-            q = q.offset((self.page - 1) * self.items_per_page)\
-                 .limit(self.items_per_page)
-        return q.all()
+        # Templates may ask for the items several times
+        if not hasattr(self, '_items'):
+            q = self._query
+            if self.items_per_page:
+                q = q.offset((self.page - 1) * self.items_per_page)\
+                     .limit(self.items_per_page)
+            self._items = q.all()
+        return self._items
 
     def pagelink(self, page):
         d = self._request.GET.copy()
@@ -267,74 +327,239 @@ class Pager:
         return render_to_string("tillweb/pager.html", context={
             'pager': self})
 
-@tillweb_view
-def pubroot(request, info, session):
-    date = datetime.date.today()
-    # If it's the early hours of the morning, it's more useful for us
-    # to consider it still to be yesterday.
-    if datetime.datetime.now().hour < 4:
-        date = date - datetime.timedelta(1)
-    thisweek_start = date - datetime.timedelta(date.weekday())
-    thisweek_end = thisweek_start + datetime.timedelta(6)
-    lastweek_start = thisweek_start - datetime.timedelta(7)
-    lastweek_end = thisweek_end - datetime.timedelta(7)
-    weekbefore_start = lastweek_start - datetime.timedelta(7)
-    weekbefore_end = lastweek_end - datetime.timedelta(7)
-
-    weeks = [("Current week", thisweek_start, thisweek_end,
-              business_totals(session, thisweek_start, thisweek_end)),
-             ("Last week", lastweek_start, lastweek_end,
-              business_totals(session, lastweek_start, lastweek_end)),
-             ("The week before last", weekbefore_start, weekbefore_end,
-              business_totals(session, weekbefore_start, weekbefore_end))]
-
-    #currentsession = Session.current(session)
-    currentsession = session\
-                     .query(Session)\
-                     .filter_by(endtime=None)\
-                     .options(undefer('total'),
-                              undefer('closed_total'))\
-                     .first()
-
-    barsummary = session\
-                 .query(StockLine)\
-                 .filter(StockLine.location == "Bar")\
-                 .order_by(StockLine.dept_id,StockLine.name)\
-                 .options(joinedload_all('stockonsale.stocktype.unit'))\
-                 .options(undefer_qtys("stockonsale"))\
+def approximate_count(query, exact_below=1000):
+    """Estimate the number of rows a query will return
+
+    Uses the query planner's estimate, which is based on the
+    statistics PostgreSQL keeps about each table and is available
+    without reading the rows.  If the estimate is small the rows are
+    counted properly, because that's cheap.
+    """
+    statement = query.order_by(None).statement
+    compiled = statement.compile(dialect=query.session.bind.dialect)
+    plan = query.session.connection().execute(
+        "EXPLAIN (FORMAT JSON) " + str(compiled), compiled.params).scalar()
+    estimate = plan[0]['Plan']['Plan Rows']
+    if estimate < exact_below:
+        return query.order_by(None).count()
+    return estimate
+
+def _key_to_str(values):
+    return ",".join(v.strftime(_key_datetime_format)
+                    if isinstance(v, datetime.datetime) else str(v)
+                    for v in values)
+
+_key_datetime_format = "%Y-%m-%dT%H:%M:%S.%f"
+
+def _key_from_str(columns, s):
+    parts = s.split(",")
+    if len(parts) != len(columns):
+        raise ValueError("Wrong number of key values")
+    values = []
+    for column, part in zip(columns, parts):
+        python_type = column.type.python_type
+        if python_type is datetime.datetime:
+            values.append(datetime.datetime.strptime(
+                part, _key_datetime_format))
+        else:
+            values.append(python_type(part))
+    return values
+
+class KeysetPager(Pager):
+    """Manage paginated data without counting or skipping rows
+
+    Instead of using an offset, each page is found by seeking to the
+    rows that come after (or before) the last (or first) row of the
+    page the link was on, using the columns in key.  If there is a
+    suitable index, any page can be fetched as quickly as the first.
+    The key columns must be columns of the query's entity that
+    uniquely identify a row; the query is ordered by them, ascending
+    or descending, replacing any existing order.
+
+    The number of pages is estimated from planner statistics rather
+    than counted.  Links are only available to the first, previous,
+    next and last pages.
+    """
+    def __init__(self, request, query, key, descending=False,
+                 items_per_page=30):
+        self._key = key
+        self._descending = descending
+        self._after = None
+        self._before = None
+        self._last = request.GET.get('last') == "1"
+        try:
+            if 'after' in request.GET:
+                self._after = _key_from_str(key, request.GET['after'])
+            elif 'before' in request.GET:
+                self._before = _key_from_str(key, request.GET['before'])
+        except ValueError:
+            pass
+        super().__init__(request, query.order_by(None), items_per_page)
+        if not (self._after or self._before or self._last):
+            self.page = 1
+
+    def _page_in_range(self):
+        # The page number is only used to label the page
+        return self.page >= 1
+
+    def count(self):
+        """Approximate number of items to display
+        """
+        if not hasattr(self, '_count'):
+            self._count = approximate_count(self._query)
+        return self._count
+
+    def pages(self):
+        if self.items_per_page:
+            return max(self.page,
+                       (self.count() - 1) // self.items_per_page + 1, 1)
+        return 1
+
+    def _fetch(self):
+        if hasattr(self, '_items'):
+            return
+        q = self._query
+        if not self.items_per_page:
+            self._items = q.order_by(*self._order(False)).all()
+            self._more = False
+            return
+        reverse = bool(self._before) or self._last
+        anchor = self._after or self._before
+        if anchor:
+            k = tuple_(*self._key)
+            v = tuple_(*anchor)
+            # Rows further along in the direction we are reading
+            q = q.filter(k < v if self._descending != reverse else k > v)
+        items = q.order_by(*self._order(reverse))\
+                 .limit(self.items_per_page + 1)\
                  .all()
+        if anchor and not items:
+            # There's nothing beyond the row the link was made from,
+            # perhaps because rows have been deleted: start again at
+            # the beginning
+            self._after = self._before = None
+            self.page = 1
+            return self._fetch()
+        self._more = len(items) > self.items_per_page
+        items = items[:self.items_per_page]
+        if reverse:
+            items.reverse()
+        self._items = items
+        if self._last:
+            self.page = self.pages()
+
+    def _order(self, reverse):
+        if self._descending != reverse:
+            return [desc(c) for c in self._key]
+        return list(self._key)
+
+    def items(self):
+        self._fetch()
+        return self._items
+
+    def has_next(self):
+        self._fetch()
+        if self._before:
+            return True
+        return self._more and not self._last
+
+    def has_previous(self):
+        self._fetch()
+        if self._after:
+            return True
+        if self._before or self._last:
+            return self._more
+        return False
+
+    def _keyof(self, item):
+        return _key_to_str(getattr(item, c.key) for c in self._key)
+
+    def _link(self, page, **anchor):
+        d = self._request.GET.copy()
+        for k in ('page', 'after', 'before', 'last'):
+            d.pop(k, None)
+        if page > 1:
+            d['page'] = str(page)
+        d.update(anchor)
+        if self.items_per_page != self.default_items_per_page:
+            d['pagesize'] = str(self.items_per_page) \
+                            if self.items_per_page else "all"
+        return "?" + d.urlencode()
+
+    def pagelink(self, page):
+        # Only pages next to the current one can be linked to
+        if page == self.page - 1:
+            return self.prevlink()
+        if page == self.page + 1:
+            return self.nextlink()
+        if page == self.page:
+            return self._link(page, **(
+                {'after': self._after_str} if self._after else
+                {'before': self._before_str} if self._before else
+                {'last': "1"} if self._last else {}))
+        raise ValueError("Page is not next to the current page")
+
+    @property
+    def _after_str(self):
+        return _key_to_str(self._after)
+
+    @property
+    def _before_str(self):
+        return _key_to_str(self._before)
+
+    def local_page_range(self):
+        pages = []
+        if self.has_previous():
+            pages.append(_pager_page(self, max(self.page - 1, 1),
+                                     self.prevlink()))
+        pages.append(_pager_page(self, self.page))
+        if self.has_next():
+            pages.append(_pager_page(self, self.page + 1, self.nextlink()))
+        return pages
+
+    def nextlink(self):
+        if not self.has_next():
+            return None
+        return self._link(self.page + 1, after=self._keyof(self._items[-1]))
 
-    stillage = session\
-               .query(StockAnnotation)\
-               .join(StockItem)\
-               .outerjoin(StockLine)\
-               .filter(tuple_(StockAnnotation.text, StockAnnotation.time).in_(
-                   select([StockAnnotation.text,
-                           func.max(StockAnnotation.time)],
-                          StockAnnotation.atype == 'location')\
-                   .group_by(StockAnnotation.text)))\
-               .filter(StockItem.finished == None)\
-               .order_by(StockLine.name != null(), StockAnnotation.time)\
-               .options(joinedload_all('stockitem.stocktype.unit'),
-                        joinedload_all('stockitem.stockline'),
-                        undefer_qtys('stockitem'))\
-               .all()
-
-    deferred = session\
-               .query(func.sum(Transline.items * Transline.amount))\
-               .select_from(Transaction)\
-               .join(Transline)\
-               .filter(Transaction.sessionid == None)\
-               .scalar()
+    def prevlink(self):
+        if not self.has_previous():
+            return None
+        if self.page <= 2:
+            return self.firstlink()
+        return self._link(self.page - 1, before=self._keyof(self._items[0]))
+
+    def firstlink(self):
+        return self._link(1) if self.has_previous() else None
 
+    def lastlink(self):
+        return self._link(self.pages(), last="1") if self.has_next() else None
+
+@tillweb_view
+def pubroot(request, info, session):
     return ('index.html',
-            {'currentsession': currentsession,
-             'barsummary': barsummary,
-             'stillage': stillage,
-             'weeks': weeks,
-             'deferred': deferred,
+            {'dashboard': dashboard.snapshot(
+                session, info['pubname'], _dashboard_context(info)),
+             'refresh': dashboard.ttl(),
             })
 
+def _dashboard_context(info):
+    return {'pubname': info['pubname'], 'dtf': dtf}
+
+@tillweb_view
+def dashboard_json(request, info, session):
+    """Parts of the front page that have changed
+
+    The request parameters are the versions of the parts the client
+    already has.
+    """
+    return JsonResponse({
+        'parts': dashboard.snapshot(session, info['pubname'],
+                                    _dashboard_context(info),
+                                    have=request.GET),
+        'refresh': dashboard.ttl(),
+    })
+
 @tillweb_view
 def locationlist(request, info, session):
     return ('locations.html', {'locations': StockLine.locations(session)})
@@ -391,10 +616,9 @@ def sessionfinder(request, info, session):
     sessions = session\
                .query(Session)\
                .options(undefer('total'),
-                        undefer('actual_total'))\
-               .order_by(desc(Session.id))
+                        undefer('actual_total'))
 
-    pager = Pager(request, sessions)
+    pager = KeysetPager(request, sessions, [Session.id], descending=True)
 
     return ('sessions.html',
             {'recent': pager.items,
@@ -404,7 +628,39 @@ def sessionfinder(request, info, session):
              'form': form,
              'rangeform': rangeform})
 
-@tillweb_view
+def closed_session(session, sessionid, **kwargs):
+    """Version of a session that can't change
+
+    Once a session is closed and its actual takings have been
+    recorded, pages about it only change if the takings are entered
+    again or the next session is started (which adds a link to it).
+    The takings can be entered again without changing anything else
+    about the session, so there is no last-modified time: the version
+    includes the amount recorded for each payment type instead.
+    """
+    sessionid = int(sessionid)
+    r = session.query(
+        Session.endtime,
+        select([func.min(Session.id)])\
+        .where(Session.id > sessionid)\
+        .as_scalar())\
+        .filter(Session.id == sessionid)\
+        .first()
+    if not r:
+        raise Http404
+    endtime, nextsession = r
+    if not endtime:
+        return None
+    takings = session.query(SessionTotal.paytype_id, SessionTotal.amount)\
+                     .filter(SessionTotal.sessionid == sessionid)\
+                     .order_by(SessionTotal.paytype_id)\
+                     .all()
+    if not takings:
+        return None
+    return ((tuple((paytype, str(amount)) for paytype, amount in takings),
+             nextsession), None)
+
+@tillweb_view(immutable=closed_session)
 def session(request, info, session, sessionid):
     s = session\
         .query(Session)\
@@ -421,7 +677,7 @@ def session(request, info, session, sessionid):
     return ('session.html',
             {'session': s, 'nextlink': nextlink, 'prevlink': prevlink})
 
-@tillweb_view
+@tillweb_view(immutable=closed_session)
 def session_spreadsheet(request, info, session, sessionid):
     s = session\
         .query(Session)\
@@ -432,7 +688,7 @@ def session_spreadsheet(request, info, session, sessionid):
         raise Http404
     return spreadsheets.session(session, s, info['tillname'])
 
-@tillweb_view
+@tillweb_view(immutable=closed_session)
 def session_takings_by_dept(request, info, session, sessionid):
     s = session\
         .query(Session)\
@@ -442,7 +698,7 @@ def session_takings_by_dept(request, info, session, sessionid):
 
     return ('session-takings-by-dept.ajax', {'session': s})
 
-@tillweb_view
+@tillweb_view(immutable=closed_session)
 def session_takings_by_user(request, info, session, sessionid):
     s = session\
         .query(Session)\
@@ -452,7 +708,7 @@ def session_takings_by_user(request, info, session, sessionid):
 
     return ('session-takings-by-user.ajax', {'session': s})
 
-@tillweb_view
+@tillweb_view(immutable=closed_session)
 def session_stock_sold(request,info,session,sessionid):
     s = session\
         .query(Session)\
@@ -462,7 +718,7 @@ def session_stock_sold(request,info,session,sessionid):
 
     return ('session-stock-sold.ajax', {'session': s})
 
-@tillweb_view
+@tillweb_view(immutable=closed_session)
 def session_transactions(request, info, session, sessionid):
     s = session\
         .query(Session)\
@@ -474,7 +730,7 @@ def session_transactions(request, info, session, sessionid):
 
     return ('session-transactions.ajax', {'session': s})
 
-@tillweb_view
+@tillweb_view(immutable=closed_session)
 def sessiondept(request, info, session, sessionid, dept):
     s = session\
         .query(Session)\
@@ -580,10 +836,9 @@ def supplier(request, info, session, supplierid):
 def deliverylist(request, info, session):
     dl = session\
          .query(Delivery)\
-         .order_by(desc(Delivery.id))\
          .options(joinedload('supplier'))
 
-    pager = Pager(request, dl)
+    pager = KeysetPager(request, dl, [Delivery.id], descending=True)
 
     return ('deliveries.html', {'pager': pager})
 
@@ -666,7 +921,6 @@ def stocksearch(request,info,session):
         q = session\
             .query(StockItem)\
             .join(StockType)\
-            .order_by(StockItem.id)\
             .options(joinedload_all('stocktype.unit'),
                      joinedload('stockline'),
                      joinedload('delivery'),
@@ -675,7 +929,7 @@ def stocksearch(request,info,session):
         if not form.cleaned_data['include_finished']:
             q = q.filter(StockItem.finished == None)
 
-        pager = Pager(request, q)
+        pager = KeysetPager(request, q, [StockItem.id])
 
     return ('stocksearch.html', {
         'form': form,
@@ -831,23 +1085,10 @@ def stockcheck(request, info, session):
             behind = datetime.timedelta(days=cd['months_behind'] * 30.4)
             min_sale = cd['minimum_sold']
             dept = int(cd['department'])
-            r = session\
-                .query(StockType, func.sum(StockOut.qty) / behind.days)\
-                .join(StockItem)\
-                .join(StockOut)\
-                .options(lazyload(StockType.department),
-                         lazyload(StockType.unit),
-                         undefer(StockType.instock))\
-                .filter(StockOut.removecode_id == 'sold')\
-                .filter((func.now() - StockOut.time) < behind)\
-                .filter(StockType.dept_id == dept)\
-                .having(func.sum(StockOut.qty) / behind.days > min_sale)\
-                .group_by(StockType)\
-                .all()
-            buylist = [(st, '{:0.1f}'.format(sold),
-                        '{:0.1f}'.format(sold * ahead.days - st.instock))
-                       for st, sold in r]
-            buylist.sort(key=lambda l: float(l[2]), reverse=True)
+            buylist = [(st, '{:0.1f}'.format(sold), '{:0.1f}'.format(buy))
+                       for st, sold, buy in forecast.buylist(
+                               session, ahead.days, behind.days, min_sale,
+                               dept=dept)]
     else:
         form = StockCheckForm(depts)
     return ('stockcheck.html', {'form': form, 'buylist': buylist})
@@ -876,8 +1117,10 @@ def user(request, info, session, userid):
             .query(Transline)\
             .filter(Transline.user == u)\
             .options(joinedload('transaction'),
-                     joinedload_all('stockref.stockitem.stocktype.unit'))\
-            .order_by(desc(Transline.time))[:50]
+                     joinedload_all('stockref.stockitem.stocktype.unit'))
+
+    pager = KeysetPager(request, sales, [Transline.time, Transline.id],
+                        descending=True, items_per_page=50)
 
     payments = session\
                .query(Payment)\
@@ -894,70 +1137,122 @@ def user(request, info, session, userid):
                   .order_by(desc(StockAnnotation.time))[:50]
 
     return ('user.html',
-            {'tuser': u, 'sales': sales, 'payments': payments,
+            {'tuser': u, 'sales': pager.items(), 'pager': pager,
+             'payments': payments,
              'annotations': annotations})
 
-import matplotlib
-matplotlib.use("SVG")
-import matplotlib.pyplot as plt
+def _svg_response(svg):
+    return HttpResponse(svg, content_type="image/svg+xml")
 
-@tillweb_view
+@tillweb_view(immutable=closed_session)
 def session_sales_pie_chart(request, info, session, sessionid):
     s = session\
         .query(Session)\
         .get(int(sessionid))
     if not s:
         raise Http404
-    dt = s.dept_totals
-    fig = plt.figure(figsize=(5, 5))
-    ax = fig.add_subplot(1, 1, 1)
-    patches, texts = ax.pie(
-        [x[1] for x in dt], labels=[x[0].description for x in dt],
-        colors=['r', 'g', 'b', 'c', 'y', 'm', 'olive', 'brown', 'orchid',
-                'royalblue', 'sienna', 'steelblue'])
-    for t in texts:
-        t.set_fontsize(8)
-    for p in patches:
-        p.set_linewidth(0.5)
-        p.set_joinstyle("bevel")
-    response = HttpResponse(content_type="image/svg+xml")
-    # XXX the use of the io.StringIO wrapper is temporary until django's
-    # HttpResponse object is fixed, possibly in django-1.10
-    # See https://code.djangoproject.com/ticket/25576
-    wrapper = io.StringIO()
-    fig.savefig(wrapper, format="svg", transparent=True)
-    plt.close(fig)
-    response.write(wrapper.getvalue())
-    return response
+    return _svg_response(charts.pie_chart(
+        [(d.description, t) for d, t in s.dept_totals]))
 
-@tillweb_view
+@tillweb_view(immutable=closed_session)
 def session_users_pie_chart(request, info, session, sessionid):
     s = session\
         .query(Session)\
         .get(int(sessionid))
     if not s:
         raise Http404
-    ut = s.user_totals
-    fig = plt.figure(figsize=(5, 5))
-    ax = fig.add_subplot(1, 1, 1)
-    patches, texts = ax.pie(
-        [x[2] for x in ut], labels=[x[0].fullname for x in ut],
-        colors=['r', 'g', 'b', 'c', 'y', 'm', 'olive', 'brown', 'orchid',
-                'royalblue', 'sienna', 'steelblue'])
-    for t in texts:
-        t.set_fontsize(8)
-    for p in patches:
-        p.set_linewidth(0.5)
-        p.set_joinstyle("bevel")
-    response = HttpResponse(content_type="image/svg+xml")
-    # XXX the use of the io.StringIO wrapper is temporary until django's
-    # HttpResponse object is fixed, possibly in django-1.10
-    # See https://code.djangoproject.com/ticket/25576
-    wrapper = io.StringIO()
-    fig.savefig(wrapper, format="svg", transparent=True)
-    plt.close(fig)
-    response.write(wrapper.getvalue())
-    return response
+    return _svg_response(charts.pie_chart(
+        [(u.fullname, t) for u, i, t in s.user_totals]))
+
+@tillweb_view(immutable=closed_session)
+def session_takings_by_hour_chart(request, info, session, sessionid):
+    hour = func.date_trunc('hour', Transline.time)
+    hours = session\
+            .query(hour, func.sum(Transline.items * Transline.amount))\
+            .select_from(Transline)\
+            .join(Transaction)\
+            .filter(Transaction.sessionid == int(sessionid))\
+            .group_by(hour)\
+            .order_by(hour)\
+            .all()
+    if not hours:
+        raise Http404
+    # Fill in the hours with no sales, so the bars are evenly spaced
+    totals = dict(hours)
+    h = hours[0][0]
+    bars = []
+    while h <= hours[-1][0]:
+        bars.append((h.strftime("%H:00"), totals.get(h, 0)))
+        h += datetime.timedelta(hours=1)
+    return _svg_response(charts.bar_chart(
+        bars, label_every=max(1, len(bars) // 12), title="Takings by hour"))
+
+def _getdate(request, name):
+    """A date from the query string, or None
+    """
+    try:
+        return datetime.datetime.strptime(
+            request.GET[name], "%Y-%m-%d").date()
+    except (KeyError, ValueError):
+        return None
+
+@tillweb_view
+def takings_by_day_chart(request, info, session):
+    end = _getdate(request, 'end') or datetime.date.today()
+    start = _getdate(request, 'start') or end - datetime.timedelta(days=27)
+    if start > end or (end - start).days > 366:
+        raise Http404
+    days = dict(session\
+                .query(Session.date,
+                       func.sum(Transline.items * Transline.amount))\
+                .select_from(Session)\
+                .join(Transaction)\
+                .join(Transline)\
+                .filter(Session.date >= start)\
+                .filter(Session.date <= end)\
+                .group_by(Session.date)\
+                .all())
+    bars = []
+    d = start
+    while d <= end:
+        bars.append((d.strftime("%d/%m"), days.get(d, 0)))
+        d += datetime.timedelta(days=1)
+    return _svg_response(charts.bar_chart(
+        bars, label_every=max(1, len(bars) // 10), title="Takings by day"))
+
+@tillweb_view
+def export_table(request, info, session, table, format):
+    """Bulk export of a table
+
+    See quicktill.export.  The start and end dates and the watermark
+    of the previous export ("since") are taken from the query string.
+    The watermark of this export is returned in the
+    X-Export-Watermark header.
+    """
+    if table not in export.tables or not export.format_available(format):
+        raise Http404
+    try:
+        since = int(request.GET.get('since', 0))
+    except ValueError:
+        raise Http404
+    upto = export.watermark(session, table)
+    def generate():
+        # The view's database session has been closed by the time
+        # this runs; it is used again and closed at the end
+        try:
+            yield from export.stream(
+                session, table, format,
+                start=_getdate(request, 'start'),
+                end=_getdate(request, 'end'),
+                since=since, upto=upto)
+        finally:
+            session.close()
+    r = StreamingHttpResponse(
+        generate(), content_type=export.formats[format].mimetype)
+    r['Content-Disposition'] = 'attachment; filename={}-{}.{}'.format(
+        info['tillname'], table, format)
+    r['X-Export-Watermark'] = str(upto)
+    return r
 
 class WasteReportForm(forms.Form):
     startdate = forms.DateField(label="Start date", required=False)
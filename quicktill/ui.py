@@ -8,6 +8,7 @@ import textwrap
 import traceback
 from . import keyboard, tillconfig, td
 from .td import func
+from sqlalchemy.sql import or_
 import sqlalchemy.inspection
 
 import logging
@@ -88,13 +89,32 @@ def handle_raw_keyboard_input(k):
     filter stack will typically recognise sequences (eg. "[A01]") and
     convert them into keycode objects.
     """
-    input = [k]
+    handle_raw_keyboard_input_batch([k])
+
+def handle_raw_keyboard_input_batch(keys):
+    """Deal with several items of input from the user at once
+
+    Barcode scanners and magstripe readers deliver many characters in
+    a burst.  The whole burst is passed through the keyboard filter
+    stack in one go.  Each resulting keypress is handled in its own
+    ORM session, so that a keypress that fails can't undo the work
+    of the ones before it.
+    """
+    input = list(keys)
 
     for f in keyboard_filter_stack:
         input = f(input)
 
+    if not input:
+        return
+
     for k in input:
         with td.orm_session():
+            # An earlier keypress in this batch may have dismissed
+            # the current page; the main loop would normally deal
+            # with this before the next keypress arrives
+            if basicpage._basepage is None:
+                tillconfig.firstpage()
             handle_keyboard_input(k)
 
 def current_user():
@@ -1312,6 +1332,229 @@ def automenu(itemlist, spill="menu", **kwargs):
     return keymenu([(possible_keys.pop(0), desc, func, args)
                     for desc, func, args in itemlist], **kwargs)
 
+def like_escape(s):
+    """Escape a string for use in a LIKE or ILIKE pattern
+
+    The escape character is backslash.
+    """
+    return s.replace('\\', '\\\\').replace('%', '\\%').replace('_', '\\_')
+
+class _querypages:
+    """The rows of a query, fetched from the database a page at a time
+
+    Used internally by querymenu.  Rows are converted to lines for
+    display as they are fetched.  The list may start with some fixed
+    lines that do not come from the query; their rows are None.
+    """
+    def __init__(self, query, linefunc, pagesize, extra_lines=[]):
+        self._query = query
+        self._linefunc = linefunc
+        self._pagesize = pagesize
+        self._extra = len(extra_lines)
+        self.rows = [None] * len(extra_lines)
+        self.lines = list(extra_lines)
+        self.complete = False
+
+    def fetch(self, n):
+        """Make sure at least n rows have been fetched
+
+        Fetches pages from the database until there are at least n
+        rows, or until there are no more rows.
+        """
+        while len(self.rows) < n and not self.complete:
+            page = self._query()\
+                       .offset(len(self.rows) - self._extra)\
+                       .limit(self._pagesize)\
+                       .all()
+            if len(page) < self._pagesize:
+                self.complete = True
+            self.rows.extend(page)
+            self.lines.extend(self._linefunc(x) for x in page)
+
+class _queryscrollable(scrollable):
+    """A scrollable that displays rows from a _querypages
+
+    Fetches more rows whenever the cursor approaches the last row
+    fetched so far.
+    """
+    def __init__(self, y, x, width, height, pages, default=0):
+        self._pages = pages
+        super().__init__(y, x, width, height, pages.lines, default=default)
+
+    def set_pages(self, pages):
+        self._pages = pages
+        self.cursor = 0
+        self.top = 0
+        self.set(pages.lines)
+
+    def _fetch_beyond(self, n):
+        # Fetch enough rows to fill the display below row n plus one
+        # more, so drawdl() knows whether to show the "..." marker
+        self._pages.fetch(n + self.h + 1)
+
+    def redraw(self):
+        self._fetch_beyond(max(self.cursor or 0, self.top))
+        super().redraw()
+
+    def cursor_down(self, n=1):
+        self._fetch_beyond((self.cursor or 0) + n)
+        super().cursor_down(n)
+
+class querymenu(dismisspopup):
+    """A popup menu listing the results of a database query
+
+    Rows are fetched from the database a page at a time as the user
+    scrolls through the list, so the time taken to open the menu
+    doesn't depend on the number of rows the query returns.
+
+    query is a function that returns a Query.  It is called in the
+    current ORM session whenever more rows are needed.  The query
+    must be ordered so that the order of the rows is completely
+    determined.
+
+    linefunc is called with each row and should return a string or
+    some subclass of emptyline() to display.
+
+    func is called with the chosen row.  Model instances are added to
+    the current ORM session before func is called.
+
+    If filter_fields is a list of String model attributes then typing
+    narrows the list down to rows where one of the fields starts with
+    the text typed so far, or contains it if filter_contains is set.
+    The filtering is done by the database.  Each filtered list is
+    kept while the popup is open, so deleting the text typed doesn't
+    query the database again.
+
+    extra_items is a list of (desc, func, args) tuples displayed at
+    the top of the list regardless of the filter.
+
+    If default is a row returned by the query, rows are fetched until
+    it is found and the cursor is placed on it.
+    """
+    def __init__(self, query, linefunc, func, title=None,
+                 blurb="Select a line and press Cash/Enter",
+                 filter_fields=[], filter_contains=False, filter="",
+                 extra_items=[], default=None, pagesize=50,
+                 colour=colour_input, w=None, keymap={}):
+        self._basequery = query
+        self._linefunc = linefunc
+        self._func = func
+        self._filter_fields = filter_fields
+        self._filter_contains = filter_contains
+        self._filter = filter
+        self._pagesize = pagesize
+        self._colour = colour
+        self._extra_items = extra_items
+        self._cache = {}
+        pages = self._pages(filter)
+        pages.fetch(pagesize)
+        default_index = 0
+        if default is not None:
+            while default not in pages.rows and not pages.complete:
+                pages.fetch(len(pages.rows) + pagesize)
+            if default in pages.rows:
+                default_index = pages.rows.index(default)
+        if not isinstance(blurb, list):
+            blurb = [blurb]
+        hl = [marginline(lrline(x, colour=colour), margin=1) for x in blurb]
+        mh, mw = rootwin.size()
+        if w is None:
+            w = max((x.idealwidth() for x in pages.lines), default=0) + 2
+            w = max(25, w)
+        if title is not None:
+            w = max(len(title) + 3, w)
+        w = min(w, mw)
+        headerlines = sum(len(x.display(w - 2)) for x in hl)
+        if filter_fields:
+            headerlines += 1
+        if pages.complete:
+            h = sum(len(x.display(w - 2)) for x in pages.lines)
+            h = max(h, 1) + headerlines + 2
+        else:
+            h = mh - 2
+        super().__init__(h, w, title=title, colour=colour, keymap=keymap)
+        self.win.set_cursor(False)
+        h, w = self.win.size()
+        y = 1
+        for hd in hl:
+            for i in hd.display(w - 2):
+                self.win.addstr(y, 1, i)
+                y = y + 1
+        if filter_fields:
+            self._filter_y = y
+            y = y + 1
+            self._draw_filter()
+        self.s = _queryscrollable(y, 1, w - 2, h - y - 1, pages,
+                                  default=default_index)
+        self.s.focus()
+
+    def _line(self, row):
+        l = self._linefunc(row)
+        return l if isinstance(l, emptyline) else line(l, colour=self._colour)
+
+    def _query(self, filter):
+        q = self._basequery()
+        if filter:
+            if self._filter_contains:
+                pattern = "%" + like_escape(filter) + "%"
+                q = q.filter(or_(*(f.ilike(pattern, escape='\\')
+                                   for f in self._filter_fields)))
+            else:
+                # Comparing lower() of the field with a prefix pattern
+                # enables the database to use an index on lower(field)
+                pattern = like_escape(filter.lower()) + "%"
+                q = q.filter(or_(*(func.lower(f).like(pattern, escape='\\')
+                                   for f in self._filter_fields)))
+        return q
+
+    def _pages(self, filter):
+        if filter not in self._cache:
+            extra = [x if isinstance(x, emptyline) else
+                     line(x, colour=self._colour)
+                     for x, f, a in self._extra_items]
+            self._cache[filter] = _querypages(
+                lambda: self._query(filter), self._line, self._pagesize,
+                extra_lines=extra)
+        return self._cache[filter]
+
+    def _draw_filter(self):
+        h, w = self.win.size()
+        text = "Filter: " + self._filter
+        self.win.addstr(self._filter_y, 1, text[-(w - 2):].ljust(w - 2))
+
+    def _set_filter(self, filter):
+        self._filter = filter
+        self._draw_filter()
+        self.s.set_pages(self._pages(filter))
+
+    def keypress(self, k):
+        if k == keyboard.K_CASH:
+            pages = self.s._pages
+            if self.s.cursor is None or self.s.cursor >= len(pages.rows):
+                return
+            if self.s.cursor < len(self._extra_items):
+                desc, f, args = self._extra_items[self.s.cursor]
+                self.dismiss()
+                if args is None:
+                    f()
+                else:
+                    f(*args)
+                return
+            row = pages.rows[self.s.cursor]
+            self.dismiss()
+            if sqlalchemy.inspection.inspect(row, raiseerr=False):
+                td.s.add(row)
+            self._func(row)
+        elif self._filter_fields and isinstance(k, str):
+            self._set_filter(self._filter + k)
+        elif self._filter_fields and k == keyboard.K_BACKSPACE \
+             and self._filter:
+            self._set_filter(self._filter[:-1])
+        elif self._filter_fields and k == keyboard.K_CLEAR and self._filter:
+            self._set_filter("")
+        else:
+            super().keypress(k)
+
 class booleanfield(valuefield):
     """A field with boolean value.
 
@@ -1650,37 +1893,41 @@ class modelfield(editfield):
             readonly=readonly)
 
     def _complete(self, m):
-        q = td.s.query(self._field)
-        q = q.filter(self._field.ilike("{}%".format(m)))
-        q = q.order_by(func.length(self._field), self._field)
-        return [x[0] for x in q.all()]
-
-    @staticmethod
-    def _commonprefix(l):
-        """Case-insensitive common prefix of a list of strings
+        """Case-insensitive completion of a string
 
-        This is surprisingly difficult to think about!
+        Returns the longest common prefix of all the values of the
+        field that start with m, with the case of the shortest
+        matching value, or None if there are no matching values.
 
-        When there is a match, the string returned will have the case
-        of the first list member.
+        This is surprisingly difficult to think about!  The common
+        prefix of all the matches is the common prefix of the lowest
+        and highest of them in codepoint order, so the database only
+        has to return those and the shortest match rather than every
+        matching value.
         """
-        if not l:
+        match = func.lower(self._field).like(
+            like_escape(m.lower()) + "%", escape='\\')
+        shortest = td.s.query(self._field)\
+                       .filter(match)\
+                       .order_by(func.length(self._field), self._field)\
+                       .limit(1)\
+                       .scalar()
+        if shortest is None:
             return
-        s1 = min((x.lower() for x in l))
-        s2 = max((x.lower() for x in l))
+        lowered = func.lower(self._field).collate("C")
+        s1, s2 = td.s.query(func.min(lowered), func.max(lowered))\
+                     .filter(match)\
+                     .one()
         for i, c in enumerate(s1):
             if c != s2[i]:
-                return l[0][:i]
-        return l[0]
+                return shortest[:i]
+        return shortest
 
     def _validate_autocomplete(self, s, c):
         t = s[:c + 1]
         l = self._complete(t)
         if l:
-            # l is in order of length, shortest first, so
-            # _commonprefix will return a string with the case of the
-            # shortest match.
-            return self._commonprefix(l)
+            return l
         # If we can't create new entries, don't allow the user to continue
         # typing if there are no matches
         if not self._create:
@@ -1710,15 +1957,16 @@ class modelfield(editfield):
         i = self.read()
         if self._f and not i:
             # Find candidate matches and pop up a list of them
-            m = td.s.query(self._field)\
-                    .filter(self._field.ilike("{}%".format(self._f)))\
-                    .order_by(self._field)\
-                    .all()
-            ml = [ (x[0], super(modelfield, self).set, (x[0],)) for x in m ]
-            if self._create:
-                ml.append(("Create new...", self._create, (self, self._f,)))
+            f = self._f
+            extra = [("Create new...", self._create, (self, f))] \
+                    if self._create else []
             self.set(None)
-            menu(ml, title="Choose...")
+            querymenu(
+                lambda: td.s.query(self._field).order_by(self._field),
+                lambda x: x[0],
+                lambda x: super(modelfield, self).set(x[0]),
+                title="Choose...", filter_fields=[self._field], filter=f,
+                extra_items=extra)
 
 class modelpopupfield(valuefield):
     """A field that allows a model instance to be chosen using a popup dialog
@@ -1816,7 +2064,8 @@ class modellistfield(modelpopupfield):
 
     This should only be used where the list of model instances is
     expected to be small: the entire list is loaded from the database
-    on every user interaction.  Where the list may be large, it is
+    on every user interaction except popping up the list, which is
+    loaded a page at a time.  Where the list may be large, it is
     likely to be better to use a modelfield() instead.
     """
 
@@ -1828,15 +2077,9 @@ class modellistfield(modelpopupfield):
             f=f, keymap=keymap, readonly=readonly)
 
     def _popuplist(self, func, default):
-        l = self._query(td.s.query(self.model)).all()
-        current = self.read()
-        default = None
-        try:
-            default = l.index(current)
-        except ValueError:
-            pass
-        m = [(self.valuefunc(x), func, (x,)) for x in l]
-        menu(m, colour=colour_line, default=default)
+        querymenu(lambda: self._query(td.s.query(self.model)),
+                  self.valuefunc, func, colour=colour_line,
+                  default=self.read())
 
     def change_query(self, l):
         """Change the query
@@ -0,0 +1,448 @@
+"""Display system that keeps the screen in memory
+
+This display system needs no terminal or X display.  It is used to
+drive the till from a script of keyboard input, for example to
+measure how long the till takes to respond to each keypress when
+run against a test database.
+"""
+
+import time
+import datetime
+import textwrap
+from sqlalchemy import event
+from . import ui
+from . import keyboard
+from . import tillconfig
+from . import user
+from . import models
+
+import logging
+log = logging.getLogger(__name__)
+
+class headless_root:
+    """Root window with single-line header
+
+    The contents of the display can be read using snapshot().
+    """
+    supports_fullscreen = False
+
+    def __init__(self, height=24, width=80, left="Quicktill", middle=""):
+        self._height = height
+        self._width = width
+        self.left = left
+        self.middle = middle
+        self._contents = []
+        self._ontop = []
+
+    def size(self):
+        """Size of screen in characters
+        """
+        return (self._height, self._width)
+
+    def update_header(self, left, middle):
+        self.left = left
+        self.middle = middle
+
+    def isendwin(self):
+        """Has the display been shut down?
+        """
+        return False
+
+    def flush(self):
+        """Flush pending output to the display immediately
+        """
+        pass
+
+    def set_fullscreen(self, fullscreen):
+        """Set whether the display takes the full screen
+        """
+        return False
+
+    def new(self, height, width, y, x, colour=None, always_on_top=False):
+        """Create and return a new window on top of the stack of windows
+        """
+        if not colour:
+            colour = ui.colour_default
+        my, mx = self.size()
+        if height == "max":
+            height = my
+        if height == "page":
+            height = my - 1
+        if width == "max":
+            width = mx
+        if y == "center":
+            y = (my - height) // 2
+        if y == "page":
+            y = 1
+        if x == "center":
+            x = (mx - width) // 2
+        new = headless_window(self, height, width, y, x, colour)
+        if always_on_top:
+            self._ontop.append(new)
+        else:
+            self._contents.append(new)
+        return new
+
+    def _remove(self, window):
+        if window in self._contents:
+            self._contents.remove(window)
+        if window in self._ontop:
+            self._ontop.remove(window)
+
+    def snapshot(self):
+        """The contents of the display
+
+        Returns a list of strings, one per line of the display.  The
+        header line has no clock, so that snapshots taken at
+        different times can be compared.
+        """
+        header = self.middle.center(self._width)[:self._width]
+        header = (self.left + header[len(self.left):])[:self._width]
+        screen = [list(header.ljust(self._width))]
+        screen += [[' '] * self._width for i in range(self._height - 1)]
+        for w in self._contents + self._ontop:
+            for y, l in enumerate(w._lines):
+                if 0 <= w.y + y < self._height:
+                    row = screen[w.y + y]
+                    for x, ch in enumerate(l):
+                        if 0 <= w.x + x < self._width:
+                            row[w.x + x] = ch
+        return [''.join(l) for l in screen]
+
+class window_stack:
+    def __init__(self, stack, root, ontop=False):
+        self._stack = stack
+        self._root = root
+        self._ontop = ontop
+
+    def restore(self):
+        if self._ontop:
+            self._root._ontop += self._stack
+        else:
+            self._root._contents += self._stack
+
+class headless_window:
+    """A window to draw text in
+    """
+    def __init__(self, root, height, width, y, x, colour=ui.colour_default):
+        self._root = root
+        self.y = y
+        self.x = x
+        self.height = height
+        self.width = width
+        self.colour = colour
+        self.cur_y = 0
+        self.cur_x = 0
+        self.erase()
+
+    def destroy(self):
+        self._root._remove(self)
+
+    def flush(self):
+        pass
+
+    def size(self):
+        return (self.height, self.width)
+
+    def save_stack(self):
+        # Hide this window and all windows on top of it (excluding
+        # those marked "always on top") and return an object that can
+        # be used to restore them
+        if self in self._root._ontop:
+            # Only "always on top" windows can be above this one
+            self._root._ontop.remove(self)
+            return window_stack([self], self._root, ontop=True)
+        i = self._root._contents.index(self)
+        stack = self._root._contents[i:]
+        self._root._contents = self._root._contents[:i]
+        return window_stack(stack, self._root)
+
+    def clear(self, y, x, height, width, colour=None):
+        """Clear a rectangle to a solid colour
+        """
+        l = ' ' * width
+        for i in range(y, y + height):
+            self.addstr(i, x, l, colour)
+
+    def addstr(self, y, x, s, colour=None):
+        if 0 <= y < self.height:
+            line = self._lines[y]
+            for i, ch in enumerate(s, start=x):
+                if 0 <= i < self.width:
+                    line[i] = ch
+        self.move(y, x + len(s))
+
+    def wrapstr(self, y, x, width, s, colour=None, display=True):
+        """Display a string wrapped to specified width.
+
+        Returns the number of lines that the string was wrapped over.
+        """
+        lines = 0
+        for line in s.splitlines():
+            if line:
+                for wrappedline in textwrap.wrap(line, width):
+                    if display:
+                        self.addstr(y + lines, x, wrappedline, colour)
+                    lines += 1
+            else:
+                lines += 1
+        return lines
+
+    def getyx(self):
+        return (self.cur_y, self.cur_x)
+
+    def move(self, y, x):
+        self.cur_y = y
+        self.cur_x = x
+
+    def erase(self):
+        self._lines = [[' '] * self.width for i in range(self.height)]
+
+    def border(self, title=None, clear=None):
+        h, w = self.size()
+        self.addstr(0, 0, '+' + '-' * (w - 2) + '+')
+        for y in range(1, h - 1):
+            self.addstr(y, 0, '|')
+            self.addstr(y, w - 1, '|')
+        self.addstr(h - 1, 0, '+' + '-' * (w - 2) + '+')
+        if title:
+            self.addstr(0, 1, title)
+        if clear:
+            self.addstr(h - 1, w - 1 - len(clear), clear)
+
+    def set_cursor(self, state):
+        pass
+
+def decode_item(l):
+    """Decode one line of a keyboard input script
+
+    Returns a list of items of keyboard input.
+    """
+    if l.startswith("usertoken:"):
+        return [user.token(l[10:])]
+    if l.startswith("chars:"):
+        return list(l[6:])
+    if l.startswith("K_"):
+        if hasattr(keyboard, l):
+            return [getattr(keyboard, l)]
+        if l[6:].isdigit() and l.startswith("K_LINE"):
+            return [keyboard.linekey(int(l[6:]))]
+    return [l]
+
+def encode_item(k):
+    """Encode an item of keyboard input for a script
+
+    Returns None if the item can't be represented in a script.
+    """
+    if isinstance(k, user.token):
+        return "usertoken:" + k.usertoken
+    if isinstance(k, keyboard.keycode):
+        if getattr(keyboard, k.name, None) is k:
+            return k.name
+        return None
+    if isinstance(k, str) and k.isprintable() and k:
+        return "chars:" + k
+    return None
+
+def decode_script(f):
+    """Read keyboard input from a script
+
+    Each line of the script is one item of keyboard input, in the
+    same format as the output of the on-screen keyboard helper:
+    "usertoken:" followed by a user token, the name of a keycode (eg.
+    "K_CASH"), or a string.  Lines starting with "chars:" are split
+    into individual characters, for input that the keyboard filter
+    stack should see one character at a time (eg. "chars:[A01]").
+    Blank lines and lines starting with "#" are ignored.
+    """
+    keys = []
+    for l in f:
+        l = l.rstrip("\n")
+        if not l or l.startswith("#"):
+            continue
+        keys.extend(decode_item(l))
+    return keys
+
+class recorder:
+    """Keyboard input filter that records input to a file
+
+    Install at the end of ui.keyboard_filter_stack so that it sees
+    keycodes and user tokens rather than the raw input from the
+    keyboard.  All input is passed on unchanged.
+
+    Each line of the file is the number of seconds since the
+    previous item of input followed by the item in the same format
+    as a keyboard input script; see read_recording().
+    """
+    def __init__(self, f):
+        self.f = f
+        self.last = time.monotonic()
+        self.f.write("# Keyboard input recorded {:%Y-%m-%d %H:%M:%S} "
+                     "using configuration '{}'\n".format(
+                         datetime.datetime.now(), tillconfig.configname))
+        self.f.flush()
+
+    def __call__(self, keys):
+        now = time.monotonic()
+        for k in keys:
+            item = encode_item(k)
+            if item is None:
+                log.debug("Not recording keyboard input %s", repr(k))
+                continue
+            self.f.write("{:.3f} {}\n".format(now - self.last, item))
+            self.last = now
+        self.f.flush()
+        return keys
+
+def read_recording(f):
+    """Read keyboard input recorded by recorder
+
+    Returns a list of items of keyboard input and a list of the
+    number of seconds to wait before each item.
+    """
+    keys = []
+    delays = []
+    for l in f:
+        l = l.rstrip("\n")
+        if not l or l.startswith("#"):
+            continue
+        delay, item = l.split(" ", 1)
+        for i, k in enumerate(decode_item(item)):
+            keys.append(k)
+            delays.append(float(delay) if i == 0 else 0.0)
+    return keys, delays
+
+def percentile(l, p):
+    """The p'th percentile of a sorted list
+    """
+    if not l:
+        return None
+    return l[min(len(l) - 1, int(len(l) * p / 100))]
+
+def latency_report(latencies, elapsed, statements=None):
+    """Summarise a list of keypress latencies in seconds
+
+    Returns a list of lines of text.
+    """
+    l = sorted(latencies)
+    if not l:
+        return ["No keypresses"]
+    report = [
+        "{} keypresses in {:.2f} seconds ({:.1f} per second)".format(
+            len(l), elapsed, len(l) / elapsed),
+        "Latency: mean {:.2f}ms, median {:.2f}ms, 90% {:.2f}ms, "
+        "99% {:.2f}ms, max {:.2f}ms".format(
+            sum(l) * 1000 / len(l), percentile(l, 50) * 1000,
+            percentile(l, 90) * 1000, percentile(l, 99) * 1000,
+            l[-1] * 1000),
+    ]
+    if statements is not None:
+        report.append("{} SQL statements ({:.1f} per keypress)".format(
+            statements, statements / len(l)))
+    return report
+
+class statement_counter:
+    """Count the SQL statements issued while in a "with" block
+    """
+    def __init__(self):
+        self.statements = 0
+
+    def _count(self, *args):
+        self.statements += 1
+
+    def __enter__(self):
+        event.listen(models.metadata.bind, "before_cursor_execute",
+                     self._count)
+        return self
+
+    def __exit__(self, type, value, traceback):
+        event.remove(models.metadata.bind, "before_cursor_execute",
+                     self._count)
+
+class _beep_counter:
+    def __init__(self):
+        self.beeps = 0
+
+    def __call__(self):
+        self.beeps += 1
+
+def run(keys, height=24, width=80, keypress_hook=None, delays=None):
+    """Start running with the headless display system
+
+    Each item of keys is passed to ui.handle_raw_keyboard_input() in
+    turn, running any timeouts that are due between keypresses.
+    Stops at the end of keys or when the main loop is shut down.
+
+    If delays is provided it is a list of the number of seconds to
+    wait before each item of keys; otherwise the keys are handled
+    as fast as possible.
+
+    If keypress_hook is provided it is called after each keypress
+    with the item of input and the number of seconds taken to handle
+    it.
+
+    Returns a list of the number of seconds taken to handle each
+    item of input.
+    """
+    ui.rootwin = headless_root(height, width)
+    ui.beep = _beep_counter()
+    ui.toaster.notify_display_initialised()
+    for i in ui.run_after_init:
+        i()
+    latencies = []
+    due = time.monotonic()
+    for i, k in enumerate(keys):
+        if delays:
+            due += delays[i]
+            while tillconfig.mainloop.exit_code is None:
+                wait = due - time.monotonic()
+                if wait <= 0:
+                    break
+                ui.basicpage._ensure_page_exists()
+                tillconfig.mainloop.iterate(max_wait=wait)
+        if tillconfig.mainloop.exit_code is not None:
+            break
+        ui.basicpage._ensure_page_exists()
+        start = time.perf_counter()
+        ui.handle_raw_keyboard_input(k)
+        t = time.perf_counter() - start
+        latencies.append(t)
+        if keypress_hook:
+            keypress_hook(k, t)
+        tillconfig.mainloop.iterate(max_wait=0)
+    if ui.beep.beeps:
+        log.info("Headless display: %d beeps", ui.beep.beeps)
+    return latencies
+
+def run_and_report(keys, delays=None, repeat=1, latencyfile=None,
+                   snapshot=False):
+    """Run keyboard input and report how long it took
+
+    keys (and delays, if provided) are run repeat times over; see
+    run().  If latencyfile is provided, the time taken to handle
+    each keypress is written to it in CSV format and it is closed
+    afterwards.  If snapshot is set, the contents of the display at
+    the end of the run are included in the report.
+
+    Returns a list of lines of text.
+    """
+    count = [0]
+    def record(k, t):
+        count[0] += 1
+        latencyfile.write("{},{},{:.6f}\n".format(
+            count[0], str(k).replace(",", ""), t))
+    start = time.time()
+    with statement_counter() as sql:
+        latencies = run(keys * repeat,
+                        delays=delays * repeat if delays else None,
+                        keypress_hook=record if latencyfile else None)
+    elapsed = time.time() - start
+    if latencyfile:
+        latencyfile.close()
+    report = latency_report(latencies, elapsed, sql.statements)
+    if repeat > 1 and keys and elapsed > 0:
+        report.append("{:.1f} runs of the script per minute".format(
+            len(latencies) / len(keys) * 60 / elapsed))
+    if snapshot:
+        report += [l.rstrip() for l in ui.rootwin.snapshot()]
+    return report
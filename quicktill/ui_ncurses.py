@@ -73,6 +73,7 @@ class curses_root:
         self._win = win
         self.left = left
         self.middle = middle
+        self._header = None # What is currently drawn on the header line
         self._clockalarm()
 
     def _redraw(self):
@@ -104,7 +105,22 @@ class curses_root:
             else:
                 t = t[1:]
             x = cat(m, s, t)
-        self._win.addstr(0, 0, x.encode(c), _curses_attr(ui.colour_header))
+        old = self._header
+        if x == old:
+            return
+        self._header = x
+        start = 0
+        if old is not None and len(old) == len(x):
+            # Only draw the part of the header that has changed;
+            # usually this is just the last few digits of the clock
+            while x[start] == old[start]:
+                start += 1
+            end = len(x)
+            while x[end - 1] == old[end - 1]:
+                end -= 1
+            x = x[start:end]
+        self._win.addstr(0, start, x.encode(c), _curses_attr(ui.colour_header))
+        _damage(self)
 
     def update_header(self, left, middle):
         self.left = left
@@ -158,6 +174,7 @@ class curses_root:
         self._check_on_top()
         win.bkgdset(ord(' '), _curses_attr(colour))
         win.erase()
+        _damage(cw)
         return cw
 
     def set_fullscreen(self, fullscreen):
@@ -185,6 +202,7 @@ class window_stack:
     def restore(self):
         for i in self._stack:
             i._pan.show()
+            _damage(i)
         ui.rootwin._check_on_top()
 
 class curses_window:
@@ -202,6 +220,7 @@ class curses_window:
     def destroy(self):
         if self._pan:
             self._pan.hide()
+        _damage(self)
         del self._win, self._pan
 
     def flush(self):
@@ -225,6 +244,7 @@ class curses_window:
                 to_save._pan.hide()
         l.append(self)
         self._pan.hide()
+        _damage(self)
         l.reverse()
         return window_stack(l)
 
@@ -238,6 +258,7 @@ class curses_window:
     def addstr(self, y, x, s, colour=None):
         if colour is None:
             colour = self.colour
+        _damage(self)
         try:
             self._win.addstr(y, x, s.encode(c), _curses_attr(colour))
         except curses.error:
@@ -263,12 +284,16 @@ class curses_window:
         return self._win.getyx()
 
     def move(self, y, x):
+        if self._win.getyx() != (y, x):
+            _damage(self)
         return self._win.move(y, x)
 
     def erase(self):
+        _damage(self)
         return self._win.erase()
 
     def border(self, title=None, clear=None):
+        _damage(self)
         self._win.border()
         if title:
             self.addstr(0, 1, title)
@@ -282,9 +307,75 @@ class curses_window:
         # based on that
         pass
 
+# Windows that have been drawn on, moved, shown or hidden since the
+# last screen update.  If this is empty there is nothing to send to
+# the terminal and _doupdate() does nothing.
+_damaged = set()
+
+def _damage(win):
+    _damaged.add(win)
+
+# Set to an instance of _output_meter if we are measuring the amount
+# of output sent to the terminal
+_meter = None
+
 def _doupdate():
-    curses.panel.update_panels()
-    curses.doupdate()
+    if not _damaged:
+        if _meter:
+            _meter.skipped += 1
+        return
+    _damaged.clear()
+    if _meter:
+        with _meter:
+            curses.panel.update_panels()
+            curses.doupdate()
+    else:
+        curses.panel.update_panels()
+        curses.doupdate()
+
+class _output_meter:
+    """Measure the amount of output sent to the terminal
+
+    Used as a context manager around screen updates.  The number of
+    bytes written by the process during the update is read from
+    /proc/self/io, so this only works on Linux.  Totals are written to
+    the log every "interval" seconds.
+    """
+    def __init__(self, interval=10):
+        self._io = open("/proc/self/io", "rb", buffering=0)
+        self._interval = interval
+        self._reset()
+        tillconfig.mainloop.add_timeout(
+            self._interval, self._report, "terminal output report")
+
+    def _reset(self):
+        self.bytes = 0
+        self.updates = 0
+        self.skipped = 0
+        self._start = time.time()
+
+    def _wchar(self):
+        self._io.seek(0)
+        for l in self._io.read().splitlines():
+            if l.startswith(b"wchar:"):
+                return int(l[6:])
+        return 0
+
+    def __enter__(self):
+        self._before = self._wchar()
+
+    def __exit__(self, type, value, traceback):
+        self.bytes += self._wchar() - self._before
+        self.updates += 1
+
+    def _report(self):
+        elapsed = time.time() - self._start
+        log.info("Terminal output: %.1f bytes/s over %.0f seconds; "
+                 "%d screen updates, %d skipped",
+                 self.bytes / elapsed, elapsed, self.updates, self.skipped)
+        self._reset()
+        tillconfig.mainloop.add_timeout(
+            self._interval, self._report, "terminal output report")
 
 # curses codes and their till keycode equivalents
 kbcodes = {
@@ -315,32 +406,49 @@ kbcodes = {
 
 def _curses_keyboard_input():
     """Called by the mainloop whenever data is available on sys.stdin
-    """
-    i = _stdwin.getch()
-    if i == -1:
-        return
-    if i == curses.KEY_RESIZE:
-        # Notify interested code that the screen has resized; NB this
-        # doesn't reliably arrive until the next keypress;
-        # _curses_keyboard_input() could be installed to handle
-        # SIGWINCH as well?
-        for f in ui.run_after_resize:
-            f()
-        return
-    if i in kbcodes:
-        ui.handle_raw_keyboard_input(kbcodes[i])
-    elif curses.ascii.isprint(i):
-        ui.handle_raw_keyboard_input(chr(i))
 
-def _init(w):
+    Reads all the input that is available and handles it as a single
+    batch, so that a burst of input from a barcode scanner or
+    magstripe reader doesn't cost a trip around the main loop and a
+    screen update per character.
+    """
+    keys = []
+    while True:
+        i = _stdwin.getch()
+        if i == -1:
+            break
+        if i == curses.KEY_RESIZE:
+            # Notify interested code that the screen has resized; NB
+            # this doesn't reliably arrive until the next keypress;
+            # _curses_keyboard_input() could be installed to handle
+            # SIGWINCH as well?
+            if keys:
+                ui.handle_raw_keyboard_input_batch(keys)
+                keys = []
+            for f in ui.run_after_resize:
+                f()
+        elif i in kbcodes:
+            keys.append(kbcodes[i])
+        elif curses.ascii.isprint(i):
+            keys.append(chr(i))
+    if keys:
+        log.debug("Keyboard input: batch of %d", len(keys))
+        ui.handle_raw_keyboard_input_batch(keys)
+
+def _init(w, measure_output=False):
     """ncurses has been initialised, and calls us with the root window.
 
     When we leave this function for whatever reason, ncurses will shut
     down and return the display to normal mode.  If we're leaving with
     an exception, ncurses will reraise it.
     """
-    global _stdwin
+    global _stdwin, _meter
     _stdwin = w
+    if measure_output:
+        try:
+            _meter = _output_meter()
+        except OSError:
+            log.warning("Unable to measure terminal output on this system")
     w.nodelay(1)
     _init_colourpairs()
     ui.beep = curses.beep
@@ -355,7 +463,10 @@ def _init(w):
         _doupdate()
         tillconfig.mainloop.iterate()
 
-def run():
+def run(measure_output=False):
     """Start running with the ncurses display system
+
+    If measure_output is set, the number of bytes per second sent to
+    the terminal is written to the log periodically.
     """
-    curses.wrapper(_init)
+    curses.wrapper(_init, measure_output=measure_output)
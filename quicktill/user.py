@@ -303,8 +303,7 @@ class tokenlistener:
         log.debug("Received: {}".format(repr(d)))
         if d:
             tillconfig.unblank_screen()
-            with td.orm_session():
-                ui.handle_keyboard_input(token(d))
+            ui.handle_raw_keyboard_input(token(d))
 
 def user_from_token(t):
     """Find a user given a token object.
@@ -11,8 +11,9 @@ from . import td
 from . import user
 from . import delivery
 from . import keyboard
+from . import report
 from .models import Session, SessionNoteType, SessionNote, zero
-from .models import Delivery, Supplier
+from .models import Delivery, Supplier, Department
 log = logging.getLogger(__name__)
 
 XERO_ENDPOINT_URL = "https://api.xero.com/api.xro/2.0/"
@@ -310,10 +311,15 @@ class XeroIntegration:
             raise XeroError("Session {} does not exist".format(sessionid))
         if not session.endtime:
             raise XeroError("Session {} is still open".format(sessionid))
-        if not session.actual_totals:
+        # The department totals, actual totals and error all come from
+        # a single query
+        totals = list(report.session_totals(td.s, sessionids=[sessionid]))[0]
+        if totals.actual_total is None:
             raise XeroError("Session {} has no totals recorded".format(
                 sessionid))
-        
+        depts = {d.id: d for d in td.s.query(Department)
+                 .filter(Department.id.in_(totals.depts.keys()))}
+
         invoices = Element("Invoices")
         inv = SubElement(invoices, "Invoice")
         inv.append(_textelem("Type", "ACCREC"))
@@ -333,7 +339,8 @@ class XeroIntegration:
         if approve:
             inv.append(_textelem("Status", "AUTHORISED"))
         litems = SubElement(inv, "LineItems")
-        for dept, amount in session.dept_totals:
+        for deptid, amount in totals.depts.items():
+            dept = depts[deptid]
             li = SubElement(litems, "LineItem")
             li.append(_textelem("Description", dept.description))
             li.append(_textelem("AccountCode",
@@ -344,7 +351,7 @@ class XeroIntegration:
                 li.append(tracking)
         # If there is a discrepancy between the till totals and the
         # actual totals, this must be recorded in a separate account
-        if session.error != zero:
+        if totals.error != zero:
             if not self.discrepancy_account:
                 raise XeroError(
                     "Session {} has a discrepancy between till total and "
@@ -353,7 +360,7 @@ class XeroIntegration:
             li = SubElement(litems, "LineItem")
             li.append(_textelem("Description", "Till discrepancy"))
             li.append(_textelem("AccountCode", self.discrepancy_account))
-            li.append(_textelem("LineAmount", str(session.error)))
+            li.append(_textelem("LineAmount", str(totals.error)))
             li.append(_textelem("TaxType", "NONE"))
             tracking = self._get_tracking(None)
             if tracking: